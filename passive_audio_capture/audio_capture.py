@@ -1,8 +1,39 @@
-import alsaaudio
 import sys
 import time
 import queue
 
+try:
+    import alsaaudio
+except ImportError:
+    # Without pyalsaaudio only a simulated backend (see pac_fake_pcm) can be used
+    alsaaudio = None
+
+
+# ALSA capture parameters of the (hacked) Batsound interface
+SAMPLE_RATE = 256000        # 256kHz sample rate
+CHANNELS = 1                # Mono audio capture
+SAMPLE_WIDTH = 2            # 16-bit samples
+PERIOD_SIZE = 1024*4        # Frames per period
+PERIODS = 4                 # Number of periods in the buffer
+PERIOD_BYTES = PERIOD_SIZE * CHANNELS * SAMPLE_WIDTH
+
+
+def open_alsa_pcm(device_name, channels=CHANNELS, rate=SAMPLE_RATE, periodsize=PERIOD_SIZE, periods=PERIODS):
+    """
+    Open an ALSA capture device for 16-bit little-endian capture.
+
+    Returns:
+        alsaaudio.PCM: The opened device
+    """
+    if alsaaudio is None:
+        raise RuntimeError("pyalsaaudio is not installed, cannot open ALSA device " + device_name)
+    return alsaaudio.PCM(alsaaudio.PCM_CAPTURE, 
+                         device=device_name, 
+                         channels=channels,       # Mono audio capture
+                         rate=rate,               # 256kHz sample rate
+                         format=alsaaudio.PCM_FORMAT_S16_LE,  # 16-bit little-endian
+                         periodsize=periodsize,   # Buffer size for each period
+                         periods=periods)         # Number of periods in the buffer
 
 
 class AudioCapture:
@@ -13,40 +44,79 @@ class AudioCapture:
     with configurable parameters such as sample rate, format, and buffer sizes.
     """
     
-    def __init__(self, device_name="hw:CARD=Ultrasound,DEV=0"):
+    def __init__(self, device_name="hw:CARD=Ultrasound,DEV=0", pcm_factory=open_alsa_pcm,
+                 rate=SAMPLE_RATE, channels=CHANNELS, period_size=PERIOD_SIZE, periods=PERIODS):
         """
         Initialize the audio capture device with specific ALSA parameters.
         
         Args:
             device_name (str): ALSA device identifier. Defaults to Ultrasound device.
+            pcm_factory (callable): Opens the PCM device; defaults to ALSA. Pass e.g. FakePCM
+                                    to capture from a simulated device.
+            rate (int): Sample rate in Hz (default: 256000)
+            channels (int): Number of channels (default: 1)
+            period_size (int): Frames per period (default: 4096)
+            periods (int): Number of periods in the device buffer (default: 4)
         """
-        self.device = alsaaudio.PCM(alsaaudio.PCM_CAPTURE, 
-                                    device=device_name, 
-                                    channels=1,          # Mono audio capture
-                                    rate=256000,         # 256kHz sample rate
-                                    format=alsaaudio.PCM_FORMAT_S16_LE,  # 16-bit little-endian
-                                    periodsize=1024*4,   # Buffer size for each period
-                                    periods=4)           # Number of periods in the buffer
-
-    def capture(self, runtime=1, data_queue=None, barrier=None):
+        self.device_name = device_name
+        self.rate = rate
+        self.channels = channels
+        self.period_size = period_size
+        self.first_period_time = None
+        self.first_sample_time = None
+        self.timestamp_source = None
+        self.frames_captured = 0
+        self.overruns = 0
+        self.device = pcm_factory(device_name, channels=channels, rate=rate, periodsize=period_size, periods=periods)
+
+        # Let ALSA timestamp its status in wall clock time (pyalsaaudio >= 0.10)
+        self.hardware_timestamps = False
+        try:
+            self.device.set_tstamp_mode(alsaaudio.PCM_TSTAMP_ENABLE)
+            self.device.set_tstamp_type(alsaaudio.PCM_TSTAMP_TYPE_GETTIMEOFDAY)
+            self.hardware_timestamps = True
+        except Exception:
+            # Older pyalsaaudio, or a backend without timestamp support
+            pass
+
+    def capture(self, runtime=1, data_queue=None, barrier=None, ring_buffer=None, stop_event=None, on_status=None,
+                metrics=None):
         """
         Capture audio data for a specified duration.
+
+        The capture stops after exactly runtime * rate frames, independent of the
+        wall clock. The time of the first captured sample is stored in first_sample_time.
         
         Args:
             runtime (float): Duration to capture audio in seconds. Defaults to 1 second.
+                             None captures until stop_event is set.
             data_queue (Queue, optional): Queue to store captured audio data. If None,
                                         data is only printed to console.
             barrier (threading.Barrier, optional): Synchronization barrier for coordinated
                                                  start across multiple captures.
+            ring_buffer (RingBuffer, optional): Preallocated ring buffer to copy periods into.
+                                                Takes precedence over data_queue.
+            stop_event (threading.Event, optional): Stops the capture early when set.
+            on_status (callable, optional): Called with this capture after the first period
+                                            and after every overrun, e.g. to publish
+                                            first_sample_time to another process.
+            metrics (CaptureMetrics, optional): Counters to update with every period and overrun.
         """
         # Wait for synchronization if barrier is provided
         if barrier:
             barrier.wait()
         
         self.start_time = time.time()
+        self.first_period_time = None
+        self.first_sample_time = None
+        self.frames_captured = 0
+        self.overruns = 0
         print(f"Starting capture at {self.start_time}")
-        
-        while time.time() - self.start_time < runtime:
+
+        max_frames = None if runtime is None else int(round(runtime * self.rate))
+        while max_frames is None or self.frames_captured < max_frames:
+            if stop_event is not None and stop_event.is_set():
+                break
             # Read data from the device
             # l: number of frames read (negative indicates buffer overflow)
             # data: the actual audio data
@@ -54,7 +124,22 @@ class AudioCapture:
             
             if l > 0:
                 # Successfully read data
-                if data_queue:
+                if self.first_period_time is None:
+                    self.first_period_time = time.time()
+                    self.first_sample_time, self.timestamp_source = self._first_sample_time(l, self.first_period_time)
+                    if on_status is not None:
+                        on_status(self)
+                if max_frames is not None and self.frames_captured + l > max_frames:
+                    # Cut the last period so exactly max_frames frames are captured
+                    l = max_frames - self.frames_captured
+                    data = data[:l * self.channels * SAMPLE_WIDTH]
+                self.frames_captured += l
+                if metrics is not None:
+                    metrics.period_read(l)
+                if ring_buffer is not None:
+                    # Full buffer drops the period; counted by the ring buffer itself
+                    ring_buffer.put(data)
+                elif data_queue:
                     data_queue.put(data)
                 else:
                     print(f"Captured {l} bytes")
@@ -63,11 +148,46 @@ class AudioCapture:
                 pass
             else:
                 # Buffer overflow occurred
+                self.overruns += 1
+                if metrics is not None:
+                    metrics.overrun()
                 print(f"Buffer overflow ({l})")
+                if on_status is not None:
+                    on_status(self)
                 
         self.stop_time = time.time()
         print(f"Stopping capture at {self.stop_time}")
 
+    def _first_sample_time(self, frames_read, read_time):
+        """
+        Estimate the wall clock time of the first sample after the first successful read.
+
+        With ALSA timestamps, the status timestamp marks the moment the hardware pointer
+        stood at frames_read + available frames, which dates the first sample without any
+        scheduling jitter. Otherwise the read is assumed to return as soon as its period
+        was complete.
+
+        Returns:
+            tuple: (first sample time, timestamp source "htimestamp" or "clock")
+        """
+        if self.hardware_timestamps:
+            try:
+                seconds, nanoseconds, available = self.device.htimestamp()[:3]
+                if seconds > 0:
+                    return seconds + nanoseconds * 1e-9 - (frames_read + available) / self.rate, "htimestamp"
+            except Exception:
+                pass
+        return read_time - frames_read / self.rate, "clock"
+
+    def rearm(self):
+        """
+        Stop the stream and drop all buffered frames, so the device is idle between runs
+        and the next read starts a fresh stream instead of returning stale data.
+        """
+        self.device.drop()
+
+    def close(self):
+        self.device.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,234 @@
+"""
+Capture pipeline throughput benchmark.
+
+Drives the CaptureManager (threads) or the ProcessCaptureManager (a process per device)
+with N simulated devices (FakePCM) and reports, per configuration, the sustained write
+throughput, overruns and dropped periods, the CPU used per device and the peak RSS (of the
+largest process in process mode). Every configuration runs in its own process, so the
+peak RSS of one run does not leak into the next.
+
+Runs on any Linux box without Batsounds, e.g. to find the device-count ceiling of a Pi:
+
+    python pac_benchmark.py --devices 2 4 6 8 --rates 256000 384000 --duration 10 --modes thread process
+
+Use --fail-on-loss to turn overruns or dropped periods into a non-zero exit code.
+
+With --check-early-stop, every mode instead starts a timed capture of --duration seconds
+and stops it after --stop-after seconds, as a stop command does, and checks that it ends
+right away instead of running to the end:
+
+    python pac_benchmark.py --check-early-stop --modes thread process --duration 10 --stop-after 1
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from audio_capture import AudioCapture, PERIOD_SIZE, SAMPLE_WIDTH
+from pac_capture_manager import CaptureManager
+from pac_device_pool import DevicePool
+from pac_fake_pcm import FakePCM
+from pac_process_capture import ProcessCaptureManager
+
+
+def fake_capture_factory(device_name, rate, channels, period_size, fake_options):
+    pcm_factory = partial(FakePCM, **fake_options)
+    return AudioCapture(device_name, pcm_factory=pcm_factory, rate=rate, channels=channels, period_size=period_size)
+
+
+def build_manager(devices: int, rate: int, channels: int, period_size: int, storage_path: str, fake_options: dict,
+                  mode: str):
+    """
+    Returns:
+        Union[CaptureManager, ProcessCaptureManager]: A capture manager for simulated devices
+    """
+    device_names = [f"fake:{i}" for i in range(devices)]
+    capture_factory = partial(fake_capture_factory, rate=rate, channels=channels,
+                              period_size=period_size, fake_options=fake_options)
+    if mode == "process":
+        return ProcessCaptureManager(devices=device_names, capture_factory=capture_factory, storage_path=storage_path,
+                                     sample_rate=rate, channels=channels, period_size=period_size)
+    pool = DevicePool(device_names, capture_factory=capture_factory)
+    return CaptureManager(device_pool=pool, storage_path=storage_path,
+                          sample_rate=rate, channels=channels, period_size=period_size)
+
+
+def run_benchmark(devices: int, rate: int, duration: float, channels: int = 1, period_size: int = PERIOD_SIZE,
+                  storage_path: str = None, fake_options: dict = None, mode: str = "thread") -> dict:
+    """
+    Run a single capture with simulated devices and measure it.
+
+    Args:
+        devices (int): Number of simulated devices
+        rate (int): Sample rate in Hz
+        duration (float): Capture duration in seconds
+        channels (int): Channels per device
+        period_size (int): Frames per period
+        storage_path (str, optional): Directory to write to; a temporary directory if omitted
+        fake_options (dict, optional): Extra FakePCM options (overrun/stall injection)
+        mode (str): "thread" for the CaptureManager, "process" for the ProcessCaptureManager
+
+    Returns:
+        dict: Benchmark results
+    """
+    fake_options = fake_options or {}
+    temporary = storage_path is None
+    storage_path = storage_path or tempfile.mkdtemp(prefix="pac_benchmark_")
+    try:
+        manager = build_manager(devices, rate, channels, period_size, storage_path, fake_options, mode)
+
+        start_time = time.time() + 0.5
+        manager.start(duration, start_time)
+        cpu_start = time.process_time()
+        wall_start = time.monotonic()
+        manager.stop()
+        wall = time.monotonic() - wall_start
+        cpu = time.process_time() - cpu_start
+
+        if mode == "process":
+            writer_reports = [report for report in manager.writer_reports if report is not None]
+            capture_reports = [report for report in manager.capture_reports if report is not None]
+            bytes_written = sum(report["bytes_written"] for report in writer_reports)
+            latency_p99 = max((report["latency_p99"] for report in writer_reports), default=0.0)
+            overruns = sum(report["overruns"] for report in capture_reports)
+            # The capture and writer processes measure their own CPU time
+            cpu += sum(report["cpu_seconds"] for report in writer_reports + capture_reports)
+        else:
+            bytes_written = sum(writer.bytes_written for writer in manager.writers if writer is not None)
+            latency_p99 = max((writer.latency.percentile(99) for writer in manager.writers if writer is not None), default=0.0)
+            overruns = sum(capture.overruns for capture in manager.captures if capture is not None)
+        dropped_periods = sum(ring_buffer.dropped_periods for ring_buffer in manager.ring_buffers)
+        ring_high_water_mark = max(ring_buffer.high_water_mark for ring_buffer in manager.ring_buffers)
+        if mode == "process":
+            manager.shutdown()
+
+        expected_bytes = int(round(duration * rate)) * channels * SAMPLE_WIDTH * devices
+        peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        return {
+            "mode": mode,
+            "devices": devices,
+            "rate": rate,
+            "channels": channels,
+            "period_size": period_size,
+            "duration": duration,
+            "wall_seconds": wall,
+            "throughput_mb_s": bytes_written / wall / 1024 / 1024,
+            "required_mb_s": rate * channels * SAMPLE_WIDTH * devices / 1024 / 1024,
+            "complete": bytes_written == expected_bytes,
+            "overruns": overruns,
+            "dropped_periods": dropped_periods,
+            "ring_high_water_mark": ring_high_water_mark,
+            "cpu_percent_per_device": 100.0 * cpu / wall / devices,
+            "write_latency_p99_ms": latency_p99 * 1000,
+            "peak_rss_mb": peak_rss / 1024,
+        }
+    finally:
+        if temporary:
+            shutil.rmtree(storage_path, ignore_errors=True)
+
+
+def run_early_stop_check(devices: int, rate: int, duration: float, stop_after: float, mode: str = "thread") -> dict:
+    """
+    Start a timed capture and stop it early after stop_after seconds, as a stop command does.
+
+    Returns:
+        dict: Seconds the stop took, seconds of audio written per device, and whether the capture stopped early
+    """
+    storage_path = tempfile.mkdtemp(prefix="pac_early_stop_")
+    try:
+        manager = build_manager(devices, rate, 1, PERIOD_SIZE, storage_path, {}, mode)
+        start_time = time.time() + 0.5
+        manager.start(duration, start_time)
+        time.sleep(max(0.0, start_time + stop_after - time.time()))
+        stop_start = time.monotonic()
+        manager.stop(early=True)
+        stop_seconds = time.monotonic() - stop_start
+        if mode == "process":
+            bytes_written = sum(report["bytes_written"] for report in manager.writer_reports if report is not None)
+            manager.shutdown()
+        else:
+            bytes_written = sum(writer.bytes_written for writer in manager.writers if writer is not None)
+        seconds_written = bytes_written / (rate * SAMPLE_WIDTH * devices)
+        return {
+            "mode": mode,
+            "devices": devices,
+            "stop_seconds": stop_seconds,
+            "seconds_written": seconds_written,
+            # Stopped within a second of the request, with what was recorded up to it written
+            "stopped_early": stop_seconds < 1.0 and stop_after * 0.5 < seconds_written < stop_after + 1.0,
+        }
+    finally:
+        shutil.rmtree(storage_path, ignore_errors=True)
+
+
+def print_results(results: list[dict]):
+    header = f"{'mode':>7} {'devices':>7} {'rate':>7} {'MB/s':>7} {'need':>7} {'complete':>8} {'overruns':>8} {'dropped':>7} {'ring hwm':>8} {'cpu/dev %':>9} {'p99 ms':>7} {'rss MB':>7}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['mode']:>7} {r['devices']:>7} {r['rate']:>7} {r['throughput_mb_s']:>7.2f} {r['required_mb_s']:>7.2f} "
+              f"{str(r['complete']):>8} {r['overruns']:>8} {r['dropped_periods']:>7} {r['ring_high_water_mark']:>8} "
+              f"{r['cpu_percent_per_device']:>9.1f} {r['write_latency_p99_ms']:>7.1f} {r['peak_rss_mb']:>7.1f}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the capture pipeline with simulated devices")
+    parser.add_argument("--devices", type=int, nargs="+", default=[1, 2, 4], help="Device counts to benchmark")
+    parser.add_argument("--modes", nargs="+", default=["thread"], choices=["thread", "process"],
+                        help="Capture modes to benchmark")
+    parser.add_argument("--rates", type=int, nargs="+", default=[256000], help="Sample rates to benchmark")
+    parser.add_argument("--duration", type=float, default=10.0, help="Capture duration per run in seconds")
+    parser.add_argument("--channels", type=int, default=1, help="Channels per device")
+    parser.add_argument("--period-size", type=int, default=PERIOD_SIZE, help="Frames per period")
+    parser.add_argument("--storage-path", default=None, help="Directory to write to (default: a temporary directory)")
+    parser.add_argument("--overrun-every", type=int, default=None, help="Inject an overrun every N periods")
+    parser.add_argument("--stall-every", type=int, default=None, help="Stall a read every N periods")
+    parser.add_argument("--stall-duration", type=float, default=0.05, help="Duration of an injected stall in seconds")
+    parser.add_argument("--json", default=None, help="Also write the results to this JSON file")
+    parser.add_argument("--fail-on-loss", action="store_true", help="Exit with 1 if any run lost data")
+    parser.add_argument("--check-early-stop", action="store_true",
+                        help="Only check that a timed capture stops early when stopped, for every mode")
+    parser.add_argument("--stop-after", type=float, default=1.0, help="Seconds into the capture to stop it with --check-early-stop")
+    args = parser.parse_args(argv)
+
+    if args.check_early_stop:
+        failed = False
+        for mode in args.modes:
+            check = run_early_stop_check(args.devices[0], args.rates[0], args.duration, args.stop_after, mode)
+            print(f"{mode}: stop took {check['stop_seconds']:.2f} s, {check['seconds_written']:.2f} s of "
+                  f"{args.duration:.0f} s written: {'ok' if check['stopped_early'] else 'failed'}")
+            failed = failed or not check["stopped_early"]
+        return 1 if failed else 0
+
+    fake_options = {"overrun_every": args.overrun_every, "stall_every": args.stall_every,
+                    "stall_duration": args.stall_duration}
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for mode in args.modes:
+        for rate in args.rates:
+            for devices in args.devices:
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    result = executor.submit(run_benchmark, devices, rate, args.duration, args.channels,
+                                             args.period_size, args.storage_path, fake_options, mode).result()
+                results.append(result)
+
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    lost = any(not r["complete"] or r["overruns"] or r["dropped_periods"] for r in results)
+    return 1 if args.fail_on_loss and lost else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
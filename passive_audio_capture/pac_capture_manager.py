@@ -1,11 +1,17 @@
-import queue
 import threading
 import time
 import os
 from datetime import datetime
-from audio_capture import AudioCapture
-import soundfile as sf
-import numpy as np
+from functools import partial
+from audio_capture import AudioCapture, SAMPLE_RATE, CHANNELS, SAMPLE_WIDTH, PERIOD_SIZE
+from pac_ring_buffer import RingBuffer
+from pac_stream_writer import StreamWriter
+from pac_device_pool import DevicePool
+from pac_file_index import RecordingIndex
+from pac_metrics import CaptureMetrics
+from pac_pcm_stream import PcmStream, PCM_CHANNEL
+from pac_spectral_summary import SpectralSummary
+from pac_trigger import TriggeredWriter, event_path
 
 
 # Define hardware devices for ultrasound capture
@@ -15,57 +21,226 @@ DEVICES = ["hw:CARD=Ultrasound,DEV=0", "hw:CARD=Ultrasound_1,DEV=0"] # , "hw:CAR
 # Path where captured audio data will be stored
 LOCAL_STORAGE_PATH = "/home/plense/passive_sensor_data/fetch_test"
 
+# Number of ALSA periods buffered per device between capture and dump thread
+# 1024 periods of 4096 frames = 8 MB or ~16 s of audio per device at 256kHz
+RING_BUFFER_PERIODS = 1024
+
+# Final stretch before the start time that is busy-waited instead of slept, in seconds
+START_SPIN_WINDOW = 0.005
+
+# Write a spectral summary sidecar next to every recording
+SPECTRAL_SUMMARIES = True
+
+
+def recording_path(storage_path: str, start_time: float, sample_rate: int, device_index: int, first_frame: int = 0) -> str:
+    """
+    Returns:
+        str: Path of a recording (or segment), named after the time of its first sample
+    """
+    timestamp_ymd_hm = datetime.fromtimestamp(start_time + first_frame / sample_rate).strftime("%Y_%m_%d_%H_%M_%S")
+    return os.path.join(storage_path, f"PZOrec_{timestamp_ymd_hm}_Udev{device_index}.wav")
+
+
+def spectral_summary_factory(sample_rate: int, channels: int):
+    """
+    Returns:
+        callable: Analyzer factory for a StreamWriter, None if spectral summaries are disabled
+    """
+    if not SPECTRAL_SUMMARIES:
+        return None
+    return partial(SpectralSummary, sample_rate=sample_rate, channels=channels)
+
+
+def build_file_metadata(device: str, device_index: int, sample_rate: int, start_time: float, first_frame: int, frames: int,
+                        first_sample_time: float, timestamp_source: str, overruns: int, dropped_periods: int,
+                        clock_sync: dict = None) -> dict:
+    """
+    Builds the alignment metadata stored in the header of a recorded file.
+
+    Args:
+        device (str): Device identifier
+        device_index (int): Index of the device
+        sample_rate (int): Sample rate in Hz
+        start_time (float): Scheduled start time of the capture
+        first_frame (int): Index of the first frame of the file within the capture
+        frames (int): Number of frames in the file
+        first_sample_time (float): Time of the first sample of the capture, None if unknown
+        timestamp_source (str): How first_sample_time was determined
+        overruns (int): Device overruns during the capture
+        dropped_periods (int): Periods dropped by the ring buffer during the capture
+        clock_sync (dict, optional): offset (clock of the pi minus that of the controller) and its
+                                     uncertainty in seconds, as estimated by the controller
+
+    Returns:
+        dict: Scheduled start, time of the first sample and the offset between both
+    """
+    metadata = {
+        "device": device,
+        "device_index": device_index,
+        "sample_rate": sample_rate,
+        "first_frame": first_frame,
+        "frames": frames,
+        "scheduled_start_time": start_time,
+        "first_sample_time": None,
+        "alignment_offset": None,
+        "alignment_offset_frames": None,
+        "timestamp_source": None,
+        "overruns": overruns,
+        "dropped_periods": dropped_periods,
+        # Controller time of a sample is its time here minus clock_offset, to within clock_uncertainty
+        "clock_offset": (clock_sync or {}).get("offset"),
+        "clock_uncertainty": (clock_sync or {}).get("uncertainty"),
+    }
+    if first_sample_time is not None:
+        alignment_offset = first_sample_time - start_time
+        metadata.update({
+            "first_sample_time": first_sample_time + first_frame / sample_rate,
+            "alignment_offset": alignment_offset,
+            "alignment_offset_frames": round(alignment_offset * sample_rate),
+            "timestamp_source": timestamp_source,
+        })
+    return metadata
+
+
+def format_status(device_index: int, status: dict) -> str:
+    """
+    Returns:
+        str: One line with the counters of a device, as printed by the status updates
+    """
+    since_last_period = status["since_last_period"]
+    return (f"Status Udev{device_index}: {status['frames_read']} frames read, {status['bytes_written']/1024/1024:.1f} MB written, "
+            f"{status['bytes_dropped']} bytes dropped, "
+            f"{status['overruns']} overruns, queue {status['queue']}/{status['queue_slots']} "
+            f"(high-water {status['queue_high_water']}, {status['dropped_periods']} dropped), "
+            f"last period {'-' if since_last_period is None else f'{since_last_period*1000:.0f} ms'} ago, "
+            f"write p99 {status['write_p99_ms']:.1f} ms, max {status['write_max_ms']:.1f} ms")
+
 
 class CaptureManager:
     """
     Manages multiple audio capture devices, handling concurrent recording and data storage.
     
-    This class coordinates the capture of audio data from multiple ultrasound devices,
-    manages temporary storage of raw data, and converts it to WAV format upon completion.
+    This class coordinates the capture of audio data from multiple ultrasound devices
+    and streams the data of every device directly into its own WAV file.
+    Captured periods are handed from the capture threads to the dump threads through
+    one preallocated ring buffer per device, so memory use is bounded.
+
+    In continuous mode (no runtime) the devices keep streaming until `stop` is called and
+    the output of every device is split into gapless segments of a fixed length.
+
+    In triggered mode only the audio around detected events is written, one file per event.
+
+    With a stream server, the audio of every device is also streamed live to the controllers
+    subscribed to its pcm channel; without storing, it is only streamed.
     
     Attributes:
-        runtime (float): Duration of capture in seconds (default: 15.0)
+        runtime (float): Duration of capture in seconds (default: 15.0), None for continuous capture
     """
     
-    def __init__(self, runtime=15.0):
+    def __init__(self, runtime=15.0, device_pool: DevicePool = None, storage_path: str = LOCAL_STORAGE_PATH,
+                 sample_rate: int = SAMPLE_RATE, channels: int = CHANNELS, period_size: int = PERIOD_SIZE,
+                 file_index: RecordingIndex = None, stream_server=None):
         """
         Initialize the capture manager with specified runtime.
         
         Args:
             runtime (float): Duration of capture in seconds (default: 15.0)
+            device_pool (DevicePool, optional): Pool of open devices to capture from. Without
+                                                a pool every run opens its devices itself.
+            storage_path (str): Directory the recordings are written to
+            sample_rate (int): Sample rate of the devices in Hz (default: 256000)
+            channels (int): Channels per device (default: 1)
+            period_size (int): Frames per ALSA period (default: 4096)
+            file_index (RecordingIndex, optional): Index the writers add every finished file to
+            stream_server (CommandServer, optional): Server to publish the live audio of every device on
         """
-        self.number_of_devices = len(DEVICES)
+        self.settings = dict(device_pool=device_pool, storage_path=storage_path,
+                             sample_rate=sample_rate, channels=channels, period_size=period_size,
+                             file_index=file_index, stream_server=stream_server)
+        self.device_pool = device_pool
+        self.storage_path = storage_path
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.period_size = period_size
+        self.file_index = file_index
+        self.stream_server = stream_server
+        self.devices = device_pool.devices if device_pool is not None else DEVICES
+        self.number_of_devices = len(self.devices)
 
-        self.startup_sync_barrier = threading.Barrier(len(DEVICES)+1)
+        # Built in start() for the devices that are actually available
+        self.startup_sync_barrier = None
+        self.captures: list[AudioCapture] = [None] * len(self.devices)
+        self.active_devices: list[int] = []
         
-        self.queues = [queue.Queue() for _ in DEVICES]
-        self.fetch_threads = [threading.Thread(target=self.capture, args=(i,)) for i in range(len(DEVICES))]
+        self.ring_buffers = [RingBuffer(RING_BUFFER_PERIODS, period_size * channels * SAMPLE_WIDTH) for _ in self.devices]
+        self.metrics = [CaptureMetrics() for _ in self.devices]
+        self.fetch_threads = [threading.Thread(target=self.capture, args=(i,)) for i in range(len(self.devices))]
+        self.capture_done = [threading.Event() for _ in self.devices]
 
-        self.dump_threads = [threading.Thread(target=self.fetch_dump_data, args=(i,)) for i in range(len(DEVICES))]
+        self.dump_threads = [threading.Thread(target=self.fetch_dump_data, args=(i,)) for i in range(len(self.devices))]
+        self.writers: list[StreamWriter] = [None] * len(self.devices)
+        self.recorded_files: list[str] = []
         self.status_update_thread = threading.Thread(target=self.status_update)
 
         self.running = False
         self.runtime = runtime
+        self.start_time = None
+        # Unix time the last start had all devices armed and only waited for the start time
+        self.armed_at = None
+        self.clock_sync = None
+        self.stop_event = threading.Event()
+        self.status_stop_event = threading.Event()
+
+        self.segment_seconds = None
+        self.on_file_closed = None
+        self.triggered = False
+        self.store = True
 
         self.capture_complete = False
 
-        # create temp storage path
-        self.temp_raw_storage_path = os.path.join(LOCAL_STORAGE_PATH, "temp_raw")
-        os.makedirs(self.temp_raw_storage_path, exist_ok=True)
+        os.makedirs(self.storage_path, exist_ok=True)
 
     def reset(self):
         # how would we do this in modern python?
-        self.__init__()
+        self.__init__(**self.settings)
+
+    def acquire_device(self, device_index):
+        """
+        Returns the capture for a device: the armed one from the device pool if there is
+        one, a freshly opened one otherwise. None if the device is not available.
+        """
+        if self.device_pool is not None:
+            return self.device_pool.acquire(device_index)
+        try:
+            return AudioCapture(self.devices[device_index], rate=self.sample_rate, channels=self.channels,
+                                period_size=self.period_size)
+        except Exception as e:
+            print(f"Error opening device {self.devices[device_index]}: {e}")
+            return None
 
     def capture(self, device_index):
         """
         Captures audio data from a specific device.
         
         Args:
-            device_index (int): Index of the device in DEVICES list
+            device_index (int): Index of the device in the devices list
         """
-        capture = AudioCapture(DEVICES[device_index])
-        capture.capture(runtime=self.runtime, data_queue=self.queues[device_index], barrier=self.startup_sync_barrier)
+        capture = self.captures[device_index]
+        try:
+            capture.capture(runtime=self.runtime, barrier=self.startup_sync_barrier, ring_buffer=self.ring_buffers[device_index],
+                            stop_event=self.stop_event, metrics=self.metrics[device_index])
+        except Exception as e:
+            print(f"Error capturing from {self.devices[device_index]}: {e}")
+            if self.device_pool is not None:
+                self.device_pool.mark_failed(device_index, e)
+            return
+        finally:
+            # Let the dump thread flush the rest right away
+            self.capture_done[device_index].set()
+            self.ring_buffers[device_index].wake()
+
+        if self.device_pool is not None:
+            self.device_pool.release(device_index)
 
     def is_capture_complete(self):
         return self.capture_complete
@@ -73,135 +248,198 @@ class CaptureManager:
     def is_capture_running(self):
         return self.running
 
-    def start(self, runtime: int, start_time: int):
+    def get_recorded_files(self) -> list[str]:
+        """
+        Returns:
+            list[str]: Paths of the WAV files finished during the last capture
+        """
+        return list(self.recorded_files)
+
+    def _file_closed(self, path: str):
+        self.recorded_files.append(path)
+        if self.on_file_closed is not None:
+            self.on_file_closed(path)
+
+    def start(self, runtime: int, start_time: int, segment_seconds: int = None, on_file_closed=None, triggered: bool = False,
+              store: bool = True, clock_sync: dict = None):
         """
         Starts all capture and processing threads.
         Initializes data capture from all devices simultaneously.
+
+        Args:
+            runtime (float): Duration of capture in seconds, None to capture until `stop` is called
+            start_time (float): Unix timestamp at which all devices start capturing
+            segment_seconds (int, optional): Rotate the output files every segment_seconds seconds
+            on_file_closed (callable, optional): Called with the path of every finished WAV file
+            triggered (bool): Only write the audio around detected events; segment_seconds then
+                              is the maximum length of an event file
+            store (bool): Write the audio to the card; False only streams it (needs a stream server,
+                          not in triggered mode)
+            clock_sync (dict, optional): Clock offset to the controller and its uncertainty, stored in every file
         """
         self.runtime = runtime
         self.start_time = start_time
+        self.clock_sync = clock_sync
+        self.segment_seconds = segment_seconds
+        self.on_file_closed = on_file_closed
+        self.triggered = triggered
+        self.store = store
+        if not store and (self.stream_server is None or triggered):
+            raise ValueError("A capture that is not stored needs a stream server, and cannot be triggered")
         self.capture_complete = False
 
+        # Arm the devices before any thread starts, so no device is opened at the barrier
+        arm_start = time.monotonic()
+        self.captures = [self.acquire_device(i) for i in range(self.number_of_devices)]
+        self.active_devices = [i for i, capture in enumerate(self.captures) if capture is not None]
+        if not self.active_devices:
+            raise RuntimeError("No capture devices available")
+        self.startup_sync_barrier = threading.Barrier(len(self.active_devices)+1)
+
         self.running = True
-        for thread in self.fetch_threads:
-            thread.start()
-        for thread in self.dump_threads:
-            thread.start()
+        for i in self.active_devices:
+            self.fetch_threads[i].start()
+        for i in self.active_devices:
+            self.dump_threads[i].start()
         self.status_update_thread.start()
+        if self.device_pool is not None:
+            self.device_pool.arm_latency.record(time.monotonic() - arm_start)
 
-        # Wait until the start time
-        timer = threading.Timer(self.start_time - time.time(), self.startup_sync_barrier.wait)
-        timer.start()
-        timer.join()
+        # Wait until the start time and release all capture threads at once
+        self.armed_at = time.time()
+        self.wait_until(self.start_time)
+        self.startup_sync_barrier.wait()
         # logging.info(f"Capture started at {time.strftime('%H:%M:%S', time.localtime(time.time()))}")
 
-    def stop(self):
+    @staticmethod
+    def wait_until(timestamp: float):
         """
-        Stops all running threads and performs cleanup operations.
-        Converts raw data to WAV format before terminating.
+        Sleeps until shortly before the timestamp, then busy-waits the last few milliseconds,
+        so the start does not depend on when the sleeping thread happens to wake up.
+        """
+        while True:
+            remaining = timestamp - time.time()
+            if remaining <= 0:
+                return
+            if remaining > START_SPIN_WINDOW:
+                time.sleep(remaining - START_SPIN_WINDOW)
+
+    def stop(self, early: bool = False):
+        """
+        Stops all running threads. The WAV files are finalized by the dump threads,
+        so they are complete once this returns.
+
+        A capture with a runtime is not cut short unless early is set: the capture threads
+        stop by themselves after exactly runtime * rate frames. A continuous capture is
+        stopped right away.
+
+        Args:
+            early (bool): Also stop a capture with a runtime right away, e.g. on a stop command
         """
         self.running = False
-        for thread in self.fetch_threads:
-            thread.join()
-        for thread in self.dump_threads:
-            thread.join()
-        self.status_update_thread.join()
+        self.status_stop_event.set()
+        if self.runtime is None or early:
+            self.stop_event.set()
+        for i in self.active_devices:
+            self.fetch_threads[i].join()
+        for i in self.active_devices:
+            self.dump_threads[i].join()
+        if self.status_update_thread.ident is not None:
+            self.status_update_thread.join()
+
+        for device_index, ring_buffer in enumerate(self.ring_buffers):
+            stats = ring_buffer.stats()
+            print(f"Udev{device_index}: ring buffer high-water mark {stats['high_water_mark']}/{stats['slots']} periods, {stats['dropped_periods']} periods dropped")
+            if self.writers[device_index] is not None:
+                print(f"Udev{device_index}: {self.writers[device_index].latency_report()}")
 
-        self.cleanup_raw_to_wav()
         self.capture_complete = True
 
     def fetch_dump_data(self, device_index):
         """
-        Continuously fetches data from device queue and writes to temporary storage.
+        Writes data from the device ring buffer to its WAV file in large batches.
+        Keeps draining until the capture thread finished and the ring buffer is empty.
         
         Args:
-            device_index (int): Index of the device queue to monitor
+            device_index (int): Index of the device ring buffer to monitor
         """
-        while self.running:
-            q = self.queues[device_index]
-            try:
-                # Attempt to get data from queue with minimal timeout
-                data = q.get(timeout=0.0001)
-                try:
-                    # Write binary data to temporary raw file
-                    with open(f"{self.temp_raw_storage_path}/test_Udev{device_index}.raw", "ab") as f:
-                        f.write(data)
-                except Exception as e:
-                    print(f"Error writing data to file: {e}")
-            except queue.Empty:
-                # Skip if no data available
-                pass
+        ring_buffer = self.ring_buffers[device_index]
+        capture_done = self.capture_done[device_index]
+
+        def wav_path(first_frame: int) -> str:
+            path_function = event_path if self.triggered else recording_path
+            return path_function(self.storage_path, self.start_time, self.sample_rate, device_index, first_frame)
+
+        stream = None
+        if self.stream_server is not None and not self.triggered:
+            capture = self.captures[device_index]
+            stream = PcmStream(device_index, self.sample_rate, self.channels, SAMPLE_WIDTH,
+                               publish=lambda chunk: self.stream_server.publish(chunk, PCM_CHANNEL),
+                               is_listening=lambda: self.stream_server.has_subscribers(PCM_CHANNEL),
+                               first_sample_time=lambda: capture.first_sample_time)
+
+        segment_frames = int(self.segment_seconds * self.sample_rate) if self.segment_seconds else None
+        writer_class = TriggeredWriter if self.triggered else partial(StreamWriter, stream=stream)
+        try:
+            if not self.store:
+                writer = stream
+            else:
+                writer = writer_class(wav_path, self.sample_rate, self.channels, SAMPLE_WIDTH,
+                                      segment_frames=segment_frames, on_file_closed=self._file_closed,
+                                      metadata_factory=lambda first_frame, frames: self.file_metadata(device_index, first_frame, frames),
+                                      analyzer_factory=spectral_summary_factory(self.sample_rate, self.channels),
+                                      file_index=self.file_index, metrics=self.metrics[device_index])
+        except OSError as e:
+            print(f"Error opening WAV file for Udev{device_index}: {e}")
+            return
+        self.writers[device_index] = writer
+        try:
+            writer.run(ring_buffer, lambda: not capture_done.is_set())
+        finally:
+            writer.close()
     
+    def file_metadata(self, device_index: int, first_frame: int, frames: int) -> dict:
+        """
+        Builds the alignment metadata stored in the header of a recorded file.
+
+        Args:
+            device_index (int): Index of the device
+            first_frame (int): Index of the first frame of the file within the capture
+            frames (int): Number of frames in the file
+
+        Returns:
+            dict: Scheduled start, time of the first sample and the offset between both
+        """
+        capture = self.captures[device_index]
+        return build_file_metadata(self.devices[device_index], device_index, self.sample_rate, self.start_time,
+                                   first_frame, frames, capture.first_sample_time, capture.timestamp_source,
+                                   capture.overruns, self.ring_buffers[device_index].dropped_periods, self.clock_sync)
+
+    def status(self) -> list[dict]:
+        """
+        Snapshot of the counters of every device; cheap enough to call at any rate.
+
+        Returns:
+            list[dict]: Per device its identifier, whether it is capturing, and its counters
+        """
+        return [dict(device=device, active=device_index in self.active_devices,
+                     **self.metrics[device_index].snapshot(self.ring_buffers[device_index]))
+                for device_index, device in enumerate(self.devices)]
+
     def status_update(self, interval = 5):
         """
-        Periodically reports storage status of captured data.
+        Periodically reports the counters of every capturing device.
         
         Args:
             interval (int): Time between status updates in seconds (default: 5)
         """
-        start_bytes, start_files = self.get_bytes_on_path(self.temp_raw_storage_path)
-        while self.running:
-            time.sleep(interval)
+        while not self.status_stop_event.wait(interval):
             try:
-                nbytes, nfiles = self.get_bytes_on_path(self.temp_raw_storage_path)
-                print(f"Status: {nfiles-start_files} files, {(nbytes-start_bytes)/1024:.1f} KB stored")
+                for device_index, status in enumerate(self.status()):
+                    if status["active"]:
+                        print(format_status(device_index, status))
             except Exception as e:
                 print(f"Error getting status: {e}")
-    
-    def get_bytes_on_path(self, PATH: str):
-        """
-        Calculates total storage usage for a given directory.
-        
-        Args:
-            PATH (str): Directory path to analyze
-            
-        Returns:
-            tuple: (total_bytes, number_of_files)
-        """
-        # Get list of files in storage directory
-        files = os.listdir(PATH)
-        total_bytes = 0
-
-        if len(files) > 1000:
-            return total_bytes, len(files)
-        else:
-            # Calculate total size
-            for file in files:
-                file_path = os.path.join(PATH, file)
-                total_bytes += os.path.getsize(file_path)
-            
-            return total_bytes, len(files)
-        
-    def cleanup_raw_to_wav(self):
-        """
-        Converts raw captured data to WAV format and performs cleanup.
-        
-        - Processes raw files for each device separately
-        - Creates timestamped WAV files
-        - Removes temporary raw files after conversion
-        - Attempts to remove temporary directory if empty
-        """
-
-        files_in_temp_storage = os.listdir(self.temp_raw_storage_path)
-        timestamp_ymd_hm = datetime.fromtimestamp(self.start_time).strftime("%Y_%m_%d_%H_%M_%S")
-        for device_index in range(self.number_of_devices):
-            device_files = [file for file in files_in_temp_storage if f"Udev{device_index}" in file]
-            data = []
-            for file in device_files:
-                with open(os.path.join(self.temp_raw_storage_path, file), "rb") as f:
-                    data.append(f.read())
-            data_int16 = np.concatenate([np.frombuffer(d, dtype=np.int16) for d in data])
-            # data = np.concatenate(data)
-
-            sf.write(os.path.join(LOCAL_STORAGE_PATH, f"PZOrec_{timestamp_ymd_hm}_Udev{device_index}.wav"), data_int16, 256000, subtype="PCM_16")
-
-            for file in device_files:
-                os.remove(os.path.join(self.temp_raw_storage_path, file))
-        
-        if len(os.listdir(self.temp_raw_storage_path)) == 0:
-            os.rmdir(self.temp_raw_storage_path)
-        else:
-            print(f"Warning: {len(os.listdir(self.temp_raw_storage_path))} files left in temp storage path, could not remove temp storage path")
 
 
 if __name__ == "__main__":
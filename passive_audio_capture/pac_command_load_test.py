@@ -0,0 +1,167 @@
+"""
+Command server load test.
+
+Stands in for any number of controllers: every client opens a connection and sends framed
+commands back to back, and the round trip of every command is recorded. Reports the
+throughput and latency percentiles as seen by the clients, e.g. to check that polling a
+node does not get slower while other controllers are connected:
+
+    python pac_command_load_test.py --host 192.168.0.225 --port 5001 --clients 32 --requests 100
+
+Only read-only commands are sent by default (CAPTURE_STATUS, IS_CAPTURE_COMPLETE), so it
+can run against a node that is recording. Without a node, --local serves the commands
+from a stand-in handler in this process, which measures the server itself:
+
+    python pac_command_load_test.py --local --clients 64 --requests 200 --handler-delay 0.002 --slow-clients 8
+
+--slow-clients adds connections that send half a message and then stall, which must not
+hold up the others.
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import threading
+import time
+
+from pac_command_server import CommandServer, encode_message, read_message
+from pac_metrics import LatencyHistogram
+
+
+DEFAULT_COMMANDS = ["CAPTURE_STATUS", "IS_CAPTURE_COMPLETE"]
+
+
+def stand_in_handler(delay: float, response_bytes: int):
+    """
+    Returns:
+        Callable[[str], str]: Handler that waits delay seconds (like a command touching the
+                              card) and answers with a response of response_bytes bytes
+    """
+    def handler(command: str) -> str:
+        if delay:
+            time.sleep(delay)
+        return f"OK#{command}#" + "x" * max(0, response_bytes - len(command) - 4)
+    return handler
+
+
+async def run_client(host: str, port: int, commands: list[str], requests: int, latency: LatencyHistogram,
+                     connect_per_request: bool) -> int:
+    """
+    Returns:
+        int: Number of commands answered
+    """
+    answered = 0
+    reader = writer = None
+    for i in range(requests):
+        started = time.perf_counter()
+        if writer is None:
+            reader, writer = await asyncio.open_connection(host, port)
+        writer.write(encode_message(commands[i % len(commands)]))
+        await writer.drain()
+        response = await read_message(reader)
+        latency.record(time.perf_counter() - started)
+        if response is None:
+            break
+        answered += 1
+        if connect_per_request:
+            writer.close()
+            await writer.wait_closed()
+            writer = None
+    if writer is not None:
+        writer.close()
+        await writer.wait_closed()
+    return answered
+
+
+async def run_slow_client(host: str, port: int, stop: asyncio.Event):
+    # Half a header, then nothing until the test is over
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(encode_message("CAPTURE_STATUS")[:2])
+    await writer.drain()
+    await stop.wait()
+    writer.close()
+
+
+async def run_load(host: str, port: int, clients: int, requests: int, commands: list[str], slow_clients: int = 0,
+                   connect_per_request: bool = False) -> dict:
+    latency = LatencyHistogram()
+    stop = asyncio.Event()
+    slow = [asyncio.create_task(run_slow_client(host, port, stop)) for _ in range(slow_clients)]
+    # Let the slow clients connect first
+    await asyncio.sleep(0.1 if slow_clients else 0)
+
+    started = time.perf_counter()
+    answered = await asyncio.gather(*[run_client(host, port, commands, requests, latency, connect_per_request)
+                                      for _ in range(clients)])
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    await asyncio.gather(*slow, return_exceptions=True)
+
+    summary = latency.summary()
+    return {
+        "clients": clients,
+        "slow_clients": slow_clients,
+        "requests": sum(answered),
+        "expected": clients * requests,
+        "elapsed_s": round(elapsed, 3),
+        "requests_per_s": round(sum(answered) / elapsed, 1) if elapsed else 0.0,
+        "mean_ms": round(summary["mean"] * 1000, 3),
+        "p50_ms": round(summary["p50"] * 1000, 3),
+        "p90_ms": round(summary["p90"] * 1000, 3),
+        "p99_ms": round(summary["p99"] * 1000, 3),
+        "max_ms": round(summary["max"] * 1000, 3),
+    }
+
+
+def print_result(result: dict):
+    print(f"{result['requests']}/{result['expected']} commands from {result['clients']} clients "
+          f"({result['slow_clients']} slow clients) in {result['elapsed_s']:.2f} s: {result['requests_per_s']:.0f}/s")
+    print(f"round trip: mean {result['mean_ms']:.2f} ms, p50 {result['p50_ms']:.2f} ms, p90 {result['p90_ms']:.2f} ms, "
+          f"p99 {result['p99_ms']:.2f} ms, max {result['max_ms']:.2f} ms")
+    if "server" in result:
+        server = result["server"]
+        print(f"server: {server['requests']} commands on {server['connections']} connections, "
+              f"p50 {server['p50_ms']:.2f} ms, p99 {server['p99_ms']:.2f} ms, max {server['max_ms']:.2f} ms")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Load test the command server with concurrent stand-in controllers")
+    parser.add_argument("--host", default="127.0.0.1", help="Host of the command server")
+    parser.add_argument("--port", type=int, default=5001, help="Port of the command server")
+    parser.add_argument("--local", action="store_true", help="Serve the commands from a stand-in handler in this process")
+    parser.add_argument("--clients", type=int, default=16, help="Concurrent connections")
+    parser.add_argument("--requests", type=int, default=100, help="Commands per connection")
+    parser.add_argument("--commands", nargs="+", default=DEFAULT_COMMANDS, help="Commands to send, in turn")
+    parser.add_argument("--slow-clients", type=int, default=0, help="Connections that stall halfway through a message")
+    parser.add_argument("--connect-per-request", action="store_true",
+                        help="Open a new connection per command, like the Windows controller does")
+    parser.add_argument("--handler-delay", type=float, default=0.0, help="Seconds the stand-in handler takes per command")
+    parser.add_argument("--response-bytes", type=int, default=1024, help="Size of the stand-in responses")
+    parser.add_argument("--json", default=None, help="Also write the result to this JSON file")
+    args = parser.parse_args(argv)
+
+    server = None
+    host, port = args.host, args.port
+    if args.local:
+        server = CommandServer(stand_in_handler(args.handler_delay, args.response_bytes), "127.0.0.1", 0)
+        threading.Thread(target=server.run, daemon=True).start()
+        server.ready.wait()
+        host, port = "127.0.0.1", server.port
+
+    result = asyncio.run(run_load(host, port, args.clients, args.requests, args.commands, args.slow_clients,
+                                  args.connect_per_request))
+    if server is not None:
+        result["server"] = server.stats()
+        server.stop()
+
+    print_result(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+    return 0 if result["requests"] == result["expected"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,341 @@
+import asyncio
+import logging
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Callable, Union
+from pac_metrics import LatencyHistogram
+
+
+COMMAND_SEPARATOR = '#'
+
+# Every message (command or response) is a 4-byte big-endian payload length followed by the UTF-8 payload
+MESSAGE_HEADER = struct.Struct("!I")
+
+# Larger messages are refused; a header this large means the peer does not frame its messages
+MAX_MESSAGE_BYTES = 16 * 1024 ** 2
+
+# Threads running the command handlers; handlers may touch the card or the index, so they never run on the event loop
+COMMAND_WORKERS = 4
+
+# Connections without a command for this long are closed, in seconds
+CLIENT_IDLE_TIMEOUT = 300.0
+
+# Command that turns a connection into a subscription: SUBSCRIBE[#<channel>]. The server
+# answers SUBSCRIBED and from then on pushes every message published on the channel, and
+# KEEPALIVE when there was none for a while
+SUBSCRIBE_COMMAND = "SUBSCRIBE"
+
+# Clock synchronisation: TIME_SYNC#<t1> is answered with TIME#<t1>#<t2>#<t3>, t2 and t3 being the
+# time here when the command was read and when the answer was sent (NTP style). It is answered on
+# the event loop itself, without the hop to a worker thread, to keep both close to the wire
+TIME_SYNC_COMMAND = "TIME_SYNC"
+
+# Seconds between keepalives on an idle subscription, so the client notices a dead node
+SUBSCRIBER_KEEPALIVE = 10.0
+
+# Channel name: (messages queued per subscriber, drop messages instead of disconnecting a subscriber that falls behind)
+# Events must not go missing unnoticed; live audio chunks are better dropped than delayed
+SUBSCRIPTION_CHANNELS = {
+    "events": (1000, False),
+    "pcm": (64, True),
+}
+
+
+class MessageError(Exception):
+    """
+    Raised when a peer sends something that is not a valid framed message.
+    """
+
+
+class FileResponse:
+    """
+    Response of a handler that sends (part of) a file: a framed header message, followed by
+    count raw bytes of the file, starting at offset. The server sends the bytes with
+    sendfile, so they go from the page cache to the socket without passing through Python,
+    and closes the file afterwards.
+    """
+
+    def __init__(self, header: str, file: BinaryIO, offset: int, count: int):
+        """
+        Args:
+            header (str): Message sent before the data; must tell the client the byte count
+            file (BinaryIO): File opened in binary mode
+            offset (int): Position of the first byte to send
+            count (int): Number of bytes to send
+        """
+        self.header = header
+        self.file = file
+        self.offset = offset
+        self.count = count
+
+
+def encode_message(text: Union[str, bytes]) -> bytes:
+    """
+    Args:
+        text (Union[str, bytes]): Command or response, or a binary message
+
+    Returns:
+        bytes: The framed message
+    """
+    payload = text.encode() if isinstance(text, str) else text
+    if len(payload) > MAX_MESSAGE_BYTES:
+        raise MessageError(f"Message of {len(payload)} bytes exceeds {MAX_MESSAGE_BYTES} bytes")
+    return MESSAGE_HEADER.pack(len(payload)) + payload
+
+
+async def read_message(reader: asyncio.StreamReader) -> str:
+    """
+    Read one framed message, however it was fragmented on the way.
+
+    Args:
+        reader (asyncio.StreamReader): Stream of the connection
+
+    Returns:
+        str: The message, None if the peer closed the connection between messages
+    """
+    try:
+        header = await reader.readexactly(MESSAGE_HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise MessageError("Connection closed within a message header")
+    (length,) = MESSAGE_HEADER.unpack(header)
+    if length > MAX_MESSAGE_BYTES:
+        raise MessageError(f"Message of {length} bytes exceeds {MAX_MESSAGE_BYTES} bytes")
+    try:
+        payload = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        raise MessageError("Connection closed within a message")
+    return payload.decode()
+
+
+class CommandServer:
+    """
+    Serves commands over TCP to any number of concurrent connections.
+
+    Connections are handled by an asyncio event loop, so a slow or idle client never holds
+    up another. Every command is handed to a small thread pool, so a handler that touches
+    the card (eviction, the index, a spectral sidecar) never blocks the event loop; the
+    capture has its own threads or processes and is not affected by either. A connection
+    can send any number of commands; each gets exactly one response, in order. A handler
+    can answer with a FileResponse to stream file data after the response.
+
+    A connection that sends SUBSCRIBE gets every event published from then on pushed to it,
+    so a controller learns within milliseconds that a capture finished or a file is ready,
+    instead of polling for it. SUBSCRIBE#pcm subscribes to the live audio chunks instead.
+    TIME_SYNC is answered right on the event loop, with the times the command was read and
+    answered, so a controller can estimate the offset between its clock and the clock here.
+
+    Attributes:
+        latency (LatencyHistogram): Time from a command being read to its response being sent
+    """
+
+    def __init__(self, handler: Callable[[str], Union[str, FileResponse]], host: str, port: int, workers: int = COMMAND_WORKERS,
+                 idle_timeout: float = CLIENT_IDLE_TIMEOUT):
+        """
+        Args:
+            handler (Callable[[str], Union[str, FileResponse]]): Called with every command, from a worker
+                                                                thread; returns the response
+            host (str): Interface to listen on
+            port (int): Port to listen on; 0 picks a free port
+            workers (int): Number of commands handled at the same time
+            idle_timeout (float): Seconds after which an idle connection is closed
+        """
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.idle_timeout = idle_timeout
+        self.logger = logging.getLogger(__name__)
+
+        self.latency = LatencyHistogram()
+        self.connections = 0
+        self.active_connections = 0
+        self.requests = 0
+        self.file_bytes_sent = 0
+        self._subscribers: dict[str, set[asyncio.Queue]] = {channel: set() for channel in SUBSCRIPTION_CHANNELS}
+        self.dropped_messages = 0
+
+        self.ready = threading.Event()
+        self._loop: asyncio.AbstractEventLoop = None
+        self._server: asyncio.AbstractServer = None
+        self._executor: ThreadPoolExecutor = None
+
+    def run(self):
+        """
+        Serve until stop() is called; blocks the calling thread.
+        """
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="pac_command")
+        try:
+            self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+            # Resolve port 0 to the port that was bound
+            self.port = self._server.sockets[0].getsockname()[1]
+            self.logger.info(f"[INFO] Server listening on {self.host}:{self.port}")
+            self.ready.set()
+            async with self._server:
+                await self._server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._executor.shutdown(wait=False)
+            self.logger.info(f"[INFO] Server closed after {self.requests} commands")
+
+    def stop(self):
+        """
+        Stop serving; safe to call from any thread.
+        """
+        if self._loop is not None and self._server is not None:
+            self._loop.call_soon_threadsafe(self._server.close)
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        addr = writer.get_extra_info("peername")
+        self.connections += 1
+        self.active_connections += 1
+        self.logger.info(f"[INFO] Connection with {addr} established")
+        try:
+            while True:
+                command = await asyncio.wait_for(read_message(reader), self.idle_timeout)
+                read_time = time.time()
+                if command is None:
+                    break
+                if command.split(COMMAND_SEPARATOR)[0] == TIME_SYNC_COMMAND:
+                    client_time = command.split(COMMAND_SEPARATOR)[1] if COMMAND_SEPARATOR in command else ""
+                    writer.write(encode_message(COMMAND_SEPARATOR.join(["TIME", client_time, f"{read_time:.6f}", f"{time.time():.6f}"])))
+                    await writer.drain()
+                    self.requests += 1
+                    continue
+                if command.split(COMMAND_SEPARATOR)[0] == SUBSCRIBE_COMMAND:
+                    channel = command.split(COMMAND_SEPARATOR)[1] if COMMAND_SEPARATOR in command else "events"
+                    if channel in SUBSCRIPTION_CHANNELS:
+                        await self._serve_subscriber(reader, writer, channel)
+                    else:
+                        writer.write(encode_message(f"Unknown channel {channel}"))
+                        await writer.drain()
+                    break
+                received = time.perf_counter()
+                response = await self._loop.run_in_executor(self._executor, self._handle_command, command)
+                if isinstance(response, FileResponse):
+                    # Only the header counts towards the command latency, not the transfer
+                    await self._send_file(writer, response, received)
+                else:
+                    writer.write(encode_message(response))
+                    await writer.drain()
+                    self.latency.record(time.perf_counter() - received)
+                self.requests += 1
+        except asyncio.TimeoutError:
+            self.logger.info(f"[INFO] Connection with {addr} idle for {self.idle_timeout:.0f} s")
+        except (MessageError, UnicodeDecodeError) as e:
+            self.logger.error(f"[ERROR] Invalid message from {addr}: {e}")
+        except ConnectionError as e:
+            self.logger.error(f"[ERROR] Connection with {addr} lost: {e}")
+        finally:
+            self.active_connections -= 1
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+            self.logger.info(f"[INFO] Connection with {addr} closed")
+
+    def has_subscribers(self, channel: str = "events") -> bool:
+        return bool(self._subscribers[channel])
+
+    def publish(self, message: Union[str, bytes], channel: str = "events"):
+        """
+        Push a message to every connection subscribed to the channel; safe to call from any
+        thread, and never blocks.
+
+        Args:
+            message (Union[str, bytes]): The event, or a binary message
+            channel (str): Channel to publish on
+        """
+        if self._loop is None or not self._subscribers[channel]:
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._publish, message, channel)
+        except RuntimeError:
+            # The event loop has already stopped
+            pass
+
+    def _publish(self, message: Union[str, bytes], channel: str):
+        drop = SUBSCRIPTION_CHANNELS[channel][1]
+        for queue in list(self._subscribers[channel]):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                if drop:
+                    self.dropped_messages += 1
+                    continue
+                # Too slow to keep up; make room for the end-of-subscription marker
+                self.logger.error(f"[ERROR] Subscriber fell {queue.qsize()} messages behind on {channel}, disconnecting")
+                self._subscribers[channel].discard(queue)
+                queue.get_nowait()
+                queue.put_nowait(None)
+
+    async def _serve_subscriber(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, channel: str):
+        queue = asyncio.Queue(SUBSCRIPTION_CHANNELS[channel][0])
+        self._subscribers[channel].add(queue)
+        # A subscriber sends nothing more, so the read only completes when it disconnects
+        closed = asyncio.ensure_future(reader.read(1))
+        try:
+            writer.write(encode_message("SUBSCRIBED"))
+            await writer.drain()
+            while True:
+                event = asyncio.ensure_future(queue.get())
+                done, _ = await asyncio.wait({event, closed}, timeout=SUBSCRIBER_KEEPALIVE,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if event not in done:
+                    event.cancel()
+                if closed in done:
+                    break
+                message = event.result() if event in done else "KEEPALIVE"
+                if message is None:
+                    break
+                writer.write(encode_message(message))
+                await writer.drain()
+        finally:
+            self._subscribers[channel].discard(queue)
+            closed.cancel()
+
+    async def _send_file(self, writer: asyncio.StreamWriter, response: FileResponse, received: float):
+        try:
+            writer.write(encode_message(response.header))
+            await writer.drain()
+            self.latency.record(time.perf_counter() - received)
+            if response.count:
+                # Zero-copy os.sendfile on a plain socket; falls back to reads in the executor otherwise
+                sent = await self._loop.sendfile(writer.transport, response.file, response.offset, response.count)
+                self.file_bytes_sent += sent
+        finally:
+            response.file.close()
+
+    def _handle_command(self, command: str) -> Union[str, FileResponse]:
+        try:
+            return self.handler(command)
+        except Exception as e:
+            self.logger.error(f"[ERROR] Error handling command: {e}, {command}")
+            return f"ERROR: {e}"
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: Connection and request counts, file data sent, and command latency percentiles in milliseconds
+        """
+        latency = self.latency.summary()
+        return {
+            "connections": self.connections,
+            "active_connections": self.active_connections,
+            "subscribers": {channel: len(queues) for channel, queues in self._subscribers.items()},
+            "dropped_messages": self.dropped_messages,
+            "requests": self.requests,
+            "file_mb_sent": round(self.file_bytes_sent / 1024 / 1024, 1),
+            "p50_ms": round(latency["p50"] * 1000, 2),
+            "p99_ms": round(latency["p99"] * 1000, 2),
+            "max_ms": round(latency["max"] * 1000, 2),
+        }
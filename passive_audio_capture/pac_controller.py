@@ -1,12 +1,21 @@
 from datetime import datetime
+import json
 import logging
 import threading
-import socket
 import time
 import os
-from pac_capture_manager import CaptureManager
-from pac_file_manager import FileManager
+from typing import Union
+from audio_capture import SAMPLE_WIDTH
+from pac_capture_manager import CaptureManager, DEVICES
+from pac_command_server import CommandServer, FileResponse
+from pac_device_pool import DevicePool
+from pac_process_capture import ProcessCaptureManager
+from pac_file_manager import FileManager, AUDIO_FILE_EXTENSIONS
 from pac_calibration_manager import CalibrationManager
+from pac_flac_encoder import FlacEncoder
+from pac_metrics import LatencyHistogram
+from pac_retention import RetentionManager
+from pac_spectral_summary import spectral_sidecar_path, summarize_sidecar, SPECTRAL_SIDECAR_SUFFIX
 import pac_logger as logger_
 
 TCP_HOST = '0.0.0.0'  # Listen on all interfaces
@@ -14,104 +23,231 @@ TCP_PORT = 5001       # Arbitrary port (can be changed)
 
 COMMAND_SEPARATOR = '#'
 
+# Commands that start or stop a capture; handled one at a time, whichever connection they come from
+CONTROL_COMMANDS = ("RESET", "START_RECORDING", "START_CONTINUOUS", "START_TRIGGERED", "START_STREAMING", "STOP_CONTINUOUS")
+
 # Path where captured audio data will be stored
 LOCAL_STORAGE_PATH = "/home/plense/passive_sensor_data/fetch_test"
 
+# Encode recordings to FLAC before they are listed for fetching
+FLAC_ENCODING = True
+
+# "thread": capture all devices from threads of this process
+# "process": capture every device in its own process, for more devices per Pi
+CAPTURE_MODE = "thread"
+
+# A continuous capture needs room for at least this many seconds of audio, checked every STORAGE_CHECK_INTERVAL
+STORAGE_HEADROOM_SECONDS = 600
+STORAGE_CHECK_INTERVAL = 10.0
+
+# Arming latency reported to PING before any start was measured: time from a start command
+# to all devices armed, in seconds
+DEFAULT_ARM_LATENCY = 1.0
+
+
+def parse_clock_sync(fields: list[str]) -> dict:
+    """
+    Args:
+        fields (list[str]): Optional trailing fields of a start command: the offset of this clock to
+                            the clock of the controller and its uncertainty, in seconds
+
+    Returns:
+        dict: offset and uncertainty, None if the controller did not send them
+    """
+    if len(fields) < 2:
+        return None
+    return {"offset": float(fields[0]), "uncertainty": float(fields[1])}
+
 
 class PACController:
     def __init__(self):
-        self.capture_manager: CaptureManager = CaptureManager()
+        # Serves the commands, and publishes the events and (in thread mode) the live audio
+        self.command_server: CommandServer = CommandServer(self.handle_command, TCP_HOST, TCP_PORT)
+        # The writers add every finished file to the index of the file manager
         self.file_manager: FileManager = FileManager(directory=LOCAL_STORAGE_PATH)
+        self.retention: RetentionManager = RetentionManager(LOCAL_STORAGE_PATH, self.file_manager.file_index)
+        # Devices are opened once and re-armed between runs
+        if CAPTURE_MODE == "process":
+            # The capture processes keep their own devices open
+            self.device_pool: DevicePool = None
+            self.capture_manager: ProcessCaptureManager = ProcessCaptureManager(index_path=self.file_manager.file_index.path)
+        else:
+            self.device_pool: DevicePool = DevicePool(DEVICES)
+            self.capture_manager: CaptureManager = CaptureManager(device_pool=self.device_pool, file_index=self.file_manager.file_index,
+                                                                  stream_server=self.command_server)
         self.calibration_manager: CalibrationManager = CalibrationManager()
+        self.flac_encoder: FlacEncoder = FlacEncoder() if FLAC_ENCODING else None
+
+        # True from a start command until the files of the run are listed; set under the control
+        # lock before the recording thread starts, so a second start is refused even while the
+        # devices of the first are still being armed
+        self.run_in_progress = False
+        # Set by STOP_CONTINUOUS; the recording thread of the run stops the capture and publishes
+        # capture_complete, so a run is only ever completed once
+        self.stop_requested = threading.Event()
+        self.recording_thread: threading.Thread = None
+        self.control_lock = threading.Lock()
+        # Time from a start command being received to all devices armed, reported to PING so the
+        # controller can schedule runs with just enough lead time
+        self.arm_latency = LatencyHistogram()
 
         logger_.configure_logging()
         self.logger = logging.getLogger(__name__)
         self.logger.info("Building controller...")
 
     def start_tcp_server(self):
+        """
+        Serve commands until the process is stopped. Every controller connection is served
+        concurrently; see CommandServer.
+        """
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.bind((TCP_HOST, TCP_PORT))
-                s.listen()
-                self.logger.info(f"[INFO] Server listening on {TCP_HOST}:{TCP_PORT}")
-                while True:
-                    conn, addr = s.accept()
-                    self.handle_client(conn, addr)
+            self.command_server.run()
         except Exception as e:
             self.logger.error(f"[ERROR] Error starting server: {e}")
-        # finally:
-        #     s.close()
-        #     self.logger.info(f"[INFO] Server closed")
 
-    def handle_client(self, conn, addr):
-        self.logger.info(f"[INFO] Connection with {addr} established")
-        try:
-            with conn:
-                while True:
-                    data = conn.recv(1024).decode()
-
-                    if not data:
-                        break
-                    self.logger.info(f"[RECV] Received: {data}")
-
-                    # Callback: respond based on the command
-                    if data == "IS_CAPTURE_COMPLETE":
-                        response = "CAPTURE_COMPLETE" if self.capture_manager.is_capture_complete() else "False"
-                        self.logger.info(f"[INFO] request for capture complete: {response}")
-                    elif data == "START_CALIBRATION":
-                        pass
-                        # response = self.calibration_manager.start_calibration()
-                    elif data == "IS_CALIBRATION_COMPLETE":
-                        pass
-                        # response = self.calibration_manager.is_calibration_complete()
-                    elif data == "LIST_AUDIO_FILES":
-                        files = self.file_manager.return_new_files()
-                        response = f"FILES{COMMAND_SEPARATOR}{len(files)}"
-                        for file in files:
-                            response += f"{COMMAND_SEPARATOR}{file}"
-                    elif data == "FETCH_AUDIO_FILE":
-                        pass
-                    elif data == "RESET":
-                        self.capture_manager.reset()
-                        self.file_manager.reset()
-                        response = "RESET"
-                    elif data.startswith("START_RECORDING"):
-                        if self.capture_manager.is_capture_running():
-                            response = "Capture already running"
-                        else:
-                            # Parse the command
-                            _, record_time_fstr, start_time_fstr = data.split(COMMAND_SEPARATOR)
-                            current_time = time.time()
-                            record_time = float(record_time_fstr)
-                            start_time = float(start_time_fstr)
-                            self.recording_thread = threading.Thread(target=self.CMD_start_recording, args=(record_time, start_time))
-                            self.recording_thread.start()
-                            response = f"REC_START{COMMAND_SEPARATOR}{datetime.fromtimestamp(start_time).strftime('%Y-%m-%d_%H-%M-%S')}{COMMAND_SEPARATOR}{start_time - current_time:.1f}"
-                    else:
-                        response = "Unknown command"
-                        self.logger.info(f"[CONF] Unknown Content in command: {data}")
-
-                    conn.sendall(response.encode())
-        except Exception as e:
-            self.logger.error(f"[ERROR] Error handling client: {e}, {data}")
-        finally:
-            conn.close()
-            self.logger.info(f"[INFO] Connection with {addr} closed")
+    def handle_command(self, data: str) -> Union[str, FileResponse]:
+        """
+        Handle a single command. Runs on a worker thread of the command server, so commands
+        of different connections can be handled at the same time; commands that start or stop
+        a capture are serialised by the control lock.
+
+        Args:
+            data (str): The command, fields separated by COMMAND_SEPARATOR
+
+        Returns:
+            Union[str, FileResponse]: The response, or for FETCH_AUDIO_FILE the response followed by file data
+        """
+        self.logger.info(f"[RECV] Received: {data}")
+        if data.startswith(CONTROL_COMMANDS):
+            with self.control_lock:
+                return self._dispatch_command(data)
+        return self._dispatch_command(data)
 
-    def CMD_start_recording(self, record_time, start_time):
+    def _dispatch_command(self, data: str) -> Union[str, FileResponse]:
+        if data == "PING":
+            response = self.CMD_ping()
+        elif data == "IS_CAPTURE_COMPLETE":
+            capture_complete = self.capture_manager.is_capture_complete() and not self.run_in_progress
+            response = "CAPTURE_COMPLETE" if capture_complete else "False"
+            self.logger.info(f"[INFO] request for capture complete: {response}")
+        elif data == "CAPTURE_STATUS":
+            response = self.CMD_capture_status()
+        elif data == "START_CALIBRATION":
+            pass
+            # response = self.calibration_manager.start_calibration()
+        elif data == "IS_CALIBRATION_COMPLETE":
+            pass
+            # response = self.calibration_manager.is_calibration_complete()
+        elif data == "LIST_AUDIO_FILES":
+            files = self.file_manager.return_new_files()
+            response = f"FILES{COMMAND_SEPARATOR}{len(files)}"
+            for file in files:
+                response += f"{COMMAND_SEPARATOR}{file}"
+        elif data.startswith("FETCH_AUDIO_FILE"):
+            # FETCH_AUDIO_FILE#<file>[#<offset>[#<length>]]: the file data follows the response
+            _, filename, *byte_range = data.split(COMMAND_SEPARATOR)
+            offset, length = (int(value) for value in (byte_range + ["0", "0"])[:2])
+            response = self.CMD_fetch_audio_file(filename, offset, length)
+        elif data.startswith("FILE_INFO"):
+            # FILE_INFO#<file>: size and checksum, to check a local copy without fetching it
+            _, filename = data.split(COMMAND_SEPARATOR)
+            response = self.CMD_file_info(filename)
+        elif data.startswith("MARK_FETCHED"):
+            # MARK_FETCHED#<file>#<file>...: fetched files that were kept are evicted first
+            filenames = data.split(COMMAND_SEPARATOR)[1:]
+            marked = self.file_manager.file_index.mark_fetched(filenames)
+            response = f"MARKED{COMMAND_SEPARATOR}{marked}"
+        elif data.startswith("SPECTRAL_SUMMARY"):
+            _, filename = data.split(COMMAND_SEPARATOR)
+            response = self.CMD_spectral_summary(filename)
+        elif data == "RESET":
+            # The recording thread of a run still uses what a reset tears down
+            if self.run_in_progress:
+                response = "Capture already running"
+            else:
+                self.capture_manager.reset()
+                self.file_manager.reset()
+                response = "RESET"
+        elif data.startswith("START_RECORDING"):
+            if self.run_in_progress:
+                response = "Capture already running"
+            else:
+                # Parse the command
+                # START_RECORDING#<runtime>#<start time>[#<clock offset>#<uncertainty>]
+                _, record_time_fstr, start_time_fstr, *clock_fields = data.split(COMMAND_SEPARATOR)
+                current_time = time.time()
+                record_time = float(record_time_fstr)
+                start_time = float(start_time_fstr)
+                if not self.retention.ensure_space(self.capture_bytes(record_time)):
+                    response = "Not enough storage"
+                else:
+                    self.run_in_progress = True
+                    self.stop_requested.clear()
+                    self.recording_thread = threading.Thread(target=self.CMD_start_recording, args=(record_time, start_time, current_time,
+                                                                                                     parse_clock_sync(clock_fields)))
+                    self.recording_thread.start()
+                    response = f"REC_START{COMMAND_SEPARATOR}{datetime.fromtimestamp(start_time).strftime('%Y-%m-%d_%H-%M-%S')}{COMMAND_SEPARATOR}{start_time - current_time:.1f}"
+        elif data.startswith(("START_CONTINUOUS", "START_TRIGGERED", "START_STREAMING")):
+            if self.run_in_progress:
+                response = "Capture already running"
+            else:
+                # START_TRIGGERED takes the maximum event length instead of the segment length
+                # START_STREAMING only streams the audio to subscribers of the pcm channel, nothing is stored
+                command, segment_time_fstr, start_time_fstr, *clock_fields = data.split(COMMAND_SEPARATOR)
+                current_time = time.time()
+                segment_time = int(float(segment_time_fstr))
+                start_time = float(start_time_fstr)
+                triggered = command == "START_TRIGGERED"
+                store = command != "START_STREAMING"
+                if not store and not isinstance(self.capture_manager, CaptureManager):
+                    response = "Streaming only available in thread mode"
+                elif store and not self.retention.ensure_space(self.capture_bytes(STORAGE_HEADROOM_SECONDS)):
+                    response = "Not enough storage"
+                else:
+                    self.run_in_progress = True
+                    self.stop_requested.clear()
+                    self.recording_thread = threading.Thread(target=self.CMD_start_continuous, args=(segment_time, start_time, triggered, store, current_time,
+                                                                                                      parse_clock_sync(clock_fields)))
+                    self.recording_thread.start()
+                    response = f"REC_START{COMMAND_SEPARATOR}{datetime.fromtimestamp(start_time).strftime('%Y-%m-%d_%H-%M-%S')}{COMMAND_SEPARATOR}{start_time - current_time:.1f}"
+        elif data == "STOP_CONTINUOUS":
+            # Also ends a timed run early
+            if self.run_in_progress and not self.stop_requested.is_set():
+                self.stop_requested.set()
+                response = "REC_STOP"
+            else:
+                response = "Capture not running"
+        else:
+            response = "Unknown command"
+            self.logger.info(f"[CONF] Unknown Content in command: {data}")
+
+        return response
+
+    def CMD_start_recording(self, record_time, start_time, received_time=None, clock_sync=None):
         self.logger.info(f"[INFO] Starting recording for {record_time} seconds at {start_time}")
         self.file_manager.update_files()
 
         cleanup = False
         try:
             self.capture_manager.reset()
-            self.capture_manager.start(record_time, start_time)
+            self.capture_manager.start(record_time, start_time, clock_sync=clock_sync)
+            self.record_arm_latency(received_time, start_time)
 
-            time.sleep(record_time)
-            self.logger.info(f"[INFO] Stopping recording")
+            early = self.stop_requested.wait(record_time)
+            if early:
+                self.logger.info(f"[INFO] Stop requested, stopping recording early")
+            else:
+                self.logger.info(f"[INFO] Stopping recording")
 
-            self.capture_manager.stop()
+            self.capture_manager.stop(early=early)
+            if self.device_pool is not None:
+                self.logger.info(f"[INFO] Device pool: {self.device_pool.latency_report()}")
+            if self.flac_encoder is not None:
+                for result in self.flac_encoder.encode_files(self.capture_manager.get_recorded_files()):
+                    self.file_manager.file_encoded(result)
             self.file_manager.update_new_files()
+            for filename in self.file_manager.return_new_files():
+                self.publish_file_ready(filename)
             cleanup = True
         except Exception as e:
             self.logger.error(f"[ERROR] Error during recording: {e}")
@@ -120,11 +256,246 @@ class PACController:
             if not cleanup:
                 self.capture_manager.stop()
 
-            # Delete old files after new recording is complete
-            self.file_manager.delete_old_files(hours=3.0) # leave in for now, log if used
+            # Evict old recordings only if the card is running full
+            self.retention.enforce()
             self.file_manager.update_files()
+            self.run_in_progress = False
+            self.publish_event("capture_complete")
+
+
+    def CMD_start_continuous(self, segment_time, start_time, triggered=False, store=True, received_time=None, clock_sync=None):
+        if triggered:
+            self.logger.info(f"[INFO] Starting triggered recording with events of at most {segment_time} seconds at {start_time}")
+        elif not store:
+            self.logger.info(f"[INFO] Starting streaming without recording at {start_time}")
+        else:
+            self.logger.info(f"[INFO] Starting continuous recording in segments of {segment_time} seconds at {start_time}")
+        self.file_manager.update_files()
+        try:
+            self.capture_manager.reset()
+            if store:
+                self.capture_manager.start(None, start_time, segment_seconds=segment_time, on_file_closed=self.on_recording_closed,
+                                           triggered=triggered, clock_sync=clock_sync)
+            else:
+                self.capture_manager.start(None, start_time, store=False, clock_sync=clock_sync)
+            self.record_arm_latency(received_time, start_time)
+        except Exception as e:
+            self.logger.error(f"[ERROR] Error starting continuous recording: {e}")
+            self.CMD_stop_continuous()
+            return
+
+        # Keep room for the next minutes of audio; stop cleanly rather than fill the card
+        while not self.stop_requested.wait(STORAGE_CHECK_INTERVAL) and self.capture_manager.is_capture_running():
+            if store and not self.retention.ensure_space(self.capture_bytes(STORAGE_HEADROOM_SECONDS)):
+                self.logger.error(f"[ERROR] Storage exhausted, stopping continuous recording")
+                break
+        self.CMD_stop_continuous()
+
+    def CMD_stop_continuous(self):
+        """
+        Stops a continuous capture and completes its run. Only called from the recording thread
+        of the run; STOP_CONTINUOUS sets stop_requested instead.
+        """
+        self.logger.info(f"[INFO] Stopping continuous recording")
+        try:
+            self.capture_manager.stop()
+        except Exception as e:
+            self.logger.error(f"[ERROR] Error stopping continuous recording: {e}")
+        finally:
+            self.run_in_progress = False
+            self.publish_event("capture_complete")
+
+    def CMD_ping(self) -> str:
+        """
+        Answers right away, so the controller can measure the round trip, with the clock of
+        the pi and the time it takes to arm all devices after a start command.
+
+        Returns:
+            str: "PONG#<unix time>#<arm latency in seconds>"
+        """
+        arm_latency = self.arm_latency.percentile(99) if self.arm_latency.count else DEFAULT_ARM_LATENCY
+        return f"PONG{COMMAND_SEPARATOR}{time.time():.6f}{COMMAND_SEPARATOR}{arm_latency:.3f}"
+
+    def record_arm_latency(self, received_time: float, start_time: float):
+        """
+        Record how long the last start took from receiving its command to all devices armed,
+        and warn if the devices were armed after the start time, i.e. the capture started late.
+        """
+        armed_at = self.capture_manager.armed_at
+        if received_time is None or armed_at is None:
+            return
+        self.arm_latency.record(armed_at - received_time)
+        if armed_at > start_time:
+            self.logger.error(f"[ERROR] Devices armed {(armed_at - start_time)*1000:.0f} ms after the start time")
+
+    def CMD_capture_status(self) -> str:
+        """
+        Snapshot of the running capture, built from counters kept on the hot path, so it can
+        be polled while recording without touching the card.
+
+        The devices are sent as a table: "fields" names the columns, "devices" holds one
+        row per device, which keeps the response small. "commands" holds the request counts
+        and latency of the command server.
+
+        Returns:
+            str: "STATUS#<json>"
+        """
+        devices = self.capture_manager.status()
+        fields = list(devices[0].keys()) if devices else []
+        status = {
+            "running": self.capture_manager.is_capture_running(),
+            "runtime": self.capture_manager.runtime,
+            "start_time": self.capture_manager.start_time,
+            "free_mb": self.retention.free_bytes() // (1024 * 1024),
+            "fields": fields,
+            "devices": [[device[field] for field in fields] for device in devices],
+            "commands": self.command_server.stats(),
+        }
+        return f"STATUS{COMMAND_SEPARATOR}{json.dumps(status, separators=(',', ':'))}"
+
+    def capture_bytes(self, seconds: float) -> int:
+        """
+        Returns:
+            int: Bytes all devices write in the given number of seconds, before FLAC encoding
+        """
+        manager = self.capture_manager
+        return int(seconds * manager.sample_rate) * manager.channels * SAMPLE_WIDTH * manager.number_of_devices
+
+    def CMD_spectral_summary(self, filename: str) -> str:
+        """
+        Summarises the spectral sidecar of a recording, so the controller can decide whether
+        the recording is worth fetching without downloading it.
+
+        Args:
+            filename (str): Name of the recording (WAV or FLAC)
+
+        Returns:
+            str: "SPECTRAL#<json summary>", or an error message if there is no sidecar
+        """
+        sidecar_path = spectral_sidecar_path(os.path.join(LOCAL_STORAGE_PATH, os.path.basename(filename)))
+        if not os.path.exists(sidecar_path):
+            return "Spectral summary not found"
+        try:
+            summary = summarize_sidecar(sidecar_path)
+        except Exception as e:
+            self.logger.error(f"[ERROR] Error reading spectral summary {sidecar_path}: {e}")
+            return "Spectral summary not readable"
+        summary["file"] = filename
+        summary["sidecar"] = os.path.basename(sidecar_path)
+        return f"SPECTRAL{COMMAND_SEPARATOR}{json.dumps(summary, separators=(',', ':'))}"
+
+    def CMD_fetch_audio_file(self, filename: str, offset: int = 0, length: int = 0) -> Union[str, FileResponse]:
+        """
+        Sends a recording (or its spectral sidecar) over the command connection, without the
+        encryption overhead of SFTP. The response "FILE#<file>#<offset>#<count>#<size>" is
+        followed by count raw bytes starting at offset, so an interrupted transfer resumes by
+        asking for the rest of the file.
+
+        For an indexed file the response ends in "#<checksum offset>#<checksum>": the checksum
+        the writer computed over the file from that byte on, so the controller verifies the
+        file as it arrives instead of trusting its size.
+
+        Args:
+            filename (str): Name of a file in the storage directory
+            offset (int): First byte to send
+            length (int): Number of bytes to send; 0 sends the rest of the file
+
+        Returns:
+            Union[str, FileResponse]: The response with the file data, or an error message
+        """
+        if os.path.basename(filename) != filename or not filename.endswith(AUDIO_FILE_EXTENSIONS + (SPECTRAL_SIDECAR_SUFFIX,)):
+            return "Invalid file name"
+        try:
+            # Once open, the file can be evicted or replaced by its FLAC version without breaking the transfer
+            file = open(os.path.join(LOCAL_STORAGE_PATH, filename), "rb")
+        except FileNotFoundError:
+            return "File not found"
+        size = os.fstat(file.fileno()).st_size
+        if offset < 0 or length < 0 or offset > size:
+            file.close()
+            return "Invalid range"
+        count = size - offset if length == 0 else min(length, size - offset)
+        self.logger.info(f"[INFO] Sending {filename} bytes {offset}-{offset + count} of {size}")
+        fields = ["FILE", filename, str(offset), str(count), str(size)] + self.file_checksum_fields(filename, size)
+        return FileResponse(COMMAND_SEPARATOR.join(fields), file, offset, count)
+
+    def CMD_file_info(self, filename: str) -> str:
+        """
+        Returns:
+            str: "INFO#<file>#<size>[#<checksum offset>#<checksum>]", or an error message
+        """
+        if os.path.basename(filename) != filename or not filename.endswith(AUDIO_FILE_EXTENSIONS + (SPECTRAL_SIDECAR_SUFFIX,)):
+            return "Invalid file name"
+        try:
+            size = os.path.getsize(os.path.join(LOCAL_STORAGE_PATH, filename))
+        except FileNotFoundError:
+            return "File not found"
+        return COMMAND_SEPARATOR.join(["INFO", filename, str(size)] + self.file_checksum_fields(filename, size))
+
+    def file_checksum_fields(self, filename: str, size: int) -> list[str]:
+        """
+        Returns:
+            list[str]: Offset and checksum of a file as indexed by its writer, empty if unknown
+                       or if the entry does not match the file on the card
+        """
+        entry = self.file_manager.file_index.get(filename)
+        if not entry or not entry["file_checksum"] or entry["size"] != size:
+            return []
+        return [str(entry["file_checksum_offset"]), entry["file_checksum"]]
+
+    def on_recording_closed(self, path: str):
+        """
+        Makes a finished segment of a continuous recording available for fetching,
+        after encoding it to FLAC if enabled. Runs on the dump thread, so it must not block.
+        """
+        if self.flac_encoder is not None:
+            self.flac_encoder.submit(path, on_done=self.on_recording_encoded)
+        else:
+            self.file_manager.add_new_file(os.path.basename(path))
+            self.publish_file_ready(os.path.basename(path))
+
+    def on_recording_encoded(self, result: dict):
+        self.file_manager.file_encoded(result)
+        self.file_manager.add_new_file(os.path.basename(result["flac_path"]))
+        self.publish_file_ready(os.path.basename(result["flac_path"]))
+
+    def publish_event(self, event_type: str, **fields):
+        """
+        Pushes an event to every controller subscribed with SUBSCRIBE, as "EVENT#<json>".
+
+        Args:
+            event_type (str): "capture_complete" or "file_ready"
+            **fields: Further fields of the event
+        """
+        event = {"type": event_type, "time": time.time(), **fields}
+        self.command_server.publish(f"EVENT{COMMAND_SEPARATOR}{json.dumps(event, separators=(',', ':'))}")
+
+    def publish_file_ready(self, filename: str):
+        # The writers index a file before it is handed on, so the entry is there
+        entry = self.file_manager.file_index.get(filename) or {}
+        self.publish_event("file_ready", file=filename, size=entry.get("size"), checksum=entry.get("checksum"),
+                           file_checksum=entry.get("file_checksum"), file_checksum_offset=entry.get("file_checksum_offset"))
+
+    def shutdown(self):
+        """
+        Finishes a running capture, then closes the devices and ends the capture and encoder processes.
+        """
+        self.logger.info(f"[INFO] Shutting down controller")
+        if self.run_in_progress and self.capture_manager.runtime is None:
+            self.stop_requested.set()
+        if self.recording_thread is not None:
+            self.recording_thread.join()
+        if isinstance(self.capture_manager, ProcessCaptureManager):
+            self.capture_manager.shutdown()
+        if self.device_pool is not None:
+            self.device_pool.close()
+        if self.flac_encoder is not None:
+            self.flac_encoder.shutdown()
 
 
 if __name__ == "__main__":
     pac_controller = PACController()
-    pac_controller.start_tcp_server()
+    try:
+        pac_controller.start_tcp_server()
+    finally:
+        pac_controller.shutdown()
@@ -0,0 +1,138 @@
+import logging
+import threading
+import time
+from audio_capture import AudioCapture
+from pac_metrics import LatencyHistogram
+
+
+# Number of attempts to (re)open a device before giving up for this run
+OPEN_ATTEMPTS = 3
+
+# Pause between two attempts to open a device in seconds
+OPEN_RETRY_INTERVAL = 0.5
+
+
+class DevicePool:
+    """
+    Keeps the ALSA capture devices open and configured across runs.
+
+    Every device is opened once when the pool is built. Between runs a device is re-armed
+    (stream stopped, stale frames dropped) instead of closed, so no device is opened right
+    before the start barrier. A device that failed (open error, read error, failed re-arm)
+    is closed and reopened on its next use, without restarting the service.
+
+    Attributes:
+        devices (list[str]): ALSA device identifiers
+        arm_latency (LatencyHistogram): Time from a start request until all devices are armed
+        start_latency (LatencyHistogram): Time from the start barrier until the first period
+    """
+
+    def __init__(self, devices: list[str], capture_factory=AudioCapture):
+        """
+        Open all devices.
+
+        Args:
+            devices (list[str]): ALSA device identifiers
+            capture_factory (callable): Builds an AudioCapture for a device identifier
+        """
+        self.logger = logging.getLogger(__name__)
+        self.logger.info("Building device pool...")
+
+        self.devices = devices
+        self.capture_factory = capture_factory
+        self.captures: list[AudioCapture] = [None] * len(devices)
+        self.failures = [0] * len(devices)
+        self.lock = threading.Lock()
+
+        self.arm_latency = LatencyHistogram()
+        self.start_latency = LatencyHistogram()
+
+        for device_index in range(len(devices)):
+            self._open(device_index)
+
+    def _open(self, device_index: int) -> AudioCapture:
+        device_name = self.devices[device_index]
+        for attempt in range(OPEN_ATTEMPTS):
+            try:
+                self.captures[device_index] = self.capture_factory(device_name)
+                self.logger.info(f"[INFO] Opened device {device_name}")
+                return self.captures[device_index]
+            except Exception as e:
+                self.logger.error(f"[ERROR] Error opening device {device_name} (attempt {attempt + 1} of {OPEN_ATTEMPTS}): {e}")
+                time.sleep(OPEN_RETRY_INTERVAL)
+        self.captures[device_index] = None
+        return None
+
+    def _close(self, device_index: int):
+        capture = self.captures[device_index]
+        self.captures[device_index] = None
+        if capture is not None:
+            try:
+                capture.close()
+            except Exception as e:
+                self.logger.error(f"[ERROR] Error closing device {self.devices[device_index]}: {e}")
+
+    def acquire(self, device_index: int) -> AudioCapture:
+        """
+        Return the armed capture of a device, reopening it if it failed before.
+
+        Args:
+            device_index (int): Index of the device
+
+        Returns:
+            AudioCapture: The armed capture, None if the device could not be opened
+        """
+        with self.lock:
+            capture = self.captures[device_index]
+            if capture is None:
+                self.logger.info(f"[INFO] Recovering device {self.devices[device_index]}")
+                capture = self._open(device_index)
+            return capture
+
+    def release(self, device_index: int):
+        """
+        Re-arm a device after a run so it is ready for the next one.
+
+        Args:
+            device_index (int): Index of the device
+        """
+        with self.lock:
+            capture = self.captures[device_index]
+            if capture is None:
+                return
+            if capture.first_period_time is not None:
+                self.start_latency.record(capture.first_period_time - capture.start_time)
+            try:
+                capture.rearm()
+            except Exception as e:
+                self.logger.error(f"[ERROR] Error re-arming device {self.devices[device_index]}, reopening on next use: {e}")
+                self.failures[device_index] += 1
+                self._close(device_index)
+
+    def mark_failed(self, device_index: int, error: Exception):
+        """
+        Close a device after an error; it is reopened on its next use.
+
+        Args:
+            device_index (int): Index of the device
+            error (Exception): The error the device failed with
+        """
+        with self.lock:
+            self.logger.error(f"[ERROR] Device {self.devices[device_index]} failed: {error}")
+            self.failures[device_index] += 1
+            self._close(device_index)
+
+    def close(self):
+        with self.lock:
+            for device_index in range(len(self.devices)):
+                self._close(device_index)
+
+    def latency_report(self) -> str:
+        """
+        Returns:
+            str: Human readable arm and start latency percentiles
+        """
+        arm = self.arm_latency.summary()
+        start = self.start_latency.summary()
+        return (f"arm latency p50 {arm['p50']*1000:.1f} ms, max {arm['max']*1000:.1f} ms; "
+                f"start latency p50 {start['p50']*1000:.1f} ms, max {start['max']*1000:.1f} ms")
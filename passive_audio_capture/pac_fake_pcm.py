@@ -0,0 +1,141 @@
+import math
+import time
+import numpy as np
+
+
+# Return value of a read after an overrun, as returned by pyalsaaudio (-EPIPE)
+OVERRUN = -32
+
+
+class FakePCM:
+    """
+    A simulated ALSA capture device with the interface of alsaaudio.PCM used by AudioCapture.
+
+    The device produces a deterministic signal (a sine tone plus seeded noise) in real time:
+    `read` blocks until the next period would have been captured, just like a real device.
+    A reader that falls behind by more than the device buffer gets an overrun and the stream
+    restarts, as ALSA does. Overruns and read stalls can also be injected on purpose.
+
+    Use it through AudioCapture, e.g.
+    `AudioCapture("fake:0", pcm_factory=FakePCM)` or with extra options
+    `AudioCapture("fake:0", pcm_factory=lambda name, **kwargs: FakePCM(name, stall_every=100, **kwargs))`.
+    """
+
+    def __init__(self, device="fake", channels=1, rate=256000, periodsize=4096, periods=4,
+                 frequency=40000.0, amplitude=8000, noise_level=200, seed=0,
+                 overrun_every=None, stall_every=None, stall_duration=0.05, realtime=True,
+                 burst_every=None, burst_duration=0.1):
+        """
+        Args:
+            device (str): Device name, only used for reporting
+            channels (int): Number of channels
+            rate (int): Sample rate in Hz
+            periodsize (int): Frames per period
+            periods (int): Number of periods in the device buffer
+            frequency (float): Frequency of the sine tone in Hz
+            amplitude (int): Amplitude of the sine tone
+            noise_level (int): Standard deviation of the added noise
+            seed (int): Seed of the noise generator, so the signal is reproducible
+            overrun_every (int, optional): Inject an overrun every overrun_every periods
+            stall_every (int, optional): Stall a read every stall_every periods
+            stall_duration (float): Duration of an injected stall in seconds
+            realtime (bool): Pace reads like a real device; False returns periods as fast as possible
+            burst_every (float, optional): Only play the tone in bursts, one every burst_every seconds
+                                           (halfway each cycle); noise only in between
+            burst_duration (float): Duration of a tone burst in seconds
+        """
+        self.device = device
+        self.channels = channels
+        self.rate = rate
+        self.periodsize = periodsize
+        self.buffer_frames = periodsize * periods
+        self.overrun_every = overrun_every
+        self.stall_every = stall_every
+        self.stall_duration = stall_duration
+        self.realtime = realtime
+
+        # One second of signal (or one burst cycle), replayed cyclically
+        table_frames = max(periodsize, rate, int(round((burst_every or 0) * rate)))
+        t = np.arange(table_frames) / rate
+        rng = np.random.default_rng(seed)
+        tone = amplitude * np.sin(2 * math.pi * frequency * t)
+        if burst_every:
+            cycle_time = t % burst_every
+            tone *= (cycle_time >= burst_every / 2) & (cycle_time < burst_every / 2 + burst_duration)
+        noise = rng.normal(0, noise_level, table_frames)
+        mono = np.clip(tone + noise, -32768, 32767).astype("<i2")
+        table = np.repeat(mono[:, None], channels, axis=1).reshape(-1)
+        # Two copies back to back, so every period is one contiguous slice
+        self._table = np.concatenate([table, table]).tobytes()
+        self._table_frames = table_frames
+        self._frame_bytes = channels * 2
+
+        self.stream_start = None
+        self.position = 0
+        self.phase = 0
+        self.periods_read = 0
+        self.overruns = 0
+        self.stalls = 0
+
+    def set_tstamp_mode(self, mode=None):
+        pass
+
+    def set_tstamp_type(self, tstamp_type=None):
+        pass
+
+    def read(self):
+        """
+        Returns:
+            tuple: (number of frames, bytes) like alsaaudio.PCM.read, (OVERRUN, b"") after an overrun
+        """
+        now = time.monotonic()
+        if self.stream_start is None:
+            # Like ALSA, the stream starts with the first read
+            self.stream_start = now
+            self.position = 0
+
+        self.periods_read += 1
+        if self.stall_every and self.periods_read % self.stall_every == 0:
+            self.stalls += 1
+            time.sleep(self.stall_duration)
+            now = time.monotonic()
+
+        if self.realtime:
+            captured = (now - self.stream_start) * self.rate
+            injected = self.overrun_every and self.periods_read % self.overrun_every == 0
+            if injected or captured - self.position > self.buffer_frames:
+                # Overrun: the buffered frames are lost and the stream restarts
+                self.overruns += 1
+                self.phase = (self.phase + int(captured - self.position)) % self._table_frames
+                self.stream_start = None
+                return OVERRUN, b""
+
+            deadline = self.stream_start + (self.position + self.periodsize) / self.rate
+            if deadline > now:
+                time.sleep(deadline - now)
+        elif self.overrun_every and self.periods_read % self.overrun_every == 0:
+            self.overruns += 1
+            return OVERRUN, b""
+
+        start = self.phase * self._frame_bytes
+        data = self._table[start:start + self.periodsize * self._frame_bytes]
+        self.phase = (self.phase + self.periodsize) % self._table_frames
+        self.position += self.periodsize
+        return self.periodsize, data
+
+    def htimestamp(self):
+        """
+        Returns:
+            tuple: (seconds, nanoseconds, frames available), like alsaaudio.PCM.htimestamp
+        """
+        now = time.time()
+        if self.stream_start is None:
+            return int(now), int((now % 1) * 1e9), 0
+        available = max(0, int((time.monotonic() - self.stream_start) * self.rate) - self.position)
+        return int(now), int((now % 1) * 1e9), available
+
+    def drop(self):
+        self.stream_start = None
+
+    def close(self):
+        self.stream_start = None
@@ -0,0 +1,270 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from pac_stream_writer import read_wav_metadata
+
+
+# Name of the index database, kept in the storage directory next to the recordings
+INDEX_FILENAME = "recordings.sqlite"
+
+# Time to wait for a lock held by another process (e.g. the writer process) in seconds
+INDEX_BUSY_TIMEOUT = 10.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS recordings (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL,
+    frames INTEGER,
+    sample_rate INTEGER,
+    channels INTEGER,
+    start_time REAL,
+    device TEXT,
+    device_index INTEGER,
+    checksum TEXT,
+    closed_at REAL NOT NULL,
+    metadata TEXT,
+    fetched INTEGER NOT NULL DEFAULT 0,
+    file_checksum TEXT,
+    file_checksum_offset INTEGER
+);
+CREATE INDEX IF NOT EXISTS recordings_closed_at ON recordings (closed_at);
+CREATE INDEX IF NOT EXISTS recordings_start_time ON recordings (start_time);
+CREATE INDEX IF NOT EXISTS recordings_eviction ON recordings (fetched DESC, closed_at);
+"""
+
+_COLUMNS = ("id", "name", "size", "frames", "sample_rate", "channels", "start_time", "device", "device_index",
+            "checksum", "closed_at", "metadata", "fetched", "file_checksum", "file_checksum_offset")
+
+
+def index_path(directory: str) -> str:
+    """
+    Returns:
+        str: Path of the index database of a storage directory
+    """
+    return os.path.join(directory, INDEX_FILENAME)
+
+
+class RecordingIndex:
+    """
+    Persistent index of the recordings in a storage directory, kept in SQLite.
+
+    Every finished file is added by the writer that produced it, with its size, number of
+    frames, time of the first sample, device and checksums, so listing new files and
+    finding files to clean up are indexed queries instead of directory listings. Rows are
+    numbered in the order files were finished, so "new since" is a comparison with the last
+    id seen.
+
+    Two checksums are kept: `checksum` covers the samples, so it is the same for the WAV and
+    FLAC version of a recording; `file_checksum` covers the bytes of the file as stored, from
+    `file_checksum_offset` to its end, so a controller can verify a transfer as it receives it.
+    For a WAV file both are the same digest, the samples being the bytes after the header.
+
+    The database runs in WAL mode, so the controller can query it while a writer (thread or
+    process) adds files. Each process opens its own RecordingIndex; within a process a single
+    connection is shared by all threads.
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path (str): Path of the database file; created if it does not exist
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=INDEX_BUSY_TIMEOUT, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            # One fsync per checkpoint instead of per commit; a crash loses at most the last rows, never the database
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(recordings)")]
+            if columns and "fetched" not in columns:
+                # Index created before fetched files were tracked
+                self.connection.execute("ALTER TABLE recordings ADD COLUMN fetched INTEGER NOT NULL DEFAULT 0")
+            if columns and "file_checksum" not in columns:
+                # Index created before transfers were verified
+                self.connection.execute("ALTER TABLE recordings ADD COLUMN file_checksum TEXT")
+                self.connection.execute("ALTER TABLE recordings ADD COLUMN file_checksum_offset INTEGER")
+            self.connection.executescript(_SCHEMA)
+
+    def _rows(self, query: str, parameters: tuple = ()) -> list[dict]:
+        with self.lock:
+            cursor = self.connection.execute(query, parameters)
+            return [dict(zip(_COLUMNS, row)) for row in cursor.fetchall()]
+
+    def add(self, path: str, frames: int, sample_rate: int, channels: int, checksum: str = None,
+            metadata: dict = None, closed_at: float = None, file_checksum: str = None, file_checksum_offset: int = None) -> int:
+        """
+        Add a finished recording, or replace the entry of a file with the same name.
+
+        Args:
+            path (str): Path of the recording
+            frames (int): Number of frames in the recording
+            sample_rate (int): Sample rate in Hz
+            channels (int): Number of channels
+            checksum (str, optional): Hex digest of the sample data
+            metadata (dict, optional): Capture metadata as stored in the WAV header
+            closed_at (float, optional): Time the file was finished (default: now)
+            file_checksum (str, optional): Hex digest of the file bytes from file_checksum_offset to the end
+            file_checksum_offset (int, optional): First byte covered by file_checksum
+
+        Returns:
+            int: Id of the entry
+        """
+        metadata = metadata or {}
+        start_time = metadata.get("first_sample_time")
+        if start_time is None and metadata.get("scheduled_start_time") is not None:
+            start_time = metadata["scheduled_start_time"] + metadata.get("first_frame", 0) / sample_rate
+        row = (os.path.basename(path), os.path.getsize(path), frames, sample_rate, channels, start_time,
+               metadata.get("device"), metadata.get("device_index"), checksum,
+               time.time() if closed_at is None else closed_at, json.dumps(metadata) if metadata else None,
+               file_checksum, file_checksum_offset if file_checksum is not None else None)
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                "INSERT OR REPLACE INTO recordings (name, size, frames, sample_rate, channels, start_time, device, "
+                "device_index, checksum, closed_at, metadata, file_checksum, file_checksum_offset) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+            return cursor.lastrowid
+
+    def rename(self, old_path: str, new_path: str, file_checksum: str = None, file_checksum_offset: int = 0):
+        """
+        Move the entry of a recording to a new file with the same samples, e.g. its FLAC
+        version. The checksum covers the samples, so it stays valid; the file checksum is
+        replaced by that of the new file.
+
+        Args:
+            old_path (str): Path of the indexed file
+            new_path (str): Path of the file replacing it
+            file_checksum (str, optional): Hex digest of the bytes of the new file from file_checksum_offset
+            file_checksum_offset (int): First byte covered by file_checksum
+        """
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE recordings SET name = ?, size = ?, file_checksum = ?, file_checksum_offset = ? WHERE name = ?",
+                                    (os.path.basename(new_path), os.path.getsize(new_path), file_checksum,
+                                     file_checksum_offset if file_checksum is not None else None, os.path.basename(old_path)))
+
+    def remove(self, names: list[str]):
+        """
+        Args:
+            names (list[str]): Names of the files to drop from the index
+        """
+        with self.lock, self.connection:
+            self.connection.executemany("DELETE FROM recordings WHERE name = ?", [(name,) for name in names])
+
+    def mark_fetched(self, names: list[str]) -> int:
+        """
+        Mark files as fetched by the controller, which makes them the first to be evicted.
+
+        Args:
+            names (list[str]): Names of the fetched files
+
+        Returns:
+            int: Number of indexed files marked
+        """
+        with self.lock, self.connection:
+            cursor = self.connection.executemany("UPDATE recordings SET fetched = 1 WHERE name = ?",
+                                                 [(os.path.basename(name),) for name in names])
+            return cursor.rowcount
+
+    def eviction_order(self, limit: int = 100) -> list[dict]:
+        """
+        Args:
+            limit (int): Maximum number of entries to return
+
+        Returns:
+            list[dict]: Entries in the order they should be evicted: fetched files first, oldest first
+        """
+        return self._rows(f"SELECT {', '.join(_COLUMNS)} FROM recordings ORDER BY fetched DESC, closed_at LIMIT ?",
+                          (limit,))
+
+    def total_size(self, fetched_only: bool = False) -> int:
+        """
+        Returns:
+            int: Total size in bytes of the indexed files, or of the fetched ones only
+        """
+        query = "SELECT COALESCE(SUM(size), 0) FROM recordings" + (" WHERE fetched = 1" if fetched_only else "")
+        with self.lock:
+            return self.connection.execute(query).fetchone()[0]
+
+    def get(self, name: str) -> dict:
+        """
+        Returns:
+            dict: The entry of a file, None if it is not indexed
+        """
+        rows = self._rows(f"SELECT {', '.join(_COLUMNS)} FROM recordings WHERE name = ?", (os.path.basename(name),))
+        return rows[0] if rows else None
+
+    def last_id(self) -> int:
+        """
+        Returns:
+            int: Id of the most recently finished file, 0 if the index is empty
+        """
+        with self.lock:
+            return self.connection.execute("SELECT COALESCE(MAX(id), 0) FROM recordings").fetchone()[0]
+
+    def count(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM recordings").fetchone()[0]
+
+    def new_since(self, last_id: int) -> list[dict]:
+        """
+        Args:
+            last_id (int): Id returned by an earlier call to last_id
+
+        Returns:
+            list[dict]: Entries of the files finished since, oldest first
+        """
+        return self._rows(f"SELECT {', '.join(_COLUMNS)} FROM recordings WHERE id > ? ORDER BY id", (last_id,))
+
+    def closed_before(self, timestamp: float) -> list[dict]:
+        """
+        Args:
+            timestamp (float): Unix time
+
+        Returns:
+            list[dict]: Entries of the files finished before timestamp, oldest first
+        """
+        return self._rows(f"SELECT {', '.join(_COLUMNS)} FROM recordings WHERE closed_at < ? ORDER BY closed_at",
+                          (timestamp,))
+
+    def sync(self, directory: str, extensions: tuple) -> tuple[int, list[str]]:
+        """
+        Bring the index in line with the directory, e.g. after files were copied in or
+        deleted while the controller was not running. Lists the directory once; only meant
+        for startup.
+
+        Files that are not indexed yet are added without checksum; WAV files get their
+        metadata from the header.
+
+        Args:
+            directory (str): Storage directory
+            extensions (tuple): Extensions of the files to index
+
+        Returns:
+            tuple[int, list[str]]: Number of entries added, and names of the entries removed
+        """
+        on_disk = {name for name in os.listdir(directory) if name.endswith(extensions)}
+        with self.lock:
+            indexed = {row[0] for row in self.connection.execute("SELECT name FROM recordings")}
+
+        removed = indexed - on_disk
+        self.remove(sorted(removed))
+
+        added = 0
+        # Add the oldest files first, so ids follow the order the files were written in
+        for name in sorted(on_disk - indexed, key=lambda name: os.path.getmtime(os.path.join(directory, name))):
+            path = os.path.join(directory, name)
+            try:
+                metadata = read_wav_metadata(path) if name.endswith(".wav") else {}
+                self.add(path, metadata.get("frames"), metadata.get("sample_rate"), None, metadata=metadata,
+                         closed_at=os.path.getmtime(path))
+                added += 1
+            except (OSError, ValueError) as e:
+                print(f"Error indexing {path}: {e}")
+        return added, sorted(removed)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -1,54 +1,91 @@
 import logging
 import os
-import time
-from datetime import datetime
+import sqlite3
+import threading
+from pac_file_index import RecordingIndex, index_path
+from pac_spectral_summary import spectral_sidecar_path
+
+
+# Recordings as written by the capture manager and the FLAC encoder
+AUDIO_FILE_EXTENSIONS = ('.wav', '.flac')
 
 
 class FileManager:
-    def __init__(self, directory: str):
+    """
+    Keeps track of the recordings in the storage directory through a RecordingIndex.
+
+    The writers add every finished file to the index, so new files and files to clean up
+    are found with indexed queries; the directory is only listed once, at startup, to pick
+    up changes made while the controller was not running.
+    """
+
+    def __init__(self, directory: str, file_index: RecordingIndex = None):
+        """
+        Args:
+            directory (str): Storage directory of the recordings
+            file_index (RecordingIndex, optional): Index of the directory (default: the index in the directory itself)
+        """
         self.directory = directory
         self.logger = logging.getLogger(__name__)
         self.logger.info("Building file manager...")
 
-        self.files = []
+        os.makedirs(directory, exist_ok=True)
+        self.file_index = file_index if file_index is not None else RecordingIndex(index_path(directory))
+        added, removed = self.file_index.sync(directory, AUDIO_FILE_EXTENSIONS)
+        for filename in removed:
+            sidecar_path = spectral_sidecar_path(os.path.join(directory, filename))
+            if os.path.exists(sidecar_path):
+                os.remove(sidecar_path)
+        self.logger.info(f"[INFO] Synced file index of {directory}: {added} files added, {len(removed)} removed")
+
+        # Id of the last indexed file before the current run
+        self.last_file_id = 0
         self.new_files = []
+        self.new_files_lock = threading.Lock()
         self.update_files()
 
     def get_files_in_directory(self):
         return os.listdir(self.directory)
 
     def update_files(self):
-        self.files = self.get_files_in_directory()
-        self.logger.info(f"[INFO] # Files in {self.directory}: {len(self.files)}")
+        self.last_file_id = self.file_index.last_id()
+        self.logger.info(f"[INFO] # Files in {self.directory}: {self.file_index.count()}")
 
     def update_new_files(self):
-        current_files = self.get_files_in_directory()
-        self.new_files = [file for file in current_files if file not in self.files]
+        with self.new_files_lock:
+            self.new_files = [entry["name"] for entry in self.file_index.new_since(self.last_file_id)
+                              if entry["name"].endswith(AUDIO_FILE_EXTENSIONS)]
 
-    def return_new_files(self):
-        return self.new_files
+    def add_new_file(self, filename: str):
+        """
+        Register a single finished recording, e.g. a segment of a continuous capture.
+
+        Args:
+            filename (str): Name of the file in the managed directory
+        """
+        with self.new_files_lock:
+            if filename not in self.new_files:
+                self.new_files.append(filename)
 
-    def delete_old_files(self, hours: float = 3.0) -> None:
+    def file_encoded(self, result: dict):
         """
-        Delete files that are older than the specified number of hours.
-        
+        Moves the index entry of a recording to its FLAC version.
+
         Args:
-            hours (float): Number of hours to use as threshold for deletion. Defaults to 1.0.
+            result (dict): Result of the FLAC encoder
         """
-        current_time = time.time()
-        threshold = current_time - (hours * 3600)  # Convert hours to seconds
-        
-        for filename in self.get_files_in_directory():
-            file_path = os.path.join(self.directory, filename)
-            try:
-                # Get the last modification time of the file
-                mod_time = os.path.getmtime(file_path)
-                if mod_time < threshold:
-                    if filename.endswith('.wav'):
-                        os.remove(file_path)
-                    self.logger.info(f"Deleted old file: {filename} (modified: {datetime.fromtimestamp(mod_time)})")
-            except OSError as e:
-                self.logger.error(f"Error processing file {filename}: {e}")
-        
-        # Update the files list after deletion
+        try:
+            self.file_index.rename(result["wav_path"], result["flac_path"], file_checksum=result.get("flac_checksum"))
+        except (OSError, sqlite3.Error) as e:
+            self.logger.error(f"[ERROR] Error updating the index for {result['flac_path']}: {e}")
+
+    def return_new_files(self):
+        # Files fetched and deleted by the controller in the meantime are dropped
+        with self.new_files_lock:
+            self.new_files = [file for file in self.new_files if os.path.exists(os.path.join(self.directory, file))]
+            return list(self.new_files)
+
+    def reset(self):
+        with self.new_files_lock:
+            self.new_files = []
         self.update_files()
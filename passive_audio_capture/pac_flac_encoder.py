@@ -0,0 +1,186 @@
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, Future, wait
+import soundfile as sf
+from pac_stream_writer import payload_checksum, read_wav_metadata
+
+
+# FLAC compression level (0 = fastest, 8 = smallest), mapped onto libsndfile's 0.0 - 1.0 scale
+FLAC_COMPRESSION_LEVEL = 5
+
+# Number of cores the encoder may use; the remaining cores are left to the capture threads
+FLAC_CPU_BUDGET = max(1, (os.cpu_count() or 1) - 2)
+
+# Nice value of the encoder processes, so they always yield to capture and dump threads
+FLAC_NICENESS = 10
+
+# Number of frames read and encoded per block; keeps worker memory constant
+FLAC_BLOCK_FRAMES = 256000
+
+# Bytes read per block when checksumming a finished FLAC file
+FLAC_CHECKSUM_BLOCK_BYTES = 1024 * 1024
+
+
+def _init_worker(cpu_set: set, niceness: int):
+    """
+    Runs once in every encoder process: lower its priority and pin it to the encoder cores.
+    """
+    os.nice(niceness)
+    if cpu_set and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpu_set)
+
+
+def encode_wav_to_flac(wav_path: str, compression_level: int = FLAC_COMPRESSION_LEVEL, keep_wav: bool = False) -> dict:
+    """
+    Losslessly encode a WAV file to FLAC next to it, block by block.
+
+    The FLAC file is written to `<name>.flac.part` and renamed when complete, so a listing
+    never contains a partial FLAC file. The capture metadata of the WAV header goes into the
+    comment of the FLAC file, as JSON, so the timing of the samples survives the encoding.
+
+    Args:
+        wav_path (str): Path of the WAV file to encode
+        compression_level (int): FLAC compression level 0-8
+        keep_wav (bool): Keep the WAV file after encoding (default: False)
+
+    Returns:
+        dict: Paths and sizes of the WAV and FLAC file, checksum of the FLAC file and the encoding time in seconds
+    """
+    start = time.perf_counter()
+    flac_path = os.path.splitext(wav_path)[0] + ".flac"
+    part_path = flac_path + ".part"
+
+    metadata = read_wav_metadata(wav_path)
+    with sf.SoundFile(wav_path) as src:
+        with sf.SoundFile(part_path, "w", samplerate=src.samplerate, channels=src.channels,
+                          subtype="PCM_16", format="FLAC", compression_level=compression_level / 8) as dst:
+            if metadata:
+                dst.comment = json.dumps(metadata, separators=(",", ":"))
+            for block in src.blocks(blocksize=FLAC_BLOCK_FRAMES, dtype="int16"):
+                dst.write(block)
+
+    # libsndfile seeks back to patch the stream info, so the bytes are only final once closed;
+    # the file was just written, so this reads it back from the page cache, not the card
+    checksum = payload_checksum()
+    with open(part_path, "rb") as f:
+        for block in iter(lambda: f.read(FLAC_CHECKSUM_BLOCK_BYTES), b""):
+            checksum.update(block)
+    os.replace(part_path, flac_path)
+
+    wav_bytes = os.path.getsize(wav_path)
+    flac_bytes = os.path.getsize(flac_path)
+    if not keep_wav:
+        os.remove(wav_path)
+
+    return {
+        "wav_path": wav_path,
+        "flac_path": flac_path,
+        "wav_bytes": wav_bytes,
+        "flac_bytes": flac_bytes,
+        "flac_checksum": checksum.hexdigest(),
+        "seconds": time.perf_counter() - start,
+    }
+
+
+class FlacEncoder:
+    """
+    Encodes finished WAV recordings to FLAC in a pool of background processes.
+
+    The pool is limited to a CPU budget: workers are pinned to the highest numbered cores
+    and run niced, so they never compete with the capture threads for CPU time.
+    """
+
+    def __init__(self, compression_level: int = FLAC_COMPRESSION_LEVEL, cpu_budget: int = FLAC_CPU_BUDGET,
+                 niceness: int = FLAC_NICENESS, keep_wav: bool = False):
+        """
+        Args:
+            compression_level (int): FLAC compression level 0-8 (default: 5)
+            cpu_budget (int): Number of cores the encoder may use (default: all but two)
+            niceness (int): Nice value of the encoder processes (default: 10)
+            keep_wav (bool): Keep the WAV files after encoding (default: False)
+        """
+        self.logger = logging.getLogger(__name__)
+        self.logger.info("Building FLAC encoder...")
+
+        self.compression_level = compression_level
+        self.keep_wav = keep_wav
+
+        cpu_count = os.cpu_count() or 1
+        cpu_budget = max(1, min(cpu_budget, cpu_count))
+        cpu_set = set(range(cpu_count - cpu_budget, cpu_count))
+
+        # forkserver: never fork the controller while capture threads are running
+        self.executor = ProcessPoolExecutor(max_workers=cpu_budget,
+                                            mp_context=multiprocessing.get_context("forkserver"),
+                                            initializer=_init_worker,
+                                            initargs=(cpu_set, niceness))
+        self.pending: set[Future] = set()
+
+        self.wav_bytes = 0
+        self.flac_bytes = 0
+
+    def submit(self, wav_path: str, on_done=None) -> Future:
+        """
+        Queue a WAV file for encoding.
+
+        Args:
+            wav_path (str): Path of the WAV file
+            on_done (callable, optional): Called with the result dict once the FLAC file is ready
+
+        Returns:
+            Future: Resolves to the result dict of `encode_wav_to_flac`
+        """
+        future = self.executor.submit(encode_wav_to_flac, wav_path, self.compression_level, self.keep_wav)
+        self.pending.add(future)
+        future.add_done_callback(lambda f: self._on_encoded(f, on_done))
+        return future
+
+    def _on_encoded(self, future: Future, on_done):
+        self.pending.discard(future)
+        try:
+            result = future.result()
+        except Exception as e:
+            self.logger.error(f"[ERROR] FLAC encoding failed: {e}")
+            return
+
+        self.wav_bytes += result["wav_bytes"]
+        self.flac_bytes += result["flac_bytes"]
+        self.logger.info(f"[INFO] Encoded {os.path.basename(result['flac_path'])}: "
+                         f"{result['wav_bytes']/1024/1024:.1f} MB -> {result['flac_bytes']/1024/1024:.1f} MB "
+                         f"(ratio {self.compression_ratio(result):.2f}) in {result['seconds']:.1f} s")
+        if on_done is not None:
+            on_done(result)
+
+    def encode_files(self, wav_paths: list[str]) -> list[dict]:
+        """
+        Encode a batch of WAV files in parallel and wait until all are done.
+
+        Args:
+            wav_paths (list[str]): Paths of the WAV files
+
+        Returns:
+            list[dict]: Results of the successfully encoded files
+        """
+        futures = [self.submit(wav_path) for wav_path in wav_paths]
+        wait(futures)
+        return [future.result() for future in futures if future.exception() is None]
+
+    def is_busy(self) -> bool:
+        return len(self.pending) > 0
+
+    def compression_ratio(self, result: dict = None) -> float:
+        """
+        Args:
+            result (dict, optional): Single encoding result; overall ratio if omitted
+
+        Returns:
+            float: WAV size divided by FLAC size
+        """
+        wav_bytes, flac_bytes = (result["wav_bytes"], result["flac_bytes"]) if result else (self.wav_bytes, self.flac_bytes)
+        return wav_bytes / flac_bytes if flac_bytes else 0.0
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
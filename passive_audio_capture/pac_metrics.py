@@ -0,0 +1,233 @@
+import bisect
+import threading
+import time
+import numpy as np
+
+
+class LatencyHistogram:
+    """
+    A fixed-size, log-bucketed latency histogram.
+
+    Recording a sample is a bisect and an increment, so it can be used on the hot path.
+    Percentiles are approximate: they return the upper edge of the bucket the percentile
+    falls in (buckets are spaced 4 per octave, so within ~19%).
+
+    Like the RingBuffer, the histogram can live in memory provided by the caller (e.g.
+    shared memory), so one process can record while another reads it. The lock only
+    serialises the threads of one process: across processes there must be a single recorder,
+    and a reading taken while it records may be torn (e.g. count and buckets off by the
+    samples recorded meanwhile), which is fine for monitoring.
+    """
+
+    # Indices into the state array; the bucket counts follow
+    _COUNT = 0
+    _TOTAL = 1
+    _MAX = 2
+    _STATE_SIZE = 3
+
+    def __init__(self, min_latency: float = 1e-5, max_latency: float = 10.0, buffer=None):
+        """
+        Args:
+            min_latency (float): Upper edge of the first bucket in seconds (default: 10 us)
+            max_latency (float): Latencies above this end up in the overflow bucket (default: 10 s)
+            buffer (buffer, optional): Memory of at least required_bytes(min_latency, max_latency)
+                                       bytes to keep the histogram in; its contents are kept
+        """
+        self.edges = self._edges(min_latency, max_latency)
+        size = self._STATE_SIZE + len(self.edges) + 1
+        if buffer is None:
+            buffer = bytearray(size * 8)
+        self._state = np.frombuffer(buffer, dtype=np.float64, count=size)
+        self._counts = self._state[self._STATE_SIZE:]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _edges(min_latency: float, max_latency: float) -> list[float]:
+        edges = []
+        edge = min_latency
+        while edge < max_latency:
+            edges.append(edge)
+            edge *= 2 ** 0.25
+        edges.append(max_latency)
+        return edges
+
+    @staticmethod
+    def required_bytes(min_latency: float = 1e-5, max_latency: float = 10.0) -> int:
+        """
+        Returns:
+            int: Size of the memory a histogram with these limits needs
+        """
+        return (LatencyHistogram._STATE_SIZE + len(LatencyHistogram._edges(min_latency, max_latency)) + 1) * 8
+
+    @property
+    def counts(self) -> list[int]:
+        return [int(count) for count in self._counts]
+
+    @property
+    def count(self) -> int:
+        return int(self._state[self._COUNT])
+
+    @property
+    def total(self) -> float:
+        return float(self._state[self._TOTAL])
+
+    @property
+    def max(self) -> float:
+        return float(self._state[self._MAX])
+
+    def reset(self):
+        with self._lock:
+            self._state[:] = 0
+
+    def record(self, latency: float):
+        """
+        Args:
+            latency (float): Measured latency in seconds
+        """
+        with self._lock:
+            self._counts[bisect.bisect_left(self.edges, latency)] += 1
+            self._state[self._COUNT] += 1
+            self._state[self._TOTAL] += latency
+            if latency > self._state[self._MAX]:
+                self._state[self._MAX] = latency
+
+    def percentile(self, p: float) -> float:
+        """
+        Args:
+            p (float): Percentile between 0 and 100
+
+        Returns:
+            float: Approximate latency in seconds at percentile p, 0.0 without samples
+        """
+        with self._lock:
+            # Work on a copy, so the walk below sees one set of counts; a recorder in another
+            # process does not take this lock, so the copy itself may be torn
+            counts = self._counts.copy()
+            maximum = self.max
+        total = counts.sum()
+        if total == 0:
+            return 0.0
+        target = total * p / 100.0
+        cumulative = 0
+        for i, count in enumerate(counts):
+            cumulative += count
+            if cumulative >= target and count > 0:
+                return min(self.edges[i], maximum) if i < len(self.edges) else maximum
+        return maximum
+
+    def summary(self) -> dict:
+        """
+        Returns:
+            dict: Sample count, mean, p50, p90, p99 and max latency in seconds
+        """
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+class CaptureMetrics:
+    """
+    Counters of a single capture device, updated on the hot path by the capture and the
+    writer and read by anyone who wants a status snapshot.
+
+    Updating a counter is a single store into a small array, so it costs nothing next to
+    reading or writing a period. Like the RingBuffer, the counters can live in memory
+    provided by the caller (e.g. shared memory), so the capture and writer processes update
+    them while the controller reads them.
+
+    Attributes:
+        latency (LatencyHistogram): Latency of every write call of the device
+    """
+
+    # Indices into the counter array
+    _FRAMES_READ = 0
+    _OVERRUNS = 1
+    _LAST_PERIOD = 2
+    _BYTES_WRITTEN = 3
+    _FILES_CLOSED = 4
+    _LAST_WRITE = 5
+    _BYTES_DROPPED = 6
+    _STATE_SIZE = 8
+
+    def __init__(self, buffer=None):
+        """
+        Args:
+            buffer (buffer, optional): Memory of at least required_bytes() bytes to keep the
+                                       counters in; its contents are kept
+        """
+        if buffer is None:
+            buffer = bytearray(self.required_bytes())
+        self._state = np.frombuffer(buffer, dtype=np.float64, count=self._STATE_SIZE)
+        self.latency = LatencyHistogram(buffer=memoryview(buffer)[self._STATE_SIZE * 8:])
+
+    @staticmethod
+    def required_bytes() -> int:
+        """
+        Returns:
+            int: Size of the memory the counters of one device need
+        """
+        return CaptureMetrics._STATE_SIZE * 8 + LatencyHistogram.required_bytes()
+
+    def reset(self):
+        """
+        Clear all counters, e.g. at the start of a run.
+        """
+        self._state[:] = 0
+        self.latency.reset()
+
+    def period_read(self, frames: int):
+        # time.monotonic is CLOCK_MONOTONIC, so the time compares across processes
+        self._state[self._FRAMES_READ] += frames
+        self._state[self._LAST_PERIOD] = time.monotonic()
+
+    def overrun(self):
+        self._state[self._OVERRUNS] += 1
+
+    def bytes_written(self, nbytes: int):
+        self._state[self._BYTES_WRITTEN] += nbytes
+        self._state[self._LAST_WRITE] = time.monotonic()
+
+    def bytes_dropped(self, nbytes: int):
+        self._state[self._BYTES_DROPPED] += nbytes
+
+    def file_closed(self):
+        self._state[self._FILES_CLOSED] += 1
+
+    def snapshot(self, ring_buffer=None) -> dict:
+        """
+        Args:
+            ring_buffer (RingBuffer, optional): Ring buffer of the device, to include its fill
+
+        Returns:
+            dict: The counters, with times converted to seconds since the last period and write
+        """
+        state = self._state.copy()
+        now = time.monotonic()
+        latency = self.latency.summary()
+        snapshot = {
+            "frames_read": int(state[self._FRAMES_READ]),
+            "overruns": int(state[self._OVERRUNS]),
+            "since_last_period": round(float(now - state[self._LAST_PERIOD]), 3) if state[self._LAST_PERIOD] else None,
+            "bytes_written": int(state[self._BYTES_WRITTEN]),
+            "bytes_dropped": int(state[self._BYTES_DROPPED]),
+            "files_closed": int(state[self._FILES_CLOSED]),
+            "since_last_write": round(float(now - state[self._LAST_WRITE]), 3) if state[self._LAST_WRITE] else None,
+            "writes": latency["count"],
+            "write_p50_ms": round(latency["p50"] * 1000, 2),
+            "write_p99_ms": round(latency["p99"] * 1000, 2),
+            "write_max_ms": round(latency["max"] * 1000, 2),
+        }
+        if ring_buffer is not None:
+            stats = ring_buffer.stats()
+            snapshot.update({
+                "queue": stats["fill"],
+                "queue_slots": stats["slots"],
+                "queue_high_water": stats["high_water_mark"],
+                "dropped_periods": stats["dropped_periods"],
+            })
+        return snapshot
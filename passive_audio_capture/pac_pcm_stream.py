@@ -0,0 +1,150 @@
+import math
+import struct
+from typing import Callable
+
+
+# Channel of the command server the chunks are published on; controllers subscribe with SUBSCRIBE#pcm
+PCM_CHANNEL = "pcm"
+
+# Header in front of every chunk: magic, device index, channels, sample width, sample rate,
+# sequence number, index of the first frame within the capture, time of the first frame
+# (unix time, NaN if unknown) and the number of sample bytes that follow
+PCM_CHUNK_HEADER = struct.Struct("!4sBBBxIQQdI")
+PCM_CHUNK_MAGIC = b"PCM1"
+
+# Maximum time between chunks while a controller is listening, in seconds
+PCM_STREAM_INTERVAL = 0.1
+
+
+def pack_chunk(device_index: int, channels: int, sample_width: int, sample_rate: int, sequence: int, first_frame: int,
+               first_sample_time: float, payload: bytes) -> bytes:
+    """
+    Returns:
+        bytes: A chunk of a PCM stream, header and samples
+    """
+    return PCM_CHUNK_HEADER.pack(PCM_CHUNK_MAGIC, device_index, channels, sample_width, sample_rate, sequence,
+                                 first_frame, first_sample_time, len(payload)) + payload
+
+
+def unpack_chunk(chunk: bytes) -> tuple[dict, memoryview]:
+    """
+    Args:
+        chunk (bytes): A chunk as built by pack_chunk
+
+    Returns:
+        tuple[dict, memoryview]: The header fields, and a view of the samples
+    """
+    magic, device_index, channels, sample_width, sample_rate, sequence, first_frame, first_sample_time, length = \
+        PCM_CHUNK_HEADER.unpack_from(chunk)
+    if magic != PCM_CHUNK_MAGIC:
+        raise ValueError(f"Not a PCM chunk: {bytes(chunk[:4])}")
+    header = {
+        "device_index": device_index,
+        "channels": channels,
+        "sample_width": sample_width,
+        "sample_rate": sample_rate,
+        "sequence": sequence,
+        "first_frame": first_frame,
+        "first_sample_time": None if math.isnan(first_sample_time) else first_sample_time,
+    }
+    return header, memoryview(chunk)[PCM_CHUNK_HEADER.size:PCM_CHUNK_HEADER.size + length]
+
+
+class PcmStream:
+    """
+    Forwards the audio of a single device live to the controllers subscribed to the pcm
+    channel, as chunks with a sequence number, the index of their first frame and the time
+    of their first sample.
+
+    The stream is fed by the writer side (the dump thread), never by the capture thread,
+    and publishing only copies the chunk into the queues of the command server, which drop
+    chunks for a controller that cannot keep up. A slow network therefore shows up as gaps
+    in the sequence numbers at the receiver, and never as backpressure on the ALSA reads.
+    While nobody is listening, update only counts frames.
+
+    Without an SD card to write to (stream-only mode) the stream drains the ring buffer
+    itself, see run().
+    """
+
+    def __init__(self, device_index: int, sample_rate: int, channels: int, sample_width: int,
+                 publish: Callable[[bytes], None], is_listening: Callable[[], bool],
+                 first_sample_time: Callable[[], float] = None, interval: float = PCM_STREAM_INTERVAL):
+        """
+        Args:
+            device_index (int): Index of the device
+            sample_rate (int): Sample rate in Hz
+            channels (int): Number of channels
+            sample_width (int): Bytes per sample
+            publish (Callable[[bytes], None]): Hands a chunk to the subscribers; must not block
+            is_listening (Callable[[], bool]): Returns True while anyone subscribed
+            first_sample_time (Callable[[], float], optional): Returns the time of the first sample
+                                                                of the capture, None while unknown
+            interval (float): Maximum time between chunks in seconds
+        """
+        self.device_index = device_index
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.frame_bytes = channels * sample_width
+        self.publish = publish
+        self.is_listening = is_listening
+        self.first_sample_time = first_sample_time
+        self.interval = interval
+
+        self.frames = 0
+        self.sequence = 0
+        self.bytes_streamed = 0
+
+    def live(self) -> bool:
+        return self.is_listening()
+
+    def update(self, buffers: list):
+        """
+        Args:
+            buffers (list): Bytes-like objects with the next samples of the device, in order
+        """
+        nbytes = sum(len(buffer) for buffer in buffers)
+        if nbytes and self.is_listening():
+            start = self.first_sample_time() if self.first_sample_time is not None else None
+            chunk_time = start + self.frames / self.sample_rate if start is not None else math.nan
+            # The buffers are ring buffer slots that are reused after this call, so the chunk is a copy
+            self.publish(pack_chunk(self.device_index, self.channels, self.sample_width, self.sample_rate,
+                                    self.sequence, self.frames, chunk_time, b"".join(buffers)))
+            self.sequence += 1
+            self.bytes_streamed += nbytes
+        self.frames += nbytes // self.frame_bytes
+
+    def run(self, ring_buffer, is_running):
+        """
+        Stream periods from the ring buffer until `is_running` returns False and the ring
+        buffer is empty, without writing them anywhere else.
+
+        Args:
+            ring_buffer (RingBuffer): Ring buffer filled by the capture thread
+            is_running (callable): Returns True while new periods may still arrive
+        """
+        batch_periods = max(1, int(self.interval * self.sample_rate * self.frame_bytes) // ring_buffer.slot_bytes)
+        while True:
+            running = is_running()
+            if running and not ring_buffer.wait(timeout=self.interval, min_periods=batch_periods):
+                continue
+
+            periods = ring_buffer.peek()
+            if periods:
+                try:
+                    self.update(periods)
+                except Exception as e:
+                    print(f"Error streaming Udev{self.device_index}: {e}")
+                ring_buffer.advance(len(periods))
+            elif not running:
+                break
+
+    def close(self):
+        pass
+
+    def latency_report(self) -> str:
+        """
+        Returns:
+            str: Chunks and data streamed
+        """
+        return f"{self.sequence} chunks, {self.bytes_streamed/1024/1024:.1f} MB streamed of {self.frames} frames"
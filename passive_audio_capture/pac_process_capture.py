@@ -0,0 +1,503 @@
+import math
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from functools import partial
+from multiprocessing import shared_memory
+from threading import BrokenBarrierError
+from audio_capture import AudioCapture, SAMPLE_RATE, CHANNELS, SAMPLE_WIDTH, PERIOD_SIZE
+from pac_capture_manager import DEVICES, LOCAL_STORAGE_PATH, RING_BUFFER_PERIODS, CaptureManager, recording_path, build_file_metadata, spectral_summary_factory
+from pac_device_pool import DevicePool
+from pac_file_index import RecordingIndex
+from pac_metrics import CaptureMetrics
+from pac_ring_buffer import RingBuffer
+from pac_stream_writer import StreamWriter
+from pac_trigger import TriggeredWriter, event_path
+
+
+# Seconds to wait for a capture or writer process to answer before giving up on it
+PROCESS_TIMEOUT = 10.0
+
+# Indices into the shared capture state of a device
+_FIRST_SAMPLE_TIME = 0
+_HTIMESTAMP = 1
+_OVERRUNS = 2
+_CAPTURE_STATE_SIZE = 3
+
+
+def _attach_ring_buffer(name: str, slots: int, slot_bytes: int, data_ready) -> tuple:
+    """
+    Lay a ring buffer over the shared memory block created by the ProcessCaptureManager.
+
+    Returns:
+        tuple: (SharedMemory, RingBuffer); keep the SharedMemory referenced while the ring buffer is used
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, RingBuffer(slots, slot_bytes, buffer=shm.buf, data_ready=data_ready)
+
+
+def _attach_metrics(name: str, device_index: int) -> tuple:
+    """
+    Lay the counters of a device over the shared memory block created by the ProcessCaptureManager.
+
+    Returns:
+        tuple: (SharedMemory, CaptureMetrics); keep the SharedMemory referenced while the counters are used
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    size = CaptureMetrics.required_bytes()
+    return shm, CaptureMetrics(buffer=shm.buf[device_index * size:(device_index + 1) * size])
+
+
+def _capture_process(device_index: int, device: str, capture_factory, ring_spec: tuple, commands, results,
+                     barrier, stop_event, capture_done, capture_state, metrics_name: str):
+    """
+    Main loop of a capture process: keeps one device open and captures into its shared ring buffer.
+
+    Every command is a tuple (runtime,), with runtime None for continuous capture; None
+    instead of a command ends the process. The process waits at the start barrier even if its device
+    could not be opened, so the other devices still start on time.
+    """
+    shm, ring_buffer = _attach_ring_buffer(*ring_spec)
+    metrics_shm, metrics = _attach_metrics(metrics_name, device_index)
+    device_pool = DevicePool([device], capture_factory=capture_factory)
+    results.put(("ready", device_index))
+
+    def publish(capture: AudioCapture):
+        offset = device_index * _CAPTURE_STATE_SIZE
+        capture_state[offset + _FIRST_SAMPLE_TIME] = capture.first_sample_time if capture.first_sample_time is not None else math.nan
+        capture_state[offset + _HTIMESTAMP] = 1.0 if capture.timestamp_source == "htimestamp" else 0.0
+        capture_state[offset + _OVERRUNS] = capture.overruns
+
+    try:
+        while True:
+            command = commands.get()
+            if command is None:
+                break
+            runtime, = command
+
+            capture = device_pool.acquire(0)
+            results.put(("armed", device_index, capture is not None))
+            report = {"frames": 0, "overruns": 0, "start_latency": None, "cpu_seconds": 0.0}
+            cpu_start = time.process_time()
+            try:
+                if capture is None:
+                    barrier.wait()
+                    continue
+                try:
+                    capture.capture(runtime=runtime, barrier=barrier, ring_buffer=ring_buffer,
+                                    stop_event=stop_event, on_status=publish, metrics=metrics)
+                except Exception as e:
+                    print(f"Error capturing from {device}: {e}")
+                    device_pool.mark_failed(0, e)
+                else:
+                    if capture.first_period_time is not None:
+                        report["start_latency"] = capture.first_period_time - capture.start_time
+                    device_pool.release(0)
+                publish(capture)
+                report.update(frames=capture.frames_captured, overruns=capture.overruns,
+                              cpu_seconds=time.process_time() - cpu_start)
+            except BrokenBarrierError:
+                print(f"Start barrier of {device} broken, skipping this run")
+            finally:
+                # Let the writer flush the rest right away
+                capture_done.set()
+                ring_buffer.wake()
+                results.put(("captured", device_index, report))
+    finally:
+        device_pool.close()
+        del ring_buffer, metrics
+        shm.close()
+        metrics_shm.close()
+
+
+def _writer_process(devices: list[str], storage_path: str, sample_rate: int, channels: int, ring_specs: list[tuple],
+                    capture_done: list, capture_state, commands, results, metrics_name: str, index_path: str = None):
+    """
+    Main loop of the writer process: streams the shared ring buffers of all devices to WAV files,
+    one thread per device, so slow storage never blocks a capture process. With index_path set,
+    the process opens its own connection to the RecordingIndex and adds every finished file.
+
+    Every command is (start_time, segment_seconds, active_devices, triggered, clock_sync); None ends the process.
+    Finished files are reported as ("closed", path), the end of a run as ("written", reports).
+    """
+    shms, ring_buffers = zip(*[_attach_ring_buffer(*ring_spec) for ring_spec in ring_specs])
+    ring_buffers = list(ring_buffers)
+    metrics_shm, metrics = zip(*[_attach_metrics(metrics_name, device_index) for device_index in range(len(devices))])
+    metrics = list(metrics)
+    file_index = RecordingIndex(index_path) if index_path is not None else None
+    results.put(("ready", None))
+
+    def file_metadata(device_index: int, start_time: float, clock_sync: dict, first_frame: int, frames: int) -> dict:
+        offset = device_index * _CAPTURE_STATE_SIZE
+        first_sample_time = capture_state[offset + _FIRST_SAMPLE_TIME]
+        first_sample_time = None if math.isnan(first_sample_time) else first_sample_time
+        timestamp_source = None
+        if first_sample_time is not None:
+            timestamp_source = "htimestamp" if capture_state[offset + _HTIMESTAMP] else "clock"
+        return build_file_metadata(devices[device_index], device_index, sample_rate, start_time, first_frame, frames,
+                                   first_sample_time, timestamp_source, int(capture_state[offset + _OVERRUNS]),
+                                   ring_buffers[device_index].dropped_periods, clock_sync)
+
+    def write(device_index: int, start_time: float, segment_seconds: int, triggered: bool, clock_sync: dict, reports: dict):
+        cpu_start = time.thread_time()
+        segment_frames = int(segment_seconds * sample_rate) if segment_seconds else None
+        writer_class, path_function = (TriggeredWriter, event_path) if triggered else (StreamWriter, recording_path)
+        try:
+            writer = writer_class(partial(path_function, storage_path, start_time, sample_rate, device_index),
+                                  sample_rate, channels, SAMPLE_WIDTH, segment_frames=segment_frames,
+                                  on_file_closed=lambda path: results.put(("closed", path)),
+                                  metadata_factory=partial(file_metadata, device_index, start_time, clock_sync),
+                                  analyzer_factory=spectral_summary_factory(sample_rate, channels),
+                                  file_index=file_index, metrics=metrics[device_index])
+        except OSError as e:
+            print(f"Error opening WAV file for Udev{device_index}: {e}")
+            # Keep draining, so the capture process never blocks on a full ring buffer
+            writer = None
+        ring_buffer = ring_buffers[device_index]
+        try:
+            if writer is not None:
+                writer.run(ring_buffer, lambda: not capture_done[device_index].is_set())
+            else:
+                while not capture_done[device_index].wait(0.1):
+                    ring_buffer.advance(len(ring_buffer))
+        finally:
+            if writer is not None:
+                writer.close()
+                reports[device_index] = {"bytes_written": writer.bytes_written,
+                                         "latency_p99": writer.latency.percentile(99),
+                                         "latency_report": writer.latency_report(),
+                                         "cpu_seconds": time.thread_time() - cpu_start}
+
+    try:
+        while True:
+            command = commands.get()
+            if command is None:
+                break
+            start_time, segment_seconds, active_devices, triggered, clock_sync = command
+
+            reports = {}
+            threads = [threading.Thread(target=write, args=(i, start_time, segment_seconds, triggered, clock_sync, reports))
+                       for i in active_devices]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            results.put(("written", reports))
+    finally:
+        if file_index is not None:
+            file_index.close()
+        ring_buffers.clear()
+        metrics.clear()
+        for shm in shms + metrics_shm:
+            shm.close()
+
+
+class ProcessCaptureManager:
+    """
+    Captures every device in its own process and writes all devices from a separate writer
+    process, so no device read ever waits for the GIL held by a write, a status update or
+    another device.
+
+    Periods are handed from the capture processes to the writer process through one
+    RingBuffer per device in multiprocessing.shared_memory. The processes are started once
+    and keep their devices open across runs; every run starts all devices at the same
+    barrier as the CaptureManager does. Has the interface of the CaptureManager, plus
+    `shutdown` to end the processes.
+
+    Attributes:
+        runtime (float): Duration of capture in seconds (default: 15.0), None for continuous capture
+    """
+
+    def __init__(self, runtime=15.0, devices: list[str] = DEVICES, capture_factory=None,
+                 storage_path: str = LOCAL_STORAGE_PATH, sample_rate: int = SAMPLE_RATE,
+                 channels: int = CHANNELS, period_size: int = PERIOD_SIZE, index_path: str = None):
+        """
+        Start the capture and writer processes.
+
+        Args:
+            runtime (float): Duration of capture in seconds (default: 15.0)
+            devices (list[str]): ALSA device identifiers
+            capture_factory (callable, optional): Picklable callable that builds an AudioCapture
+                                                  for a device identifier (default: AudioCapture)
+            storage_path (str): Directory the recordings are written to
+            sample_rate (int): Sample rate of the devices in Hz (default: 256000)
+            channels (int): Channels per device (default: 1)
+            period_size (int): Frames per ALSA period (default: 4096)
+            index_path (str, optional): RecordingIndex database the writer process adds every finished file to
+        """
+        self.devices = devices
+        self.number_of_devices = len(devices)
+        self.storage_path = storage_path
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.period_size = period_size
+        if capture_factory is None:
+            capture_factory = partial(AudioCapture, rate=sample_rate, channels=channels, period_size=period_size)
+        os.makedirs(self.storage_path, exist_ok=True)
+
+        self.runtime = runtime
+        self.start_time = None
+        # Unix time the last start had all devices armed and only waited for the start time
+        self.armed_at = None
+        self.active_devices: list[int] = []
+        self.capture_reports: list[dict] = [None] * self.number_of_devices
+        self.writer_reports: list[dict] = [None] * self.number_of_devices
+        self.recorded_files: list[str] = []
+        self.on_file_closed = None
+        self.running = False
+        self.capture_complete = False
+
+        # spawn: never fork the controller while threads are running
+        context = multiprocessing.get_context("spawn")
+        slot_bytes = period_size * channels * SAMPLE_WIDTH
+        self.shared_memory = []
+        self.ring_buffers: list[RingBuffer] = []
+        ring_specs = []
+        for _ in devices:
+            shm = shared_memory.SharedMemory(create=True, size=RingBuffer.required_bytes(RING_BUFFER_PERIODS, slot_bytes))
+            data_ready = context.Event()
+            self.shared_memory.append(shm)
+            self.ring_buffers.append(RingBuffer(RING_BUFFER_PERIODS, slot_bytes, buffer=shm.buf, data_ready=data_ready))
+            self.ring_buffers[-1].reset()
+            ring_specs.append((shm.name, RING_BUFFER_PERIODS, slot_bytes, data_ready))
+
+        # The counters of all devices share one block; the processes update them, status() reads them
+        metrics_bytes = CaptureMetrics.required_bytes()
+        metrics_shm = shared_memory.SharedMemory(create=True, size=metrics_bytes * self.number_of_devices)
+        self.shared_memory.append(metrics_shm)
+        self.metrics = [CaptureMetrics(buffer=metrics_shm.buf[i * metrics_bytes:(i + 1) * metrics_bytes]) for i in range(self.number_of_devices)]
+        for metrics in self.metrics:
+            metrics.reset()
+
+        self.startup_sync_barrier = context.Barrier(self.number_of_devices + 1)
+        self.stop_event = context.Event()
+        self.capture_done = [context.Event() for _ in devices]
+        self.capture_state = context.Array("d", self.number_of_devices * _CAPTURE_STATE_SIZE, lock=False)
+        self.results = context.Queue()
+        self.capture_commands = [context.Queue() for _ in devices]
+        self.writer_commands = context.Queue()
+
+        self.capture_processes = [
+            context.Process(target=_capture_process, name=f"pac-capture-{i}", daemon=True,
+                            args=(i, device, capture_factory, ring_specs[i], self.capture_commands[i], self.results,
+                                  self.startup_sync_barrier, self.stop_event, self.capture_done[i], self.capture_state,
+                                  metrics_shm.name))
+            for i, device in enumerate(devices)]
+        self.writer_process = context.Process(target=_writer_process, name="pac-writer", daemon=True,
+                                              args=(devices, storage_path, sample_rate, channels, ring_specs,
+                                                    self.capture_done, self.capture_state, self.writer_commands, self.results,
+                                                    metrics_shm.name, index_path))
+        for process in self.capture_processes:
+            process.start()
+        self.writer_process.start()
+
+        # Messages of the processes are dispatched by a thread, so files are reported as they close
+        self.ready = queue.Queue()
+        self.armed = queue.Queue()
+        self.captured = queue.Queue()
+        self.written = queue.Queue()
+        self.result_thread = threading.Thread(target=self.dispatch_results, daemon=True)
+        self.result_thread.start()
+
+        # Wait until every process has started and opened its device
+        for _ in range(self.number_of_devices + 1):
+            self.ready.get(timeout=PROCESS_TIMEOUT)
+
+    def reset(self):
+        """
+        Clear the state of the previous run. The processes and their devices stay up.
+        """
+        if self.running:
+            raise RuntimeError("Cannot reset while a capture is running")
+        self.active_devices = []
+        self.capture_reports = [None] * self.number_of_devices
+        self.writer_reports = [None] * self.number_of_devices
+        self.recorded_files = []
+        self.on_file_closed = None
+        self.capture_complete = False
+
+    def dispatch_results(self):
+        while True:
+            message = self.results.get()
+            if message is None:
+                return
+            kind = message[0]
+            if kind == "closed":
+                self._file_closed(message[1])
+            elif kind == "ready":
+                self.ready.put(message[1])
+            elif kind == "armed":
+                self.armed.put(message[1:])
+            elif kind == "captured":
+                self.captured.put(message[1:])
+            elif kind == "written":
+                self.written.put(message[1])
+
+    def _file_closed(self, path: str):
+        self.recorded_files.append(path)
+        if self.on_file_closed is not None:
+            self.on_file_closed(path)
+
+    def is_capture_complete(self):
+        return self.capture_complete
+
+    def is_capture_running(self):
+        return self.running
+
+    def get_recorded_files(self) -> list[str]:
+        """
+        Returns:
+            list[str]: Paths of the WAV files finished during the last capture
+        """
+        return list(self.recorded_files)
+
+    def start(self, runtime: int, start_time: int, segment_seconds: int = None, on_file_closed=None, triggered: bool = False,
+              clock_sync: dict = None):
+        """
+        Arms all capture processes and releases them together at the start time.
+
+        Args:
+            runtime (float): Duration of capture in seconds, None to capture until `stop` is called
+            start_time (float): Unix timestamp at which all devices start capturing
+            segment_seconds (int, optional): Rotate the output files every segment_seconds seconds
+            on_file_closed (callable, optional): Called with the path of every finished WAV file
+            triggered (bool): Only write the audio around detected events; segment_seconds then
+                              is the maximum length of an event file
+            clock_sync (dict, optional): Clock offset to the controller and its uncertainty, stored in every file
+        """
+        self.runtime = runtime
+        self.start_time = start_time
+        self.on_file_closed = on_file_closed
+        self.capture_complete = False
+
+        for ring_buffer in self.ring_buffers:
+            ring_buffer.reset()
+        for metrics in self.metrics:
+            metrics.reset()
+        self.capture_state[:] = [math.nan, 0.0, 0.0] * self.number_of_devices
+        self.stop_event.clear()
+        for capture_done in self.capture_done:
+            capture_done.clear()
+        if self.startup_sync_barrier.broken:
+            self.startup_sync_barrier.reset()
+
+        # Every capture process reports whether its device is armed, then waits at the barrier
+        for commands in self.capture_commands:
+            commands.put((runtime,))
+        armed = [False] * self.number_of_devices
+        for _ in range(self.number_of_devices):
+            device_index, ok = self.armed.get(timeout=PROCESS_TIMEOUT)
+            armed[device_index] = ok
+        self.active_devices = [i for i, ok in enumerate(armed) if ok]
+
+        self.running = True
+        if not self.active_devices:
+            # Release the idle processes before giving up
+            self.startup_sync_barrier.wait(timeout=PROCESS_TIMEOUT)
+            self.stop()
+            raise RuntimeError("No capture devices available")
+        self.writer_commands.put((start_time, segment_seconds, self.active_devices, triggered, clock_sync))
+
+        # Wait until the start time and release all capture processes at once
+        self.armed_at = time.time()
+        CaptureManager.wait_until(self.start_time)
+        self.startup_sync_barrier.wait(timeout=PROCESS_TIMEOUT)
+
+    def stop(self, early: bool = False):
+        """
+        Stops the run. The WAV files are finalized by the writer process, so they are
+        complete once this returns.
+
+        A capture with a runtime is not cut short unless early is set: the capture processes
+        stop by themselves after exactly runtime * rate frames. A continuous capture is
+        stopped right away.
+
+        Args:
+            early (bool): Also stop a capture with a runtime right away, e.g. on a stop command
+        """
+        if not self.running:
+            return
+        if self.runtime is None or early:
+            self.stop_event.set()
+
+        for _ in range(self.number_of_devices):
+            result = self._get_result(self.captured, self.capture_processes)
+            if result is None:
+                break
+            device_index, report = result
+            self.capture_reports[device_index] = report
+        if self.active_devices:
+            reports = self._get_result(self.written, [self.writer_process])
+            for device_index, report in (reports or {}).items():
+                self.writer_reports[device_index] = report
+        self.running = False
+
+        for device_index, ring_buffer in enumerate(self.ring_buffers):
+            stats = ring_buffer.stats()
+            print(f"Udev{device_index}: ring buffer high-water mark {stats['high_water_mark']}/{stats['slots']} periods, {stats['dropped_periods']} periods dropped")
+            if self.writer_reports[device_index] is not None:
+                print(f"Udev{device_index}: {self.writer_reports[device_index]['latency_report']}")
+            start_latency = (self.capture_reports[device_index] or {}).get("start_latency")
+            if start_latency is not None:
+                print(f"Udev{device_index}: start latency {start_latency*1000:.1f} ms")
+
+        self.capture_complete = True
+
+    def status(self) -> list[dict]:
+        """
+        Snapshot of the counters of every device, read straight from shared memory.
+
+        Returns:
+            list[dict]: Per device its identifier, whether it is capturing, and its counters
+        """
+        return [dict(device=device, active=device_index in self.active_devices,
+                     **self.metrics[device_index].snapshot(self.ring_buffers[device_index]))
+                for device_index, device in enumerate(self.devices)]
+
+    def _get_result(self, results: queue.Queue, processes: list):
+        """
+        Wait for a result, but give up once one of the processes that should send it died.
+
+        Returns:
+            The result, None if a process died
+        """
+        while True:
+            try:
+                return results.get(timeout=1.0)
+            except queue.Empty:
+                dead = [process.name for process in processes if not process.is_alive()]
+                if dead:
+                    print(f"Error: {', '.join(dead)} exited unexpectedly")
+                    return None
+
+    def shutdown(self):
+        """
+        Stop a running capture, end all processes and release the shared memory.
+        """
+        if self.running:
+            self.runtime = None
+            self.stop()
+        for commands in self.capture_commands:
+            commands.put(None)
+        self.writer_commands.put(None)
+        for process in self.capture_processes + [self.writer_process]:
+            process.join(PROCESS_TIMEOUT)
+            if process.is_alive():
+                print(f"Error: {process.name} did not exit, terminating it")
+                process.terminate()
+                process.join()
+        self.results.put(None)
+        self.result_thread.join()
+
+        self.ring_buffers.clear()
+        self.metrics = []
+        for shm in self.shared_memory:
+            shm.unlink()
+            try:
+                shm.close()
+            except BufferError:
+                # A view is still referenced somewhere; the mapping goes away with the process
+                pass
+        self.shared_memory = []
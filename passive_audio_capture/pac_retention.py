@@ -0,0 +1,148 @@
+import logging
+import os
+import shutil
+import threading
+from pac_file_index import RecordingIndex
+from pac_spectral_summary import spectral_sidecar_path
+
+
+# Start evicting recordings when less than this many bytes are free
+RETENTION_LOW_FREE_BYTES = 2 * 1024 ** 3
+
+# Once evicting, keep going until this many bytes are free
+RETENTION_TARGET_FREE_BYTES = 4 * 1024 ** 3
+
+# Never let a capture fill the card beyond this; the OS, logs and the index need room too
+RETENTION_RESERVE_BYTES = 512 * 1024 ** 2
+
+# Only evict recordings that were not fetched yet when fetched ones do not free enough space
+RETENTION_EVICT_UNFETCHED = True
+
+# Recordings evicted per index query
+_EVICTION_BATCH = 100
+
+
+class RetentionManager:
+    """
+    Keeps the storage directory from filling up, by evicting recordings only when free space
+    runs low.
+
+    Files fetched by the controller go first, oldest first; recordings that were never
+    fetched are only evicted, again oldest first, if evicting the fetched ones is not
+    enough. Before a capture starts (and periodically during a continuous capture) the
+    manager checks that the capture fits, so a run is refused or stopped instead of running
+    into a full card.
+    """
+
+    def __init__(self, directory: str, file_index: RecordingIndex, low_free_bytes: int = RETENTION_LOW_FREE_BYTES,
+                 target_free_bytes: int = RETENTION_TARGET_FREE_BYTES, reserve_bytes: int = RETENTION_RESERVE_BYTES,
+                 evict_unfetched: bool = RETENTION_EVICT_UNFETCHED):
+        """
+        Args:
+            directory (str): Storage directory of the recordings
+            file_index (RecordingIndex): Index of the directory
+            low_free_bytes (int): Free space below which recordings are evicted
+            target_free_bytes (int): Free space to evict up to
+            reserve_bytes (int): Free space a capture must leave untouched
+            evict_unfetched (bool): Also evict recordings that were never fetched
+        """
+        self.directory = directory
+        self.file_index = file_index
+        self.low_free_bytes = low_free_bytes
+        self.target_free_bytes = target_free_bytes
+        self.reserve_bytes = reserve_bytes
+        self.evict_unfetched = evict_unfetched
+        self.logger = logging.getLogger(__name__)
+
+        self.lock = threading.Lock()
+        self.evicted_files = 0
+        self.evicted_bytes = 0
+
+    def free_bytes(self) -> int:
+        return shutil.disk_usage(self.directory).free
+
+    def enforce(self) -> int:
+        """
+        Evict recordings if free space is below the low-water mark, until it reaches the target.
+
+        Returns:
+            int: Number of bytes freed
+        """
+        if self.free_bytes() >= self.low_free_bytes:
+            return 0
+        return self.evict(self.target_free_bytes)
+
+    def evict(self, free_bytes: int) -> int:
+        """
+        Evict recordings in eviction order until free_bytes are free or nothing evictable is left.
+
+        Args:
+            free_bytes (int): Free space to reach in bytes
+
+        Returns:
+            int: Number of bytes freed
+        """
+        freed = 0
+        with self.lock:
+            while self.free_bytes() < free_bytes:
+                entries = self.file_index.eviction_order(_EVICTION_BATCH)
+                if not self.evict_unfetched:
+                    entries = [entry for entry in entries if entry["fetched"]]
+                if not entries:
+                    break
+
+                evicted = []
+                for entry in entries:
+                    if self.free_bytes() >= free_bytes:
+                        break
+                    freed += self._remove(entry)
+                    evicted.append(entry["name"])
+                self.file_index.remove(evicted)
+                self.evicted_files += len(evicted)
+
+        if freed:
+            self.logger.info(f"[INFO] Evicted recordings to free {freed/1024/1024:.0f} MB, "
+                             f"{self.free_bytes()/1024/1024:.0f} MB free")
+        return freed
+
+    def _remove(self, entry: dict) -> int:
+        freed = 0
+        file_path = os.path.join(self.directory, entry["name"])
+        for path in (file_path, spectral_sidecar_path(file_path)):
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+                freed += size
+            except FileNotFoundError:
+                # Already fetched and deleted by the controller
+                pass
+            except OSError as e:
+                self.logger.error(f"[ERROR] Error evicting {path}: {e}")
+        if freed:
+            state = "fetched" if entry["fetched"] else "unfetched"
+            self.logger.info(f"[INFO] Evicted {state} recording {entry['name']} ({freed/1024/1024:.1f} MB)")
+        self.evicted_bytes += freed
+        return freed
+
+    def ensure_space(self, required_bytes: int) -> bool:
+        """
+        Make room for required_bytes of new recordings plus the reserve, evicting if needed.
+
+        Args:
+            required_bytes (int): Bytes a capture is about to write
+
+        Returns:
+            bool: True if the capture fits
+        """
+        self.enforce()
+        needed = required_bytes + self.reserve_bytes
+        free = self.free_bytes()
+        # Only evict if that can actually make the capture fit
+        if free < needed and free + self.file_index.total_size(fetched_only=not self.evict_unfetched) >= needed:
+            self.evict(needed)
+            free = self.free_bytes()
+        if free < needed:
+            self.logger.error(f"[ERROR] Not enough storage: {required_bytes/1024/1024:.0f} MB needed, "
+                              f"{(free - self.reserve_bytes)/1024/1024:.0f} MB available")
+            return False
+        return True
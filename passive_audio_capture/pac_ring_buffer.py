@@ -0,0 +1,201 @@
+import threading
+import numpy as np
+
+
+class RingBuffer:
+    """
+    A preallocated, fixed-size ring buffer holding ALSA periods of a single capture device.
+
+    Every slot holds exactly one period. The capture thread is the only producer and the
+    dump thread the only consumer, so periods are handed over without allocating: the
+    producer copies each period into its slot and the consumer gets zero-copy memoryview
+    slices into the backing NumPy array. When the consumer falls behind (e.g. the SD card
+    stalls) new periods are dropped and counted instead of letting memory grow.
+
+    The buffer can also live in memory provided by the caller, e.g. a
+    multiprocessing.shared_memory block, with producer and consumer in different processes.
+    All counters live in that memory as well; pass a multiprocessing.Event as data_ready
+    so the consumer can block across processes.
+
+    Attributes:
+        slots (int): Number of periods the buffer can hold
+        slot_bytes (int): Size of a single slot in bytes (one full period)
+    """
+
+    # Indices into the state array
+    _WRITE_COUNT = 0
+    _READ_COUNT = 1
+    _DROPPED = 2
+    _HIGH_WATER = 3
+    _WAKE_FILL = 4
+    _STATE_SIZE = 8
+
+    def __init__(self, slots: int, slot_bytes: int, buffer=None, data_ready=None):
+        """
+        Allocate the ring buffer, or lay it out over an existing buffer.
+
+        Args:
+            slots (int): Number of periods the buffer can hold
+            slot_bytes (int): Size of a single period in bytes
+            buffer (buffer, optional): Memory of at least required_bytes(slots, slot_bytes) bytes
+                                       to use instead of allocating; its contents are kept
+            data_ready (Event, optional): Event used to wake the consumer (default: threading.Event)
+        """
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+
+        if buffer is None:
+            buffer = bytearray(self.required_bytes(slots, slot_bytes))
+            self._state = np.frombuffer(buffer, dtype=np.int64, count=self._STATE_SIZE)
+            self._state[self._WAKE_FILL] = 1
+        else:
+            self._state = np.frombuffer(buffer, dtype=np.int64, count=self._STATE_SIZE)
+        offset = self._STATE_SIZE * 8
+        self._lengths = np.frombuffer(buffer, dtype=np.int64, count=slots, offset=offset)
+        offset += slots * 8
+        self._data = np.frombuffer(buffer, dtype=np.uint8, count=slots * slot_bytes, offset=offset).reshape(slots, slot_bytes)
+        self._view = memoryview(self._data).cast("B")
+
+        self._data_ready = data_ready if data_ready is not None else threading.Event()
+
+    @staticmethod
+    def required_bytes(slots: int, slot_bytes: int) -> int:
+        """
+        Returns:
+            int: Size of the memory a ring buffer of this shape needs
+        """
+        return (RingBuffer._STATE_SIZE + slots) * 8 + slots * slot_bytes
+
+    def reset(self):
+        """
+        Empty the buffer and clear its counters. Only call while nobody produces or consumes.
+        """
+        self._state[:] = 0
+        self._state[self._WAKE_FILL] = 1
+        self._data_ready.clear()
+
+    @property
+    def write_count(self) -> int:
+        return int(self._state[self._WRITE_COUNT])
+
+    @property
+    def read_count(self) -> int:
+        return int(self._state[self._READ_COUNT])
+
+    @property
+    def dropped_periods(self) -> int:
+        return int(self._state[self._DROPPED])
+
+    @property
+    def high_water_mark(self) -> int:
+        return int(self._state[self._HIGH_WATER])
+
+    def __len__(self) -> int:
+        return self.write_count - self.read_count
+
+    def put(self, data) -> bool:
+        """
+        Copy one period into the next free slot (producer side).
+
+        Args:
+            data (bytes-like): Period as returned by the ALSA device
+
+        Returns:
+            bool: False if the buffer was full and the period was dropped
+        """
+        nbytes = len(data)
+        if nbytes > self.slot_bytes:
+            raise ValueError(f"Period of {nbytes} bytes does not fit in a {self.slot_bytes} byte slot")
+
+        write_count = self.write_count
+        fill = write_count - self.read_count
+        if fill >= self.slots:
+            self._state[self._DROPPED] += 1
+            return False
+
+        slot = write_count % self.slots
+        start = slot * self.slot_bytes
+        self._view[start:start + nbytes] = data
+        self._lengths[slot] = nbytes
+
+        # Publish the slot only after it has been filled
+        self._state[self._WRITE_COUNT] = write_count + 1
+        if fill + 1 > self._state[self._HIGH_WATER]:
+            self._state[self._HIGH_WATER] = fill + 1
+
+        # Only wake the consumer once it has enough periods to work with
+        if fill + 1 >= self._state[self._WAKE_FILL]:
+            self._data_ready.set()
+        return True
+
+    def wait(self, timeout: float = None, min_periods: int = 1) -> bool:
+        """
+        Block until at least `min_periods` periods are available (consumer side).
+
+        Args:
+            timeout (float, optional): Maximum time to wait in seconds
+            min_periods (int): Number of periods to wait for. Defaults to 1.
+
+        Returns:
+            bool: True if at least one period is available
+        """
+        min_periods = min(min_periods, self.slots)
+        if len(self) >= min_periods:
+            return True
+        self._state[self._WAKE_FILL] = min_periods
+        self._data_ready.clear()
+        # Re-check to avoid missing a put between the first check and clear()
+        if len(self) < min_periods:
+            self._data_ready.wait(timeout)
+        return len(self) > 0
+
+    def wake(self):
+        """
+        Wake up a waiting consumer, e.g. because the producer finished.
+        """
+        self._data_ready.set()
+
+    def peek(self, max_periods: int = None) -> list[memoryview]:
+        """
+        Return zero-copy views of the oldest unread periods (consumer side).
+
+        The views stay valid until `advance` releases the slots.
+
+        Args:
+            max_periods (int, optional): Maximum number of periods to return
+
+        Returns:
+            list[memoryview]: One view per period, oldest first
+        """
+        read_count = self.read_count
+        available = self.write_count - read_count
+        if max_periods is not None:
+            available = min(available, max_periods)
+
+        views = []
+        for i in range(read_count, read_count + available):
+            slot = i % self.slots
+            start = slot * self.slot_bytes
+            views.append(self._view[start:start + int(self._lengths[slot])])
+        return views
+
+    def advance(self, periods: int):
+        """
+        Release periods previously returned by `peek` (consumer side).
+
+        Args:
+            periods (int): Number of periods to release
+        """
+        self._state[self._READ_COUNT] = self.read_count + periods
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: Current fill, high-water mark and dropped periods
+        """
+        return {
+            "fill": len(self),
+            "slots": self.slots,
+            "high_water_mark": self.high_water_mark,
+            "dropped_periods": self.dropped_periods,
+        }
@@ -0,0 +1,189 @@
+import json
+import os
+import numpy as np
+
+
+# Samples per FFT frame; frames do not overlap
+SPECTRAL_FFT_SIZE = 1024
+
+# Frequency bins of the decimated spectrogram, evenly spaced from 0 Hz to Nyquist
+SPECTRAL_BINS = 128
+
+# Duration of a single spectrogram row in seconds
+SPECTRAL_ROW_SECONDS = 1.0
+
+# Frequency bands (Hz) for which the energy is tracked per row
+SPECTRAL_BANDS = [(0, 20000), (20000, 50000), (50000, 80000), (80000, 128000)]
+
+# Suffix of the sidecar file written next to every recording
+SPECTRAL_SIDECAR_SUFFIX = ".spectral.npz"
+
+# Power floor added before converting to dB, so silence does not turn into -inf
+_POWER_FLOOR = 1e-12
+
+
+def spectral_sidecar_path(recording_path: str) -> str:
+    """
+    Returns:
+        str: Path of the sidecar of a recording; the same for its WAV and FLAC version
+    """
+    return os.path.splitext(recording_path)[0] + SPECTRAL_SIDECAR_SUFFIX
+
+
+class SpectralSummary:
+    """
+    Computes a compact spectral summary of a recording while it is being written.
+
+    Samples are cut into non-overlapping Hann windowed frames, which are transformed all at
+    once with a single vectorised FFT per batch. The power spectra are averaged over rows of
+    SPECTRAL_ROW_SECONDS, giving per row a decimated spectrogram of SPECTRAL_BINS bins, the
+    energy in each of SPECTRAL_BANDS and the peak sample. One minute of audio at 256 kHz
+    (30 MB) is summarised in about 20 KB.
+
+    The summary is fed the same buffers as the WAV file (`update`) and written as a `.npz`
+    sidecar next to it (`close`).
+    """
+
+    def __init__(self, path: str, sample_rate: int, channels: int = 1, fft_size: int = SPECTRAL_FFT_SIZE,
+                 bins: int = SPECTRAL_BINS, row_seconds: float = SPECTRAL_ROW_SECONDS, bands: list = SPECTRAL_BANDS):
+        """
+        Args:
+            path (str): Path of the recording the summary belongs to
+            sample_rate (int): Sample rate in Hz
+            channels (int): Number of interleaved channels; their power is summed
+            fft_size (int): Samples per FFT frame
+            bins (int): Frequency bins of the spectrogram
+            row_seconds (float): Duration of a spectrogram row in seconds
+            bands (list): (low, high) frequency bands in Hz
+        """
+        self.path = spectral_sidecar_path(path)
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.fft_size = fft_size
+        self.row_seconds = row_seconds
+        self.frames_per_row = max(1, round(sample_rate * row_seconds / fft_size))
+        self.bands = np.array(bands, dtype=np.float64).reshape(-1, 2)
+
+        self.window = np.hanning(fft_size).astype(np.float32)
+        # Scale so a full scale sine reads 0 dB in its FFT bin
+        self.scale = 4.0 / (np.sum(self.window) ** 2 * 32768.0 ** 2)
+
+        frequencies = np.fft.rfftfreq(fft_size, 1.0 / sample_rate)
+        # The spectrogram bins group the FFT bins below Nyquist in equal parts
+        fft_bins = fft_size // 2
+        bins = min(bins, fft_bins)
+        self.bin_starts = np.linspace(0, fft_bins, bins, endpoint=False).astype(np.int64)
+        self.bin_sizes = np.diff(np.append(self.bin_starts, fft_bins))
+        self.bin_frequencies = frequencies[self.bin_starts] + (self.bin_sizes * sample_rate / fft_size) / 2
+        # One row of weights per band, so all band energies are a single matrix product
+        self.band_weights = ((frequencies >= self.bands[:, :1]) & (frequencies < self.bands[:, 1:])).astype(np.float64)
+
+        self._pending = np.zeros(0, dtype=np.int16)
+        self._row_power = np.zeros(len(frequencies))
+        self._row_frames = 0
+        self._row_peak = 0
+
+        self.spectrogram: list[np.ndarray] = []
+        self.band_energy: list[np.ndarray] = []
+        self.peaks: list[int] = []
+        self.row_frames: list[int] = []
+
+    def update(self, buffers: list):
+        """
+        Add a batch of sample data.
+
+        Args:
+            buffers (list): Bytes-like objects with interleaved 16-bit samples, in order
+        """
+        if not buffers:
+            return
+        chunks = [self._pending] + [np.frombuffer(buffer, dtype="<i2") for buffer in buffers]
+        samples = np.concatenate(chunks)
+
+        frame_samples = self.fft_size * self.channels
+        usable = len(samples) - len(samples) % frame_samples
+        frames = samples[:usable].reshape(-1, self.fft_size, self.channels)
+        self._pending = samples[usable:].copy()
+
+        while len(frames):
+            take = min(len(frames), self.frames_per_row - self._row_frames)
+            self._add_frames(frames[:take])
+            frames = frames[take:]
+            if self._row_frames == self.frames_per_row:
+                self._finish_row()
+
+    def _add_frames(self, frames: np.ndarray):
+        spectra = np.fft.rfft(frames.astype(np.float32) * self.window[None, :, None], axis=1)
+        self._row_power += np.sum(spectra.real ** 2 + spectra.imag ** 2, axis=(0, 2))
+        self._row_frames += len(frames)
+        self._row_peak = max(self._row_peak, int(np.max(np.abs(frames.astype(np.int32)))))
+
+    def _finish_row(self):
+        power = self._row_power * self.scale / self._row_frames
+        binned = np.add.reduceat(power[:-1], self.bin_starts) / self.bin_sizes
+        self.spectrogram.append(10 * np.log10(binned + _POWER_FLOOR))
+        self.band_energy.append(10 * np.log10(self.band_weights @ power + _POWER_FLOOR))
+        self.peaks.append(self._row_peak)
+        self.row_frames.append(self._row_frames)
+
+        self._row_power[:] = 0
+        self._row_frames = 0
+        self._row_peak = 0
+
+    def close(self):
+        """
+        Finish the last (partial) row and write the sidecar, atomically via a `.part` file.
+        """
+        if self._row_frames:
+            self._finish_row()
+        bins = len(self.bin_starts)
+        part_path = self.path + ".part"
+        with open(part_path, "wb") as f:
+            np.savez_compressed(
+                f,
+                spectrogram=np.array(self.spectrogram, dtype=np.float16).reshape(-1, bins),
+                band_energy=np.array(self.band_energy, dtype=np.float32).reshape(-1, len(self.bands)),
+                peak=np.array(self.peaks, dtype=np.int32),
+                row_frames=np.array(self.row_frames, dtype=np.int32),
+                frequencies=self.bin_frequencies.astype(np.float32),
+                bands=self.bands,
+                sample_rate=self.sample_rate,
+                fft_size=self.fft_size,
+                row_seconds=self.row_seconds,
+            )
+        os.replace(part_path, self.path)
+
+
+def summarize_sidecar(path: str) -> dict:
+    """
+    Condense a sidecar into a few numbers per band, small enough for a single TCP response.
+
+    Args:
+        path (str): Path of the sidecar
+
+    Returns:
+        dict: Number of rows, and per band the mean and max energy (dB) and the row of the max
+    """
+    with np.load(path) as sidecar:
+        band_energy = sidecar["band_energy"].astype(np.float64)
+        peak = sidecar["peak"]
+        summary = {
+            "rows": int(band_energy.shape[0]),
+            "row_seconds": float(sidecar["row_seconds"]),
+            "bands": [[int(low), int(high)] for low, high in sidecar["bands"]],
+            "peak": int(peak.max()) if len(peak) else 0,
+        }
+    if len(band_energy):
+        summary.update({
+            "band_mean_db": np.round(band_energy.mean(axis=0), 1).tolist(),
+            "band_max_db": np.round(band_energy.max(axis=0), 1).tolist(),
+            "band_max_row": band_energy.argmax(axis=0).tolist(),
+        })
+    return summary
+
+
+if __name__ == "__main__":
+    # Print the summary of sidecars, e.g. python pac_spectral_summary.py /path/to/*.spectral.npz
+    import sys
+    for sidecar_path in sys.argv[1:]:
+        print(sidecar_path, json.dumps(summarize_sidecar(sidecar_path)))
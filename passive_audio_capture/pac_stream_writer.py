@@ -0,0 +1,511 @@
+import hashlib
+import json
+import os
+import struct
+import time
+from pac_metrics import CaptureMetrics, LatencyHistogram
+
+
+# Target size of a single coalesced write; periods are 8 KB so writes stay page aligned
+WRITE_BATCH_BYTES = 2 * 1024 * 1024
+
+# Maximum time captured data may sit in the ring buffer before it is written anyway
+MAX_FLUSH_INTERVAL = 1.0
+
+# Maximum number of buffers passed to a single writev call
+IOV_MAX = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") else 1024
+
+# Size of the reserved WAV header; padded with a JUNK chunk so sample data starts page aligned
+WAV_HEADER_BYTES = 4096
+
+# Reserve the full size of a segment when it is created, so continuous writes do not fragment the card
+PREALLOCATE_SEGMENTS = True
+
+# Largest data chunk a RIFF file can describe; longer recordings roll over to a new file
+WAV_MAX_DATA_BYTES = 0xFFFFFFFF - WAV_HEADER_BYTES
+
+
+# Chunk holding the capture metadata (JSON) of a recording
+METADATA_CHUNK_ID = b"pacm"
+
+# Digest size in bytes of the blake2b checksum over the sample data of a recording
+CHECKSUM_DIGEST_BYTES = 16
+
+
+def payload_checksum():
+    """
+    Returns:
+        hashlib.blake2b: An empty checksum of sample data; equal for the WAV and FLAC version of a recording
+    """
+    return hashlib.blake2b(digest_size=CHECKSUM_DIGEST_BYTES)
+
+
+def build_wav_header(sample_rate: int, channels: int, sample_width: int, data_bytes: int, metadata: dict = None) -> bytes:
+    """
+    Build a PCM WAV header of exactly WAV_HEADER_BYTES bytes.
+
+    Layout: RIFF header, fmt chunk, optional metadata chunk, JUNK padding chunk and the
+    data chunk header, so the sample data starts at offset WAV_HEADER_BYTES. Readers skip
+    the metadata and JUNK chunks.
+
+    Args:
+        sample_rate (int): Sample rate in Hz
+        channels (int): Number of channels
+        sample_width (int): Bytes per sample
+        data_bytes (int): Size of the sample data in bytes
+        metadata (dict, optional): Capture metadata, stored as JSON in a "pacm" chunk
+
+    Returns:
+        bytes: The header
+    """
+    block_align = channels * sample_width
+    fmt_chunk = struct.pack("<4sIHHIIHH", b"fmt ", 16, 1, channels, sample_rate,
+                            sample_rate * block_align, block_align, sample_width * 8)
+
+    metadata_chunk = b""
+    if metadata is not None:
+        payload = json.dumps(metadata, separators=(",", ":")).encode()
+        metadata_chunk = struct.pack("<4sI", METADATA_CHUNK_ID, len(payload)) + payload + b" " * (len(payload) % 2)
+
+    junk_bytes = WAV_HEADER_BYTES - 12 - len(fmt_chunk) - len(metadata_chunk) - 8 - 8
+    if junk_bytes < 0:
+        raise ValueError(f"Metadata of {len(metadata_chunk)} bytes does not fit in the WAV header")
+    junk_chunk = struct.pack("<4sI", b"JUNK", junk_bytes) + bytes(junk_bytes)
+    riff_header = struct.pack("<4sI4s", b"RIFF", WAV_HEADER_BYTES - 8 + data_bytes, b"WAVE")
+    data_header = struct.pack("<4sI", b"data", data_bytes)
+    return riff_header + fmt_chunk + metadata_chunk + junk_chunk + data_header
+
+
+def read_wav_metadata(path: str) -> dict:
+    """
+    Read the capture metadata of a WAV file written by StreamWriter.
+
+    Args:
+        path (str): Path of the WAV file
+
+    Returns:
+        dict: The metadata, empty if the file has none
+    """
+    with open(path, "rb") as f:
+        header = f.read(WAV_HEADER_BYTES)
+    offset = 12
+    while offset + 8 <= len(header):
+        chunk_id, chunk_size = struct.unpack_from("<4sI", header, offset)
+        if chunk_id == METADATA_CHUNK_ID:
+            return json.loads(header[offset + 8:offset + 8 + chunk_size])
+        if chunk_id == b"data":
+            break
+        offset += 8 + chunk_size + chunk_size % 2
+    return {}
+
+
+class WavFile:
+    """
+    A WAV file that is written incrementally.
+
+    The WAV header is written up front with empty sizes and patched on close, so the file
+    is valid the moment it is closed and memory use does not depend on its length. While
+    open, data goes to `<path>.part`, which is renamed to `path` once the header is final.
+
+    Attributes:
+        path (str): Path of the finished WAV file
+        bytes_written (int): Number of sample bytes written
+        checksum (str): Hex digest of the sample data once closed, None if not computed
+    """
+
+    def __init__(self, path: str, sample_rate: int, channels: int = 1, sample_width: int = 2,
+                 latency: LatencyHistogram = None, checksum: bool = False, preallocate_bytes: int = 0):
+        """
+        Create the file and reserve its WAV header.
+
+        Args:
+            path (str): Path of the finished WAV file
+            sample_rate (int): Sample rate in Hz
+            channels (int): Number of channels (default: 1)
+            sample_width (int): Bytes per sample (default: 2)
+            latency (LatencyHistogram, optional): Histogram to record write latencies in
+            checksum (bool): Compute a checksum of the sample data while writing
+            preallocate_bytes (int): Sample bytes to reserve on disk up front; unused space is released on close
+        """
+        self.path = path
+        self.part_path = f"{path}.part"
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.latency = latency
+        self.hash = payload_checksum() if checksum else None
+        self.checksum = None
+
+        self.bytes_written = 0
+        self.preallocated = False
+        self.fd = os.open(self.part_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.write(self.fd, build_wav_header(sample_rate, channels, sample_width, 0))
+        if preallocate_bytes > 0 and hasattr(os, "posix_fallocate"):
+            try:
+                # Allocates the blocks without writing them, so the file ends up in as few extents as possible
+                os.posix_fallocate(self.fd, 0, WAV_HEADER_BYTES + min(preallocate_bytes, WAV_MAX_DATA_BYTES))
+                self.preallocated = True
+            except OSError as e:
+                # E.g. not enough free space for the whole segment; write without reservation
+                print(f"Could not preallocate {path}: {e}")
+
+    def write(self, buffers: list) -> int:
+        """
+        Write a list of buffers with as few writev calls as possible.
+
+        Args:
+            buffers (list): Bytes-like objects (e.g. ring buffer memoryviews) to write in order
+
+        Returns:
+            int: Number of bytes written
+        """
+        if self.bytes_written + sum(len(buffer) for buffer in buffers) > WAV_MAX_DATA_BYTES:
+            raise OSError(f"{self.path} would exceed the 4 GB WAV size limit")
+
+        total = 0
+        try:
+            for i in range(0, len(buffers), IOV_MAX):
+                chunk = buffers[i:i + IOV_MAX]
+                remaining = sum(len(buffer) for buffer in chunk)
+                while remaining > 0:
+                    start = time.perf_counter()
+                    written = os.writev(self.fd, chunk)
+                    if self.latency is not None:
+                        self.latency.record(time.perf_counter() - start)
+
+                    total += written
+                    remaining -= written
+                    if remaining > 0:
+                        # Partial write: skip what was written and retry with the rest
+                        chunk = skip_bytes(chunk, written)
+        except OSError:
+            # Nothing of a failed write counts; the next write goes where this one started
+            os.lseek(self.fd, WAV_HEADER_BYTES + self.bytes_written, os.SEEK_SET)
+            raise
+        if self.hash is not None:
+            # Hashes the buffers while they are still in the page cache; releases the GIL for large buffers
+            for buffer in buffers:
+                self.hash.update(buffer)
+        self.bytes_written += total
+        return total
+
+    def close(self, metadata: dict = None):
+        """
+        Patch the WAV header with the final sizes and move the file into place.
+
+        Args:
+            metadata (dict, optional): Capture metadata to store in the header
+        """
+        if self.fd is None:
+            return
+        # Drop a trailing partial frame so the data chunk holds whole frames only
+        frame_bytes = self.channels * self.sample_width
+        data_bytes = self.bytes_written - self.bytes_written % frame_bytes
+        if data_bytes != self.bytes_written or self.preallocated:
+            os.ftruncate(self.fd, WAV_HEADER_BYTES + data_bytes)
+        if data_bytes != self.bytes_written:
+            # The checksum covered the dropped bytes too
+            self.hash = None
+        if self.hash is not None:
+            self.checksum = self.hash.hexdigest()
+
+        os.pwrite(self.fd, build_wav_header(self.sample_rate, self.channels, self.sample_width, data_bytes, metadata), 0)
+        os.fsync(self.fd)
+        os.close(self.fd)
+        self.fd = None
+        os.replace(self.part_path, self.path)
+
+
+def skip_bytes(buffers: list, nbytes: int) -> list:
+    """
+    Drop the first `nbytes` bytes from a list of buffers without copying.
+    """
+    for i, buffer in enumerate(buffers):
+        if nbytes < len(buffer):
+            return [memoryview(buffer)[nbytes:]] + buffers[i + 1:]
+        nbytes -= len(buffer)
+    return []
+
+
+def split_bytes(buffers: list, nbytes: int) -> tuple[list, list]:
+    """
+    Split a list of buffers after the first `nbytes` bytes without copying.
+
+    Returns:
+        tuple: (buffers holding the first nbytes bytes, remaining buffers)
+    """
+    head = []
+    for i, buffer in enumerate(buffers):
+        if nbytes <= 0:
+            return head, buffers[i:]
+        if nbytes < len(buffer):
+            view = memoryview(buffer)
+            return head + [view[:nbytes]], [view[nbytes:]] + buffers[i + 1:]
+        head.append(buffer)
+        nbytes -= len(buffer)
+    return head, []
+
+
+class StreamWriter:
+    """
+    Drains a device ring buffer straight into WAV files.
+
+    The writer keeps the current file open, waits (blocking, without polling) until a batch
+    worth of periods is buffered and writes them with one `os.writev` call straight from
+    the ring buffer slots.
+
+    With `segment_frames` set, the output is split into consecutive files of exactly that
+    many frames. Batches are split on the exact frame boundary, so consecutive segments
+    line up without losing or duplicating a single sample. Without it, a recording rolls
+    over to a new file the same way before it reaches the 4 GB WAV size limit.
+
+    A batch that cannot be written (e.g. the card is full) is dropped and counted. The file
+    is then closed and the next one starts at the frame after the dropped ones, so the gap
+    shows up between files and later samples keep their time.
+
+    The latency of every write is recorded, so SD card stalls show up before they turn into
+    dropped periods.
+
+    With `analyzer_factory` set, every file gets an analyzer (e.g. a SpectralSummary) that
+    is fed the same buffers as the file and closed right before the file is reported.
+
+    With `file_index` set, the writer checksums the sample data as it writes it and adds
+    every finished file to the RecordingIndex before it is reported.
+
+    With `stream` set, every batch is also forwarded live (see PcmStream); while anyone is
+    listening the writer flushes at the interval of the stream instead of flush_interval.
+
+    Attributes:
+        path (str): Path of the current (or last) WAV file
+        latency (LatencyHistogram): Latency of every write call
+        bytes_written (int): Number of sample bytes written over all files
+        bytes_dropped (int): Number of sample bytes that could not be written
+    """
+
+    def __init__(self, path_factory, sample_rate: int, channels: int = 1, sample_width: int = 2,
+                 segment_frames: int = None, on_file_closed=None, metadata_factory=None, analyzer_factory=None,
+                 batch_bytes: int = WRITE_BATCH_BYTES, flush_interval: float = MAX_FLUSH_INTERVAL,
+                 latency: LatencyHistogram = None, file_index=None, preallocate: bool = PREALLOCATE_SEGMENTS,
+                 metrics: CaptureMetrics = None, stream=None):
+        """
+        Create the first output file.
+
+        Args:
+            path_factory (callable): Returns the path of a file given the index of its first frame
+            sample_rate (int): Sample rate in Hz
+            channels (int): Number of channels (default: 1)
+            sample_width (int): Bytes per sample (default: 2)
+            segment_frames (int, optional): Rotate to a new file every segment_frames frames
+            on_file_closed (callable, optional): Called with the path of every finished file
+            metadata_factory (callable, optional): Returns the metadata of a file given the index
+                                                   of its first frame and its number of frames
+            analyzer_factory (callable, optional): Returns an analyzer for the path of a new file;
+                                                   the analyzer gets `update(buffers)` and `close()`
+            batch_bytes (int): Target size of a single write in bytes (default: 2 MB)
+            flush_interval (float): Maximum time in seconds between writes while data is pending (default: 1.0)
+            latency (LatencyHistogram, optional): Histogram to record write latencies in, e.g. shared by several writers
+            file_index (RecordingIndex, optional): Index to add every finished file to
+            preallocate (bool): Reserve the space of a full segment when a file is created
+            metrics (CaptureMetrics, optional): Device counters to update; its latency histogram
+                                                is used unless latency is given
+            stream (PcmStream, optional): Live stream to forward every batch to
+        """
+        self.path_factory = path_factory
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.frame_bytes = channels * sample_width
+        self.segment_frames = segment_frames
+        self.on_file_closed = on_file_closed
+        self.metadata_factory = metadata_factory
+        self.analyzer_factory = analyzer_factory
+        self.batch_bytes = batch_bytes
+        self.flush_interval = flush_interval
+        self.file_index = file_index
+        self.preallocate = preallocate
+        self.metrics = metrics
+        self.stream = stream
+        # Frames per file: the segment length, and never more than a WAV file can hold
+        max_file_frames = WAV_MAX_DATA_BYTES // self.frame_bytes
+        self.file_frames = min(segment_frames, max_file_frames) if segment_frames else max_file_frames
+
+        if latency is None:
+            latency = metrics.latency if metrics is not None else LatencyHistogram()
+        self.latency = latency
+        self.bytes_written = 0
+        self.bytes_dropped = 0
+        self.file: WavFile = None
+        self.analyzer = None
+        self.file_first_frame = 0
+        self.path = None
+        self._open_file()
+
+    @property
+    def frames_written(self) -> int:
+        return self.bytes_written // self.frame_bytes
+
+    def _open_file(self):
+        # Dropped frames still take their time, so a file after a gap starts where its samples belong
+        self.file_first_frame = (self.bytes_written + self.bytes_dropped) // self.frame_bytes
+        self.path = self.path_factory(self.file_first_frame)
+        preallocate_bytes = self.segment_frames * self.frame_bytes if self.preallocate and self.segment_frames else 0
+        self.file = WavFile(self.path, self.sample_rate, self.channels, self.sample_width, self.latency,
+                            checksum=self.file_index is not None, preallocate_bytes=preallocate_bytes)
+        if self.analyzer_factory is not None:
+            try:
+                self.analyzer = self.analyzer_factory(self.path)
+            except Exception as e:
+                print(f"Error creating analyzer for {self.path}: {e}")
+                self.analyzer = None
+
+    def _close_file(self):
+        metadata = None
+        if self.metadata_factory is not None:
+            try:
+                metadata = self.metadata_factory(self.file_first_frame, self.file.bytes_written // self.frame_bytes)
+            except Exception as e:
+                print(f"Error building metadata for {self.file.path}: {e}")
+        self.file.close(metadata)
+        if self.analyzer is not None:
+            try:
+                self.analyzer.close()
+            except Exception as e:
+                print(f"Error closing analyzer of {self.file.path}: {e}")
+            self.analyzer = None
+        if self.file_index is not None:
+            try:
+                # The samples are the bytes after the header, so their checksum also verifies a transfer of the file
+                self.file_index.add(self.file.path, self.file.bytes_written // self.frame_bytes, self.sample_rate,
+                                    self.channels, checksum=self.file.checksum, metadata=metadata,
+                                    file_checksum=self.file.checksum, file_checksum_offset=WAV_HEADER_BYTES)
+            except Exception as e:
+                print(f"Error indexing {self.file.path}: {e}")
+        if self.metrics is not None:
+            self.metrics.file_closed()
+        if self.on_file_closed is not None:
+            try:
+                self.on_file_closed(self.file.path)
+            except Exception as e:
+                print(f"Error handling finished file {self.file.path}: {e}")
+
+    def write(self, buffers: list) -> int:
+        """
+        Write a list of buffers, rotating files on segment boundaries.
+
+        Args:
+            buffers (list): Bytes-like objects (e.g. ring buffer memoryviews) to write in order
+
+        Returns:
+            int: Number of bytes written
+        """
+        if self.stream is not None:
+            try:
+                self.stream.update(buffers)
+            except Exception as e:
+                # A failing stream must never cost audio on the card
+                print(f"Error streaming data of {self.path}, streaming stopped: {e}")
+                self.stream = None
+
+        if self.file is None:
+            self._open_file()
+        total = 0
+        while buffers:
+            room = self.file_frames * self.frame_bytes - self.file.bytes_written
+            head, buffers = split_bytes(buffers, room)
+
+            written = self.file.write(head)
+            self.bytes_written += written
+            total += written
+            if self.metrics is not None:
+                self.metrics.bytes_written(written)
+            if self.analyzer is not None:
+                try:
+                    self.analyzer.update(head)
+                except Exception as e:
+                    # A failing analyzer must never cost audio
+                    print(f"Error analyzing data of {self.path}, analysis stopped: {e}")
+                    self.analyzer = None
+
+            if self.file.bytes_written >= self.file_frames * self.frame_bytes:
+                self._close_file()
+                # Not reported twice should the next file fail to open
+                self.file = None
+                self._open_file()
+        return total
+
+    def _drop(self, nbytes: int):
+        """
+        Count bytes that could not be written and end the current file before the gap; the
+        next write opens a new one.
+        """
+        self.bytes_dropped += nbytes
+        if self.metrics is not None:
+            self.metrics.bytes_dropped(nbytes)
+        if self.file is None:
+            return
+        try:
+            self._discard_or_close_file()
+        except OSError as e:
+            print(f"Error closing {self.file.path}: {e}")
+        self.file = None
+        self.analyzer = None
+
+    def _discard_or_close_file(self):
+        if self.file.bytes_written == 0:
+            self.file.close()
+            os.remove(self.file.path)
+            self.analyzer = None
+        else:
+            self._close_file()
+
+    def run(self, ring_buffer, is_running):
+        """
+        Write periods from the ring buffer until `is_running` returns False and the ring
+        buffer is empty.
+
+        Args:
+            ring_buffer (RingBuffer): Ring buffer filled by the capture thread
+            is_running (callable): Returns True while new periods may still arrive
+        """
+        batch_periods = max(1, min(self.batch_bytes // ring_buffer.slot_bytes, ring_buffer.slots // 2))
+        while True:
+            running = is_running()
+            flush_interval = self.stream.interval if self.stream is not None and self.stream.live() else self.flush_interval
+            if running and not ring_buffer.wait(timeout=flush_interval, min_periods=batch_periods):
+                continue
+
+            periods = ring_buffer.peek(batch_periods)
+            if periods:
+                bytes_written = self.bytes_written
+                try:
+                    self.write(periods)
+                except OSError as e:
+                    # The ring buffer must keep moving; the periods that did not make it are counted as dropped
+                    dropped = sum(len(period) for period in periods) - (self.bytes_written - bytes_written)
+                    print(f"Error writing data to {self.path}, {dropped} bytes dropped: {e}")
+                    self._drop(dropped)
+                ring_buffer.advance(len(periods))
+            elif not running:
+                break
+
+    def close(self):
+        """
+        Finish the current file. An empty trailing segment is removed instead of kept.
+        """
+        if self.file is None:
+            return
+        if self.bytes_written > 0 or self.bytes_dropped > 0:
+            self._discard_or_close_file()
+        else:
+            self._close_file()
+        self.file = None
+
+    def latency_report(self) -> str:
+        """
+        Returns:
+            str: Human readable write latency percentiles
+        """
+        summary = self.latency.summary()
+        return (f"{summary['count']} writes, {self.bytes_written/1024/1024:.1f} MB, {self.bytes_dropped} bytes dropped, "
+                f"latency p50 {summary['p50']*1000:.1f} ms, p90 {summary['p90']*1000:.1f} ms, "
+                f"p99 {summary['p99']*1000:.1f} ms, max {summary['max']*1000:.1f} ms")
@@ -0,0 +1,299 @@
+import os
+from datetime import datetime
+import numpy as np
+from pac_metrics import CaptureMetrics, LatencyHistogram
+from pac_stream_writer import StreamWriter, WRITE_BATCH_BYTES, MAX_FLUSH_INTERVAL
+
+
+# Frequency band (Hz) the detector listens to; insect activity is ultrasonic
+TRIGGER_BAND = (20000, 100000)
+
+# Samples per FFT frame of the detector; a period is analysed as several frames, so short clicks are not averaged away
+TRIGGER_FFT_SIZE = 512
+
+# A period triggers when its band energy exceeds the noise floor by this many dB
+TRIGGER_THRESHOLD_DB = 12.0
+
+# Time constant of the noise floor estimate in seconds
+TRIGGER_NOISE_TIME_CONSTANT = 10.0
+
+# Time after the start during which the noise floor is learned and nothing triggers, in seconds
+TRIGGER_WARMUP_SECONDS = 1.0
+
+# Audio kept before the first and after the last triggering period of an event, in seconds
+TRIGGER_PRE_SECONDS = 0.5
+TRIGGER_POST_SECONDS = 1.0
+
+# Events longer than this are split into consecutive files, in seconds
+TRIGGER_MAX_EVENT_SECONDS = 60
+
+# Power floor added before converting to dB, so silence does not turn into -inf
+_POWER_FLOOR = 1e-12
+
+
+def event_path(storage_path: str, start_time: float, sample_rate: int, device_index: int, first_frame: int) -> str:
+    """
+    Returns:
+        str: Path of an event file, named after the time of its first sample to the millisecond
+    """
+    timestamp = start_time + first_frame / sample_rate
+    timestamp_ymd_hms = datetime.fromtimestamp(timestamp).strftime("%Y_%m_%d_%H_%M_%S")
+    milliseconds = int(timestamp * 1000) % 1000
+    return os.path.join(storage_path, f"PZOevt_{timestamp_ymd_hms}_{milliseconds:03d}_Udev{device_index}.wav")
+
+
+class EnergyDetector:
+    """
+    Streaming band energy detector with an adaptive noise floor.
+
+    Every period is cut into Hann windowed frames that are transformed with one vectorised
+    FFT; the loudest frame's energy in TRIGGER_BAND is the level of the period. The noise
+    floor follows the level with an exponential moving average, which slows down tenfold
+    while triggered so an event does not raise its own threshold.
+    """
+
+    def __init__(self, sample_rate: int, channels: int = 1, band: tuple = TRIGGER_BAND, fft_size: int = TRIGGER_FFT_SIZE,
+                 threshold_db: float = TRIGGER_THRESHOLD_DB, time_constant: float = TRIGGER_NOISE_TIME_CONSTANT,
+                 warmup_seconds: float = TRIGGER_WARMUP_SECONDS):
+        """
+        Args:
+            sample_rate (int): Sample rate in Hz
+            channels (int): Number of interleaved channels; they are mixed down before analysis
+            band (tuple): (low, high) frequency band in Hz
+            fft_size (int): Samples per FFT frame
+            threshold_db (float): Level above the noise floor that triggers, in dB
+            time_constant (float): Time constant of the noise floor in seconds
+            warmup_seconds (float): Time during which only the noise floor is learned, in seconds
+        """
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.fft_size = fft_size
+        self.threshold_db = threshold_db
+        self.time_constant = time_constant
+        self.warmup_frames = int(warmup_seconds * sample_rate)
+
+        self.window = np.hanning(fft_size).astype(np.float32)
+        frequencies = np.fft.rfftfreq(fft_size, 1.0 / sample_rate)
+        self.band_bins = (frequencies >= band[0]) & (frequencies < band[1])
+        # Scale so a full scale sine in the band reads about 0 dB
+        self.scale = 4.0 / (np.sum(self.window) ** 2 * 32768.0 ** 2)
+
+        self.noise_floor_db = None
+        self.level_db = None
+        self.frames_seen = 0
+
+    def update(self, period, triggered: bool) -> bool:
+        """
+        Analyse one period.
+
+        Args:
+            period (bytes-like): Interleaved 16-bit samples
+            triggered (bool): Whether an event is currently being recorded
+
+        Returns:
+            bool: True if the period exceeds the threshold
+        """
+        samples = np.frombuffer(period, dtype="<i2")
+        frames = len(samples) // self.channels
+        self.frames_seen += frames
+        usable = frames - frames % self.fft_size
+        if usable == 0:
+            return False
+
+        mono = samples[:usable * self.channels].reshape(-1, self.channels).mean(axis=1, dtype=np.float32)
+        spectra = np.fft.rfft(mono.reshape(-1, self.fft_size) * self.window, axis=1)[:, self.band_bins]
+        energy = np.max(np.sum(spectra.real ** 2 + spectra.imag ** 2, axis=1)) * self.scale
+        self.level_db = float(10 * np.log10(energy + _POWER_FLOOR))
+
+        if self.noise_floor_db is None:
+            self.noise_floor_db = self.level_db
+        alpha = min(1.0, frames / self.sample_rate / self.time_constant)
+        if triggered:
+            alpha /= 10
+        above = self.level_db > self.noise_floor_db + self.threshold_db
+        self.noise_floor_db += alpha * (self.level_db - self.noise_floor_db)
+        return above and self.frames_seen > self.warmup_frames
+
+
+class TriggeredWriter:
+    """
+    Drains a device ring buffer, but only writes the periods around detected events.
+
+    Every period is run through an EnergyDetector. While nothing happens, the last
+    TRIGGER_PRE_SECONDS of periods are left unread in the ring buffer as pre-trigger
+    history, so keeping them costs no copy. When a period triggers, an event file is opened
+    that starts with that history; it is closed once TRIGGER_POST_SECONDS passed without a
+    trigger. Every event file records the exact index of its first frame within the capture,
+    so events stay sample-aligned with each other and with other devices.
+
+    Has the interface of the StreamWriter, so the capture managers can use either.
+
+    Attributes:
+        latency (LatencyHistogram): Latency of every write call
+        bytes_written (int): Number of sample bytes written over all event files
+        frames_seen (int): Number of frames analysed
+        events (int): Number of events detected
+    """
+
+    def __init__(self, path_factory, sample_rate: int, channels: int = 1, sample_width: int = 2,
+                 segment_frames: int = None, on_file_closed=None, metadata_factory=None, analyzer_factory=None,
+                 pre_seconds: float = TRIGGER_PRE_SECONDS, post_seconds: float = TRIGGER_POST_SECONDS,
+                 detector: EnergyDetector = None, batch_bytes: int = WRITE_BATCH_BYTES,
+                 flush_interval: float = MAX_FLUSH_INTERVAL, file_index=None, metrics: CaptureMetrics = None):
+        """
+        Args:
+            path_factory (callable): Returns the path of an event file given the index of its first frame
+            sample_rate (int): Sample rate in Hz
+            channels (int): Number of channels (default: 1)
+            sample_width (int): Bytes per sample (default: 2)
+            segment_frames (int, optional): Split events longer than this many frames (default: TRIGGER_MAX_EVENT_SECONDS)
+            on_file_closed (callable, optional): Called with the path of every finished event file
+            metadata_factory (callable, optional): Returns the metadata of a file given the index
+                                                   of its first frame and its number of frames
+            analyzer_factory (callable, optional): Returns an analyzer for the path of a new file
+            pre_seconds (float): Audio kept before the first triggering period, in seconds
+            post_seconds (float): Audio kept after the last triggering period, in seconds
+            detector (EnergyDetector, optional): Detector to use (default: band energy with default settings)
+            batch_bytes (int): Target amount of data analysed at once in bytes (default: 2 MB)
+            flush_interval (float): Maximum time in seconds data waits before it is analysed (default: 1.0)
+            file_index (RecordingIndex, optional): Index to add every finished event file to
+            metrics (CaptureMetrics, optional): Device counters to update
+        """
+        self.path_factory = path_factory
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.frame_bytes = channels * sample_width
+        self.segment_frames = segment_frames or int(TRIGGER_MAX_EVENT_SECONDS * sample_rate)
+        self.on_file_closed = on_file_closed
+        self.metadata_factory = metadata_factory
+        self.analyzer_factory = analyzer_factory
+        self.pre_frames = int(pre_seconds * sample_rate)
+        self.post_frames = int(post_seconds * sample_rate)
+        self.detector = detector or EnergyDetector(sample_rate, channels)
+        self.batch_bytes = batch_bytes
+        self.flush_interval = flush_interval
+        self.file_index = file_index
+        self.metrics = metrics
+
+        self.latency = metrics.latency if metrics is not None else LatencyHistogram()
+        self.bytes_written = 0
+        self.events = 0
+        self.event: StreamWriter = None
+        self.event_first_frame = 0
+        self.trigger_frame = 0
+        self.quiet_frames = 0
+        self.path = None
+
+    @property
+    def frames_seen(self) -> int:
+        return self.detector.frames_seen
+
+    def _open_event(self, first_frame: int, trigger_frame: int):
+        self.events += 1
+        self.event_first_frame = first_frame
+        self.trigger_frame = trigger_frame
+        self.quiet_frames = 0
+        self.event = StreamWriter(lambda frame: self.path_factory(first_frame + frame), self.sample_rate,
+                                  self.channels, self.sample_width, segment_frames=self.segment_frames,
+                                  on_file_closed=self.on_file_closed, metadata_factory=self._event_metadata,
+                                  analyzer_factory=self.analyzer_factory, latency=self.latency,
+                                  file_index=self.file_index, preallocate=False, metrics=self.metrics)
+        self.path = self.event.path
+
+    def _event_metadata(self, first_frame: int, frames: int) -> dict:
+        first_frame += self.event_first_frame
+        metadata = self.metadata_factory(first_frame, frames) if self.metadata_factory is not None else {}
+        metadata["trigger"] = {
+            "event": self.events,
+            "trigger_frame": self.trigger_frame,
+            "pre_trigger_frames": max(0, self.trigger_frame - first_frame),
+            "threshold_db": self.detector.threshold_db,
+            "noise_floor_db": round(self.detector.noise_floor_db, 1),
+        }
+        return metadata
+
+    def _close_event(self):
+        self.bytes_written += self.event.bytes_written
+        self.event.close()
+        self.event = None
+
+    def run(self, ring_buffer, is_running):
+        """
+        Analyse periods from the ring buffer and write the events until `is_running` returns
+        False and the ring buffer is empty.
+
+        Args:
+            ring_buffer (RingBuffer): Ring buffer filled by the capture thread
+            is_running (callable): Returns True while new periods may still arrive
+        """
+        period_frames = ring_buffer.slot_bytes // self.frame_bytes
+        # The pre-trigger history lives in the ring buffer, so leave it room to absorb stalls
+        max_history = min(-(-self.pre_frames // period_frames), ring_buffer.slots // 2)
+        batch_periods = max(1, min(self.batch_bytes // ring_buffer.slot_bytes, ring_buffer.slots // 4))
+        history = 0  # analysed periods kept unread as pre-trigger history
+        read_frame = 0  # index within the capture of the first unread frame
+        while True:
+            running = is_running()
+            if running and not ring_buffer.wait(timeout=self.flush_interval, min_periods=history + batch_periods):
+                continue
+
+            periods = ring_buffer.peek()
+            if len(periods) == history:
+                if not running:
+                    break
+                continue
+
+            frame = read_frame + sum(len(period) for period in periods[:history]) // self.frame_bytes
+            pending = []
+            for index in range(history, len(periods)):
+                period = periods[index]
+                triggered = self.detector.update(period, self.event is not None)
+                if self.event is None and triggered:
+                    # The event starts with the pre-trigger history
+                    pending = periods[index - min(history, max_history):index]
+                    self._open_event(frame - sum(len(p) for p in pending) // self.frame_bytes, frame)
+                    history = 0
+
+                frames = len(period) // self.frame_bytes
+                if self.event is not None:
+                    pending.append(period)
+                    self.quiet_frames = 0 if triggered else self.quiet_frames + frames
+                    if self.quiet_frames >= self.post_frames:
+                        self._write(pending)
+                        pending = []
+                        self._close_event()
+                else:
+                    history += 1
+                frame += frames
+            if pending:
+                self._write(pending)
+
+            # Release everything but the pre-trigger history
+            history = min(history, max_history)
+            release = len(periods) - history
+            read_frame += sum(len(period) for period in periods[:release]) // self.frame_bytes
+            ring_buffer.advance(release)
+
+    def _write(self, periods: list):
+        try:
+            self.event.write(periods)
+        except OSError as e:
+            print(f"Error writing data to {self.event.path}: {e}")
+
+    def close(self):
+        """
+        Finish the event that is still open, if any.
+        """
+        if self.event is not None:
+            self._close_event()
+
+    def latency_report(self) -> str:
+        """
+        Returns:
+            str: Number of events, fraction of the audio kept and write latency percentiles
+        """
+        summary = self.latency.summary()
+        kept = self.bytes_written / self.frame_bytes / self.frames_seen if self.frames_seen else 0.0
+        return (f"{self.events} events, {self.bytes_written/1024/1024:.1f} MB ({kept*100:.1f}% of the audio kept), "
+                f"latency p50 {summary['p50']*1000:.1f} ms, p99 {summary['p99']*1000:.1f} ms, max {summary['max']*1000:.1f} ms")
@@ -1,15 +1,152 @@
 import paramiko
 import logging
+import threading
 import time
 
 import os
 import socket
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable
 
 from datetime import datetime
 import json
 
+from windows_pac_checksum import FileChecksum
+
 COMMAND_SEPARATOR = '#'
 
+# SSH sessions kept open per node, so a download and a delete (or several downloads) can run at the same time
+SFTP_POOL_SIZE = 2
+
+# A session idle for longer than this is checked with a round trip before it is reused, in seconds
+SFTP_HEALTH_CHECK_INTERVAL = 30
+
+# Seconds between SSH keepalives on an open session, so an idle session is not dropped by the network
+SSH_KEEPALIVE_INTERVAL = 15
+
+# Timeout of the TCP connect and the SSH handshake, in seconds
+SSH_CONNECT_TIMEOUT = 10
+
+# Timeout of a single SFTP request, in seconds; a transfer that stalls for this long is aborted and retried on a new session
+SFTP_TIMEOUT = 30
+
+# Attempts of an operation whose session broke; every retry runs on a freshly connected session
+SFTP_ATTEMPTS = 2
+
+# Bytes asked for per SFTP read request (paramiko's default); OpenSSH serves up to 255 KiB per request
+SFTP_CHUNK_BYTES = 32768
+
+# SFTP read requests sent at once per range of a download, so a transfer is not limited to one request per round trip
+SFTP_MAX_REQUESTS = 64
+
+# Ranges of a large file downloaded at the same time, each over an SFTP channel of its own (one sftp-server
+# process on the pi per channel, so they spread over its cores); 1 downloads a file as a single pipelined stream
+SFTP_RANGE_WORKERS = 1
+
+# Smallest range a file is split into; smaller files are downloaded as a single range
+SFTP_MIN_RANGE_BYTES = 16 * 1024 * 1024
+
+# Downloads of a file whose checksum does not match before giving up on it
+VERIFY_ATTEMPTS = 2
+
+
+class SFTPSession:
+    """
+    An SSH connection with a single open SFTP channel.
+    """
+
+    def __init__(self, ssh: paramiko.SSHClient, sftp: paramiko.SFTPClient):
+        self.ssh = ssh
+        self.sftp = sftp
+        self.last_used = time.monotonic()
+
+    def healthy(self, check_interval: float = SFTP_HEALTH_CHECK_INTERVAL) -> bool:
+        """
+        Args:
+            check_interval (float): Only do a round trip if the session was idle for longer than this
+
+        Returns:
+            bool: True if the session can be used
+        """
+        transport = self.ssh.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        if time.monotonic() - self.last_used < check_interval:
+            return True
+        try:
+            self.sftp.stat(".")
+            return True
+        except Exception:
+            return False
+
+    def close(self):
+        for closable in (self.sftp, self.ssh):
+            try:
+                closable.close()
+            except Exception:
+                pass
+
+
+class SFTPSessionPool:
+    """
+    Keeps up to `size` SFTP sessions to a node open between operations, so a file costs a
+    request on an open channel instead of a TCP connect, an SSH handshake, authentication
+    and a new SFTP channel.
+
+    A session is checked before it is handed out: a dead transport is replaced at once, and
+    a session idle for a while must answer a stat first. A session that raised is only put
+    back if it still answers, so one network hiccup costs one reconnect. Thread-safe; callers
+    beyond `size` wait for a session to come back.
+    """
+
+    def __init__(self, connect: Callable[[], SFTPSession], size: int = SFTP_POOL_SIZE):
+        """
+        Args:
+            connect (Callable[[], SFTPSession]): Opens a new session
+            size (int): Maximum number of open sessions
+        """
+        self.connect = connect
+        self.size = size
+        self.idle: list[SFTPSession] = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+        self.connects = 0
+
+    @contextmanager
+    def session(self):
+        self.slots.acquire()
+        session = None
+        try:
+            with self.lock:
+                session = self.idle.pop() if self.idle else None
+            if session is not None and not session.healthy():
+                session.close()
+                session = None
+            if session is None:
+                session = self.connect()
+                self.connects += 1
+            try:
+                yield session
+            except Exception:
+                if not session.healthy(check_interval=0):
+                    session.close()
+                    session = None
+                raise
+            finally:
+                if session is not None:
+                    session.last_used = time.monotonic()
+                    with self.lock:
+                        self.idle.append(session)
+        finally:
+            self.slots.release()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for session in idle:
+            session.close()
+
 
 class RPI_PAC_SCP_Node:
     def __init__(self, name: str, ip_address: str, config: dict, logger: logging.Logger):
@@ -26,79 +163,293 @@ class RPI_PAC_SCP_Node:
         self.audio_file_prefix = config['audio_file_prefix']
         self.command_separator = COMMAND_SEPARATOR
 
+        self.sftp_timeout = config.get('fetch_timeout', SFTP_TIMEOUT)
+        self.sftp_chunk_bytes = config.get('sftp_chunk_bytes', SFTP_CHUNK_BYTES)
+        self.sftp_max_requests = config.get('sftp_max_requests', SFTP_MAX_REQUESTS)
+        self.sftp_range_workers = config.get('sftp_range_workers', SFTP_RANGE_WORKERS)
+        self.session_pool = SFTPSessionPool(self._connect, config.get('sftp_pool_size', SFTP_POOL_SIZE))
+
+    def _connect(self) -> SFTPSession:
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        try:
+            ssh.connect(self.ip_address, port=self.port, username=self.username, password=self.password,
+                        timeout=SSH_CONNECT_TIMEOUT, banner_timeout=SSH_CONNECT_TIMEOUT, auth_timeout=SSH_CONNECT_TIMEOUT)
+            ssh.get_transport().set_keepalive(SSH_KEEPALIVE_INTERVAL)
+            sftp = ssh.open_sftp()
+            sftp.get_channel().settimeout(self.sftp_timeout)
+        except Exception:
+            ssh.close()
+            raise
+        self.logger.info(f"~[scp] Opened sftp session to RPI_PAC_Node {self.name}")
+        return SFTPSession(ssh, sftp)
+
+    def _with_session(self, operation: Callable[[paramiko.SFTPClient], object]):
+        """
+        Run an operation on a pooled SFTP channel, retrying on a new session if the session
+        broke underneath it. Errors of the operation itself (e.g. a missing file) are raised.
+        """
+        for attempt in range(SFTP_ATTEMPTS):
+            try:
+                with self.session_pool.session() as session:
+                    return operation(session.sftp)
+            except (paramiko.SSHException, EOFError, socket.error) as e:
+                if isinstance(e, (paramiko.AuthenticationException, FileNotFoundError, PermissionError)) \
+                        or attempt == SFTP_ATTEMPTS - 1:
+                    raise
+                self.logger.info(f"~[scp] Session to {self.name} lost ({e}), reconnecting")
+
     def test_scp_connection(self):
         try:
-            with paramiko.SSHClient() as ssh:
-                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh.connect(self.ip_address, port=self.port, username=self.username, password=self.password)
-                self.logger.info(f"~[scp] Successfully connected to RPI_PAC_Node")
-                return True
+            self._with_session(lambda sftp: sftp.stat("."))
+            self.logger.info(f"~[scp] Successfully connected to RPI_PAC_Node")
+            return True
         except Exception as e:
             self.logger.error(f"~[scp] Error connecting to RPI_PAC_Node: {e}")
             return False
 
-    def download_scp_file(self, local_directory_path: str, remote_directory_path: str, filename: str = None):
+    def list_remote_files(self, remote_directory_path: str) -> dict[str, int]:
+        """
+        Returns:
+            dict[str, int]: {file name: size in bytes} of the files in the remote directory
+        """
+        return {attributes.filename: attributes.st_size
+                for attributes in self._with_session(lambda sftp: sftp.listdir_attr(remote_directory_path))}
+
+    def download_scp_file(self, local_directory_path: str, remote_directory_path: str, filename: str = None,
+                          checksum: FileChecksum = None) -> bool:
+        return filename is not None and filename in self.download_scp_files(local_directory_path, remote_directory_path, [filename],
+                                                                            {filename: checksum} if checksum else None)
+
+    def download_scp_files(self, local_directory_path: str, remote_directory_path: str, filenames: list[str],
+                           checksums: dict[str, FileChecksum] = None) -> dict[str, bool]:
+        """
+        Download files over a single pooled SFTP channel: one listing for all of them (a stat
+        for a single file), then one transfer per file. Every file is written to <file>.part and only renamed once its
+        size matches the remote size, so a broken transfer never looks like a complete file.
+
+        A partial file is resumed, and a local copy from an earlier fetch is only completed (or
+        left alone) instead of downloaded again. Files with a checksum (as sent by the node,
+        see RPI_PAC_TCP_Node.file_info) are verified as they arrive.
+
+        Args:
+            local_directory_path (str): Directory to save the files in
+            remote_directory_path (str): Directory of the files on the node
+            filenames (list[str]): Names of the files
+            checksums (dict[str, FileChecksum], optional): Checksum of a file by name, as sent by the node
+
+        Returns:
+            dict[str, bool]: {name: verified} of the files downloaded; verified is False if only the size was checked
+        """
+        os.makedirs(local_directory_path, exist_ok=True)
+        checksums = checksums or {}
+        # Outside the operation, so a retry on a new session continues where the broken one stopped
+        downloaded = {}
+
+        def download(sftp: paramiko.SFTPClient) -> dict[str, bool]:
+            if len(filenames) == 1:
+                # A single file (e.g. one of several parallel transfers) only needs a stat, not a listing
+                try:
+                    remote_sizes = {filenames[0]: sftp.stat(remote_directory_path + "/" + filenames[0]).st_size}
+                except FileNotFoundError:
+                    remote_sizes = {}
+            else:
+                remote_sizes = {attributes.filename: attributes.st_size for attributes in sftp.listdir_attr(remote_directory_path)}
+            for filename in filenames:
+                if filename in downloaded:
+                    continue
+                if filename not in remote_sizes:
+                    self.logger.info(f"~[scp] File {filename} not found on RPI_PAC_Node")
+                    continue
+                remote_file_path = remote_directory_path + "/" + filename # linux style path
+                local_file_path = os.path.join(local_directory_path, filename) # windows style path
+                self.logger.info(f"~[scp] Downloading file {filename} from {remote_file_path} to {local_file_path}")
+                verified = self._download_file(sftp, remote_file_path, local_file_path, remote_sizes[filename], checksums.get(filename))
+                if verified is None:
+                    continue
+                self.fetched_audio_files.append(filename)
+                downloaded[filename] = verified
+                self.logger.info(f"~[scp] Downloaded file {filename} ({'verified' if verified else 'size only, no checksum'})")
+            return downloaded
+
         try:
-            with paramiko.SSHClient() as ssh:
-                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh.connect(self.ip_address, port=self.port, username=self.username, password=self.password)
-                self.logger.info(f"~[scp] Successfully connected to RPI_PAC_Node")
-
-                with ssh.open_sftp() as sftp:
-                    self.logger.info(f"~[scp] Successfully opened sftp connection to RPI_PAC_Node")
-
-                    if not os.path.exists(local_directory_path):
-                        os.makedirs(local_directory_path)
-
-                    if filename is not None and filename in sftp.listdir(remote_directory_path):
-
-                        remote_file_path = remote_directory_path + "/" + filename # linux style path
-                        local_file_path = os.path.join(local_directory_path, filename) # windows style path
-                        # try:
-                        self.logger.info(f"~[scp] Downloading file {filename} from {remote_file_path} to {local_file_path}")
-                        sftp.get(remote_file_path, local_file_path)
-                        self.fetched_audio_files.append(filename)
-                        self.logger.info(f"~[scp] Downloaded file {filename}")
-                        # except Exception as e:
-                        #     logging.error(f"{datetime.now()} - RPI_PAC_Node {self.ip_address}:{self.port} - [SCP] Error downloading file {filename}: {e}")
-                    else:
-                        self.logger.info(f"~[scp] File {filename} not found on RPI_PAC_Node")
-
-                    # for file in sftp.listdir(remote_directory_path):
+            return self._with_session(download)
         except paramiko.AuthenticationException as e:
             self.logger.error(f"~[scp] Authentication failed: {str(e)}")
         except paramiko.SSHException as e:
             self.logger.error(f"~[scp] SSH error: {str(e)}")
         except Exception as e:
             self.logger.error(f"~[scp] Error downloading files: {e}")
+        return downloaded
+
+    def _download_file(self, sftp: paramiko.SFTPClient, remote_file_path: str, local_file_path: str, remote_size: int,
+                       expected: FileChecksum = None) -> bool:
+        """
+        Download the bytes of a file that are not on disk yet, checksumming the whole file on the way.
+
+        Returns:
+            bool: True if the file was verified, False if only its size was checked, None if it was not saved
+        """
+        part_path = local_file_path + ".part"
+        for attempt in range(1, VERIFY_ATTEMPTS + 1):
+            existing_path = part_path if os.path.exists(part_path) else local_file_path if os.path.exists(local_file_path) else None
+            offset = os.path.getsize(existing_path) if existing_path is not None else 0
+            if offset > remote_size:
+                # Longer than the file on the node, so it is not a part of it
+                os.remove(existing_path)
+                existing_path, offset = None, 0
+
+            checksum = FileChecksum(expected.offset, expected.expected) if expected is not None else None
+            ranges = self.split_ranges(offset, remote_size)
+            if checksum is not None and offset and len(ranges) <= 1:
+                # Bytes already on disk, including a complete copy with nothing left to download
+                checksum.update_from_file(existing_path, offset)
+            if ranges:
+                if existing_path is not None and existing_path != part_path:
+                    os.replace(existing_path, part_path)
+                self._download_ranges(sftp, remote_file_path, part_path, ranges, checksum if len(ranges) == 1 else None)
 
-    def delete_scp_file(self, remote_directory_path: str, filename: str):
+            fetched_path = part_path if os.path.exists(part_path) else local_file_path
+            if checksum is not None and len(ranges) > 1:
+                # The ranges arrived side by side, not in order; the file was just written, so this reads the page cache
+                checksum.update_from_file(fetched_path)
+            size = os.path.getsize(fetched_path)
+            if size != remote_size:
+                self.logger.error(f"~[scp] Downloaded {size} of {remote_size} bytes of {remote_file_path}")
+                return None
+            if checksum is not None and not checksum.matches():
+                self.logger.error(f"~[scp] Checksum mismatch on {remote_file_path} (attempt {attempt})")
+                os.remove(fetched_path)
+                continue
+            os.replace(fetched_path, local_file_path)
+            return checksum is not None
+        return None
+
+    def split_ranges(self, offset: int, size: int) -> list[tuple[int, int]]:
+        """
+        Returns:
+            list[tuple[int, int]]: (start, end) of the ranges to download bytes offset to size in, at most
+                                   sftp_range_workers of at least SFTP_MIN_RANGE_BYTES each; empty if there is nothing to download
+        """
+        if offset >= size:
+            return []
+        count = max(1, min(self.sftp_range_workers, (size - offset) // SFTP_MIN_RANGE_BYTES))
+        bounds = [offset + (size - offset) * i // count for i in range(count + 1)]
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def _download_ranges(self, sftp: paramiko.SFTPClient, remote_file_path: str, part_path: str, ranges: list[tuple[int, int]],
+                         checksum: FileChecksum = None):
+        """
+        Download ranges of a file into part_path, which holds the bytes before the first range.
+        The file is extended to its full size up front and every range is written in place,
+        the first over the channel of the session and the others over channels of their own
+        on the same connection. A range is requested in windows of sftp_max_requests read
+        requests of sftp_chunk_bytes, all sent before the data of the window is read.
+
+        If a range fails, part_path is cut back to the bytes that arrived without a gap, so
+        the next attempt resumes from there.
+
+        Args:
+            sftp (paramiko.SFTPClient): Channel of the session
+            remote_file_path (str): Path of the file on the node
+            part_path (str): Local file to write to
+            ranges (list[tuple[int, int]]): (start, end) of the ranges, in order and without gaps
+            checksum (FileChecksum, optional): Updated with the data of a single range as it arrives
+        """
+        received = [0] * len(ranges)
+        window_bytes = self.sftp_chunk_bytes * max(1, self.sftp_max_requests)
+
+        def download_range(index: int):
+            start, end = ranges[index]
+            channel = sftp if index == 0 else paramiko.SFTPClient.from_transport(sftp.get_channel().get_transport())
+            try:
+                if channel is not sftp:
+                    channel.get_channel().settimeout(self.sftp_timeout)
+                with channel.open(remote_file_path, "rb") as remote_file, open(part_path, "r+b") as f:
+                    remote_file.MAX_REQUEST_SIZE = self.sftp_chunk_bytes
+                    f.seek(start)
+                    position = start
+                    while position < end:
+                        # Without a limit, as paramiko's own limit on requests in flight ends a prefetch
+                        # as soon as the requests sent so far are answered
+                        window_end = min(position + window_bytes, end)
+                        remote_file.seek(position)
+                        remote_file.prefetch(window_end)
+                        while position < window_end:
+                            block = remote_file.read(min(self.sftp_chunk_bytes, window_end - position))
+                            if not block:
+                                raise EOFError(f"{remote_file_path} ended at {position} of {end} bytes")
+                            f.write(block)
+                            if checksum is not None:
+                                checksum.update(block)
+                            position += len(block)
+                            received[index] += len(block)
+            finally:
+                if channel is not sftp:
+                    channel.close()
+
+        with open(part_path, "ab") as f:
+            f.truncate(ranges[-1][1])
         try:
-            with paramiko.SSHClient() as ssh:
-                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh.connect(self.ip_address, port=self.port, username=self.username, password=self.password)
-                self.logger.info(f"~[scp] Successfully connected to RPI_PAC_Node")
+            if len(ranges) == 1:
+                download_range(0)
+            else:
+                with ThreadPoolExecutor(max_workers=len(ranges), thread_name_prefix="sftp_range") as executor:
+                    for future in [executor.submit(download_range, index) for index in range(len(ranges))]:
+                        future.result()
+        except BaseException:
+            complete = ranges[0][0]
+            for (start, end), count in zip(ranges, received):
+                complete = start + count
+                if complete < end:
+                    break
+            with open(part_path, "r+b") as f:
+                f.truncate(complete)
+            raise
+
+    def delete_scp_file(self, remote_directory_path: str, filename: str) -> bool:
+        return filename in self.delete_scp_files(remote_directory_path, [filename])
 
-                with ssh.open_sftp() as sftp:
-                    self.logger.info(f"~[scp] Successfully opened sftp connection to RPI_PAC_Node")
+    def delete_scp_files(self, remote_directory_path: str, filenames: list[str]) -> list[str]:
+        """
+        Delete files over a single pooled SFTP channel.
 
-                    remote_file_path = remote_directory_path + "/" + filename # linux style path
+        Returns:
+            list[str]: Names of the files deleted
+        """
+        deleted = []
+
+        def delete(sftp: paramiko.SFTPClient) -> list[str]:
+            for filename in filenames:
+                if filename in deleted:
+                    continue
+                remote_file_path = remote_directory_path + "/" + filename # linux style path
+                try:
                     sftp.remove(remote_file_path)
+                    deleted.append(filename)
                     self.logger.info(f"~[scp] Deleted file {filename}")
+                except (FileNotFoundError, PermissionError) as e:
+                    self.logger.error(f"~[scp] Error deleting file {filename}: {e}")
+            return deleted
 
+        try:
+            return self._with_session(delete)
         except Exception as e:
-            self.logger.error(f"~[scp] Error deleting file {filename}: {e}")
+            self.logger.error(f"~[scp] Error deleting files {filenames}: {e}")
+            return deleted
+
+    def close(self):
+        self.session_pool.close()
 
 
 if __name__ == "__main__":
     config = json.load(open(os.path.join(os.path.dirname(__file__), 'config.json')))
-    rpi_pac_scp_node = RPI_PAC_SCP_Node(config['rpi_demo_node']['ip_address'], config['rpi_demo_node']['port'], config)
+    rpi_pac_scp_node = RPI_PAC_SCP_Node(config['rpi_demo_node']['name'], config['rpi_demo_node']['ip_address'], config,
+                                        logging.getLogger(__name__))
     
     local_path = r"C:\Users\StijnSlebos\Downloads\run4_scp"
     remote_path = "/home/plense/passive_sensor_data/fetch_test"
     filename = "PZOrec_2025_04_02_16_42_Udev1.wav"
 
     rpi_pac_scp_node.download_scp_file(local_path, remote_path, filename)
-
-
-
+    rpi_pac_scp_node.close()
@@ -1,11 +1,49 @@
+import contextlib
+import json
 import logging
 import time
 import os
 import socket
+import struct
+import threading
+from collections import deque
 from datetime import datetime
+from typing import Callable, Union
+
+from windows_pac_checksum import FileChecksum
 
 COMMAND_SEPARATOR = '#'
 
+# Commands and responses are framed as a 4-byte big-endian payload length followed by the UTF-8 payload
+MESSAGE_HEADER = struct.Struct("!I")
+
+# Largest response accepted from a node
+MAX_MESSAGE_BYTES = 16 * 1024 ** 2
+
+# Bytes received and written per read when fetching a file
+FETCH_CHUNK_BYTES = 1024 * 1024
+
+# Attempts to fetch a file; every attempt resumes where the previous one stopped
+FETCH_ATTEMPTS = 3
+
+# Timeout of a single read while fetching a file, in seconds; a transfer that stalls for this long is aborted (and resumed)
+FETCH_TIMEOUT = 30
+
+# A subscription without any message (the node sends a keepalive every 10 s) for this long is reconnected
+SUBSCRIPTION_TIMEOUT = 30
+
+# Seconds between attempts to (re)subscribe to a node
+SUBSCRIPTION_RETRY_INTERVAL = 2
+
+# Timeout of a command, in seconds
+COMMAND_TIMEOUT = 5
+
+# Round trips kept per node; the slowest of them is what a start command is planned for
+RTT_SAMPLES = 10
+
+# TIME_SYNC exchanges per clock offset estimate; the one with the shortest round trip is used
+TIME_SYNC_SAMPLES = 8
+
 
 class RPI_PAC_TCP_Node:
     def __init__(self, name: str, ip_address: str, port: int, config: dict, logger: logging.Logger = None):
@@ -24,9 +62,21 @@ class RPI_PAC_TCP_Node:
         self.password = config['password']
         self.audio_file_prefix = config['audio_file_prefix']
         self.command_separator = COMMAND_SEPARATOR
+        self.fetch_timeout = config.get('fetch_timeout', FETCH_TIMEOUT)
 
         self.isresponsive = False
         self.isactive = False
+
+        # Round trips of the last pings in seconds, and the time the node needs to arm its devices after a start command
+        self.rtt_samples: deque[float] = deque(maxlen=RTT_SAMPLES)
+        self.arm_latency: float = None
+        # Clock of the node minus the clock of this controller, and the uncertainty of that estimate, in seconds
+        self.clock_offset: float = None
+        self.clock_uncertainty: float = None
+
+        self.subscription_thread: threading.Thread = None
+        self.subscription_stop = threading.Event()
+        self.subscription_socket: socket.socket = None
         self.test_tcp_connection()
 
     def test_tcp_connection(self, output: bool = True):
@@ -40,10 +90,88 @@ class RPI_PAC_TCP_Node:
                 self.logger.error(f"~[tcp] tcpnode:{self.ip_address}:{self.port} - Error connecting to RPI_PAC_Node: {e}")
             self.isresponsive = False
 
-    def start_recording(self, record_time_in_seconds: int, start_time: int):
+    def ping(self, timeout: float = COMMAND_TIMEOUT) -> dict:
+        """
+        Measure the round trip of a command to the node (including the connect, like every
+        command) and ask how long it takes to arm its devices.
+
+        Args:
+            timeout (float): Seconds to wait for the answer
+
+        Returns:
+            dict: rtt (s), node_time (clock of the node when it answered), sent and received
+                  (local clock around the round trip) and arm_latency (s); None if the node did not answer
+        """
+        sent = time.time()
+        started = time.perf_counter()
+        response = RPI_PAC_TCP_Node.send_tcp_command(self.ip_address, self.port, "PING", timeout=timeout)
+        rtt = time.perf_counter() - started
+        if not response.startswith("PONG" + self.command_separator):
+            return None
+        _, node_time, arm_latency = response.split(self.command_separator)
+        self.rtt_samples.append(rtt)
+        self.arm_latency = float(arm_latency)
+        return {"rtt": rtt, "node_time": float(node_time), "sent": sent, "received": sent + rtt, "arm_latency": self.arm_latency}
+
+    def estimate_clock_offset(self, samples: int = TIME_SYNC_SAMPLES, timeout: float = COMMAND_TIMEOUT) -> dict:
+        """
+        Estimate the offset of the clock of the node to the local clock, NTP style: a few
+        TIME_SYNC exchanges on one connection, each giving the local send (t1) and receive (t4)
+        times and the node's receive (t2) and send (t3) times. The exchange with the shortest
+        network delay is used, as it has the least room for asymmetric delays; the offset is
+        then known to within half that delay.
+
+        Args:
+            samples (int): Number of exchanges
+            timeout (float): Seconds to wait for an answer
+
+        Returns:
+            dict: offset and uncertainty of the estimate and the delay of the exchange used, in
+                  seconds; None if the node did not answer
+        """
+        best = None
+        try:
+            with socket.create_connection((self.ip_address, self.port), timeout=timeout) as s:
+                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                for _ in range(samples):
+                    t1 = time.time()
+                    payload = f"TIME_SYNC{self.command_separator}{t1:.6f}".encode()
+                    s.sendall(MESSAGE_HEADER.pack(len(payload)) + payload)
+                    response = RPI_PAC_TCP_Node.receive_message(s)
+                    t4 = time.time()
+                    if not response.startswith("TIME" + self.command_separator):
+                        self.logger.error(f"~[tcp] tcpnode:{self.ip_address}:{self.port} - Clock sync refused: {response}")
+                        return None
+                    _, _, t2, t3 = response.split(self.command_separator)
+                    t2, t3 = float(t2), float(t3)
+                    delay = (t4 - t1) - (t3 - t2)
+                    if best is None or delay < best["delay"]:
+                        best = {"offset": ((t2 - t1) + (t3 - t4)) / 2, "uncertainty": delay / 2, "delay": delay}
+        except Exception as e:
+            self.logger.error(f"~[tcp] tcpnode:{self.ip_address}:{self.port} - Error estimating clock offset: {e}")
+            return None
+        self.clock_offset = best["offset"]
+        self.clock_uncertainty = best["uncertainty"]
+        return best
+
+    def rtt(self) -> float:
+        """
+        Returns:
+            float: Slowest of the recent round trips in seconds, None before the first ping
+        """
+        return max(self.rtt_samples) if self.rtt_samples else None
+
+    def start_recording(self, record_time_in_seconds: int, start_time: float, timeout: float = COMMAND_TIMEOUT):
+        """
+        Args:
+            record_time_in_seconds (int): Length of the recording
+            start_time (float): Start time by the local clock; sent to the node by its own clock,
+                                if its clock offset was estimated
+            timeout (float): Seconds to wait for the answer
+        """
         try:
-            command = "START_RECORDING" + self.command_separator + str(record_time_in_seconds) + self.command_separator + str(start_time)
-            response = RPI_PAC_TCP_Node.send_tcp_command(self.ip_address, self.port, command)
+            command = "START_RECORDING" + self.command_separator + str(record_time_in_seconds) + self.command_separator + self.node_start_time(start_time)
+            response = RPI_PAC_TCP_Node.send_tcp_command(self.ip_address, self.port, command, timeout=timeout)
 
             return response
         except Exception as e:
@@ -51,6 +179,40 @@ class RPI_PAC_TCP_Node:
             self.isresponsive = False
             return f"ERROR: {e}"
 
+    def start_continuous(self, segment_time_in_seconds: int, start_time: float, triggered: bool = False, store: bool = True,
+                         timeout: float = COMMAND_TIMEOUT):
+        try:
+            # In triggered mode the node only keeps the audio around detected events, at most segment_time_in_seconds per file
+            # Without store the node only streams the audio live, to the subscribers of its pcm channel
+            if not store:
+                command = "START_STREAMING"
+            else:
+                command = "START_TRIGGERED" if triggered else "START_CONTINUOUS"
+            command = command + self.command_separator + str(segment_time_in_seconds) + self.command_separator + self.node_start_time(start_time)
+            response = RPI_PAC_TCP_Node.send_tcp_command(self.ip_address, self.port, command, timeout=timeout)
+
+            return response
+        except Exception as e:
+            self.logger.error(f"~[tcp] tcpnode:{self.ip_address}:{self.port} - Error starting continuous recording: {e}")
+            self.isresponsive = False
+            return f"ERROR: {e}"
+
+    def node_start_time(self, start_time: float) -> str:
+        """
+        Returns:
+            str: The start time fields of a start command: the start time by the clock of the node,
+                 followed by the clock offset and its uncertainty (stored in every file) if they are known
+        """
+        if self.clock_offset is None:
+            return str(start_time)
+        return self.command_separator.join([f"{start_time + self.clock_offset:.6f}", f"{self.clock_offset:.6f}",
+                                            f"{self.clock_uncertainty:.6f}"])
+
+    def stop_continuous(self):
+        command = "STOP_CONTINUOUS"
+        response = RPI_PAC_TCP_Node.send_tcp_command(self.ip_address, self.port, command)
+        return response
+
     def set_isresponsive(self, isresponsive: bool):
         self.isresponsive = isresponsive
 
@@ -97,14 +259,272 @@ class RPI_PAC_TCP_Node:
             self.logger.error(f"~[tcp] tcpnode:{self.ip_address}:{self.port} - Error listing audio files: {response}")
             return []
 
+    def spectral_summary(self, filename: str) -> dict:
+        """
+        Request the spectral summary of a recording: energy per frequency band, computed on the pi
+        while recording, so a run can be triaged before anything is downloaded.
+
+        Returns:
+            dict: The summary, None if the node has none for this file
+        """
+        command = "SPECTRAL_SUMMARY" + self.command_separator + filename
+        response = RPI_PAC_TCP_Node.send_tcp_command(self.ip_address, self.port, command)
+        if response.startswith("SPECTRAL" + self.command_separator):
+            return json.loads(response.split(self.command_separator, 1)[1])
+        self.logger.info(f"~[tcp] tcpnode:{self.ip_address}:{self.port} - No spectral summary for {filename}: {response}")
+        return None
+
+    def capture_status(self) -> dict:
+        """
+        Request a snapshot of the capture counters of the node.
+
+        Returns:
+            dict: running, runtime, start_time, free_mb and per device a dict of counters
+                  (frames read, bytes written, overruns, queue fill, write latency, ...),
+                  None if the node did not answer
+        """
+        command = "CAPTURE_STATUS"
+        response = RPI_PAC_TCP_Node.send_tcp_command(self.ip_address, self.port, command)
+        if not response.startswith("STATUS" + self.command_separator):
+            self.logger.error(f"~[tcp] tcpnode:{self.ip_address}:{self.port} - Error requesting capture status: {response}")
+            return None
+        status = json.loads(response.split(self.command_separator, 1)[1])
+        fields = status.pop("fields")
+        status["devices"] = [dict(zip(fields, row)) for row in status["devices"]]
+        return status
+
+    def mark_fetched(self, filenames: list[str]) -> int:
+        """
+        Tell the pi which files were fetched but kept on the pi, so it evicts those first when
+        its card runs full.
+
+        Returns:
+            int: Number of files the node marked
+        """
+        command = self.command_separator.join(["MARK_FETCHED"] + filenames)
+        response = RPI_PAC_TCP_Node.send_tcp_command(self.ip_address, self.port, command)
+        if not response.startswith("MARKED" + self.command_separator):
+            self.logger.error(f"~[tcp] tcpnode:{self.ip_address}:{self.port} - Error marking files as fetched: {response}")
+            return 0
+        return int(response.split(self.command_separator)[1])
+
+    def file_info(self, filename: str) -> dict:
+        """
+        Request the size of a file on the node and the checksum its writer computed, e.g. to
+        verify a file fetched over SFTP.
+
+        Returns:
+            dict: size and checksum (a FileChecksum, None if the node has none), None if the node did not answer
+        """
+        command = "FILE_INFO" + self.command_separator + filename
+        response = RPI_PAC_TCP_Node.send_tcp_command(self.ip_address, self.port, command)
+        if not response.startswith("INFO" + self.command_separator):
+            self.logger.error(f"~[tcp] tcpnode:{self.ip_address}:{self.port} - Error requesting info of {filename}: {response}")
+            return None
+        _, _, size, *checksum_fields = response.split(self.command_separator)
+        return {"size": int(size), "checksum": FileChecksum.from_fields(checksum_fields)}
+
+    def fetch_audio_file(self, filename: str, local_directory_path: str) -> dict:
+        """
+        Download a file from the node over its command port, straight to disk and without the
+        encryption overhead of SFTP. The data is written to <file>.part, which is kept when a
+        transfer is interrupted, so the next attempt (or the next call) only requests the
+        missing bytes.
+
+        The node sends the checksum its writer computed along with the data, and the file is
+        verified as it arrives (including the bytes already on disk); a file that does not
+        match is fetched again from the start. A complete local copy from an earlier fetch is
+        verified the same way and not fetched again.
+
+        Args:
+            filename (str): Name of the file on the node
+            local_directory_path (str): Directory to save the file in
+
+        Returns:
+            dict: size, bytes transferred and verified (False if the node had no checksum and
+                  only the size was checked), None if the file was not saved
+        """
+        os.makedirs(local_directory_path, exist_ok=True)
+        local_file_path = os.path.join(local_directory_path, filename)
+        part_path = local_file_path + ".part"
+        for attempt in range(1, FETCH_ATTEMPTS + 1):
+            existing_path = part_path if os.path.exists(part_path) else local_file_path if os.path.exists(local_file_path) else None
+            offset = os.path.getsize(existing_path) if existing_path is not None else 0
+            try:
+                result = self._fetch_file_range(filename, existing_path, part_path, offset)
+            except Exception as e:
+                self.logger.error(f"~[tcp] tcpnode:{self.ip_address}:{self.port} - Error fetching {filename} (attempt {attempt}): {e}")
+                continue
+            if result["response"] == "Invalid range":
+                # The local file is longer than the one on the node, so it is not a part of it; start over
+                os.remove(existing_path)
+                continue
+            if result["size"] is None:
+                self.logger.error(f"~[tcp] tcpnode:{self.ip_address}:{self.port} - Error fetching {filename}: {result['response']}")
+                return None
+
+            fetched_path = part_path if os.path.exists(part_path) else local_file_path
+            if os.path.getsize(fetched_path) != result["size"]:
+                continue
+            checksum = result["checksum"]
+            if checksum is not None and not checksum.matches():
+                self.logger.error(f"~[tcp] tcpnode:{self.ip_address}:{self.port} - Checksum mismatch on {filename} "
+                                  f"(attempt {attempt}), fetching it again")
+                os.remove(fetched_path)
+                continue
+            os.replace(fetched_path, local_file_path)
+            self.fetched_audio_files.append(filename)
+            verified = "verified" if checksum is not None else "size only, no checksum on the node"
+            if result["count"] == 0:
+                self.logger.info(f"~[tcp] tcpnode:{self.ip_address}:{self.port} - {filename} already fetched ({verified})")
+            else:
+                self.logger.info(f"~[tcp] tcpnode:{self.ip_address}:{self.port} - Fetched {filename} "
+                                 f"({result['count']/1024/1024:.1f} of {result['size']/1024/1024:.1f} MB, {verified})")
+            return {"size": result["size"], "transferred": result["count"], "verified": checksum is not None}
+        return None
+
+    def _fetch_file_range(self, filename: str, existing_path: str, part_path: str, offset: int) -> dict:
+        """
+        Request the bytes of a file from offset to the end and append them to part_path,
+        checksumming the first offset bytes (read from existing_path) and the new ones on the way.
+
+        Args:
+            filename (str): Name of the file on the node
+            existing_path (str): Local file holding the first offset bytes (the part file or an
+                                 earlier copy, which becomes the part file if bytes are missing)
+            part_path (str): Path of the part file
+            offset (int): First byte to request
+
+        Returns:
+            dict: response header, size of the file (None if the node refused), bytes received
+                  and the checksum (None if the node has none)
+        """
+        with socket.create_connection((self.ip_address, self.port), timeout=self.fetch_timeout) as s:
+            payload = self.command_separator.join(["FETCH_AUDIO_FILE", filename, str(offset), "0"]).encode()
+            s.sendall(MESSAGE_HEADER.pack(len(payload)) + payload)
+            response = RPI_PAC_TCP_Node.receive_message(s)
+            if not response.startswith("FILE" + self.command_separator):
+                return {"response": response, "size": None, "count": 0, "checksum": None}
+            _, _, _, count, size, *checksum_fields = response.split(self.command_separator)
+            checksum = FileChecksum.from_fields(checksum_fields)
+            remaining = int(count)
+            if checksum is not None and offset:
+                # The data is waiting in the socket buffer meanwhile
+                checksum.update_from_file(existing_path, offset)
+            if remaining and existing_path is not None and existing_path != part_path:
+                os.replace(existing_path, part_path)
+
+            buffer = bytearray(FETCH_CHUNK_BYTES)
+            view = memoryview(buffer)
+            with open(part_path, "ab") if remaining else contextlib.nullcontext() as f:
+                while remaining:
+                    n = s.recv_into(view[:min(remaining, FETCH_CHUNK_BYTES)])
+                    if n == 0:
+                        raise ConnectionError(f"Connection closed with {remaining} bytes to go")
+                    f.write(view[:n])
+                    if checksum is not None:
+                        checksum.update(view[:n])
+                    remaining -= n
+            return {"response": response, "size": int(size), "count": int(count), "checksum": checksum}
+
+    def start_subscription(self, on_event: Callable[["RPI_PAC_TCP_Node", dict], None]):
+        """
+        Subscribe to the events the node pushes (capture_complete, file_ready with file name,
+        size and checksum), on a connection of its own. A background thread keeps the
+        subscription up, reconnecting whenever the node goes away.
+
+        Args:
+            on_event (Callable): Called with this node and the event dict, from the subscription thread
+        """
+        if self.subscription_thread is not None:
+            return
+        self.subscription_stop.clear()
+        self.subscription_thread = threading.Thread(target=self._subscription_loop, args=(on_event,), daemon=True)
+        self.subscription_thread.start()
+
+    def stop_subscription(self):
+        self.subscription_stop.set()
+        if self.subscription_socket is not None:
+            try:
+                # Wakes up the blocking receive
+                self.subscription_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self.subscription_thread is not None:
+            self.subscription_thread.join(timeout=5)
+            self.subscription_thread = None
+
+    def _subscription_loop(self, on_event: Callable[["RPI_PAC_TCP_Node", dict], None]):
+        failing = False
+        while not self.subscription_stop.is_set():
+            try:
+                with socket.create_connection((self.ip_address, self.port), timeout=5) as s:
+                    self.subscription_socket = s
+                    s.settimeout(SUBSCRIPTION_TIMEOUT)
+                    payload = "SUBSCRIBE".encode()
+                    s.sendall(MESSAGE_HEADER.pack(len(payload)) + payload)
+                    response = RPI_PAC_TCP_Node.receive_message(s)
+                    if response != "SUBSCRIBED":
+                        raise ConnectionError(f"Subscription refused: {response}")
+                    self.logger.info(f"~[tcp] tcpnode:{self.ip_address}:{self.port} - Subscribed to events")
+                    failing = False
+                    while not self.subscription_stop.is_set():
+                        message = RPI_PAC_TCP_Node.receive_message(s)
+                        if not message.startswith("EVENT" + self.command_separator):
+                            continue
+                        event = json.loads(message.split(self.command_separator, 1)[1])
+                        try:
+                            on_event(self, event)
+                        except Exception as e:
+                            self.logger.error(f"~[tcp] tcpnode:{self.ip_address}:{self.port} - Error handling event {event}: {e}")
+            except Exception as e:
+                # Only log the first failure, not every retry while the node is down
+                if not failing and not self.subscription_stop.is_set():
+                    self.logger.error(f"~[tcp] tcpnode:{self.ip_address}:{self.port} - Subscription lost: {e}")
+                failing = True
+            finally:
+                self.subscription_socket = None
+            self.subscription_stop.wait(SUBSCRIPTION_RETRY_INTERVAL)
+
     @staticmethod
-    def send_tcp_command(ip_address: str, port: int, command: str):
+    def send_tcp_command(ip_address: str, port: int, command: str, timeout: float = COMMAND_TIMEOUT):
         try:
-            with socket.create_connection((ip_address, port), timeout=5) as s:
-                s.sendall(command.encode())
-                received_data = s.recv(1024).decode()
+            with socket.create_connection((ip_address, port), timeout=timeout) as s:
+                payload = command.encode()
+                s.sendall(MESSAGE_HEADER.pack(len(payload)) + payload)
+                received_data = RPI_PAC_TCP_Node.receive_message(s)
                 logging.info(f"~[@st tcp] tcpnode:{ip_address}:{port} - Received data: {received_data}")
                 return received_data
         except Exception as e:
             logging.error(f"~[@st tcp] tcpnode:{ip_address}:{port} - Error sending command: {e}")
             return f"ERROR: {e}"
+
+    @staticmethod
+    def receive_message(s: socket.socket, decode: bool = True) -> Union[str, bytes]:
+        """
+        Receive one framed message, however many reads it takes.
+
+        Args:
+            s (socket.socket): Connected socket
+            decode (bool): Decode the message as text; False returns the bytes, e.g. of audio chunks
+
+        Returns:
+            Union[str, bytes]: The message
+        """
+        (length,) = MESSAGE_HEADER.unpack(RPI_PAC_TCP_Node._receive_exactly(s, MESSAGE_HEADER.size))
+        if length > MAX_MESSAGE_BYTES:
+            raise ValueError(f"Response of {length} bytes exceeds {MAX_MESSAGE_BYTES} bytes")
+        message = RPI_PAC_TCP_Node._receive_exactly(s, length)
+        return message.decode() if decode else message
+
+    @staticmethod
+    def _receive_exactly(s: socket.socket, size: int) -> bytes:
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        received = 0
+        while received < size:
+            n = s.recv_into(view[received:])
+            if n == 0:
+                raise ConnectionError("Connection closed by node")
+            received += n
+        return bytes(buffer)
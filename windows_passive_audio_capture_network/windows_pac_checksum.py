@@ -0,0 +1,80 @@
+import hashlib
+import os
+
+# Digest size in bytes of the blake2b checksums the pi keeps of its recordings (pac_stream_writer.py)
+CHECKSUM_DIGEST_BYTES = 16
+
+# Bytes read per block when checksumming a local file
+CHECKSUM_BLOCK_BYTES = 1024 * 1024
+
+
+class FileChecksum:
+    """
+    Verifies a file against the checksum the pi computed while writing it, as the bytes of
+    the file come in.
+
+    The pi checksums a file from a given offset to its end (for a WAV file the samples after
+    the header, whose checksum it computes anyway), so bytes before the offset are counted
+    but not hashed. Bytes must be passed in file order, starting with the first byte.
+    """
+
+    def __init__(self, offset: int, expected: str):
+        """
+        Args:
+            offset (int): First byte of the file covered by the checksum
+            expected (str): Hex digest the pi computed
+        """
+        self.offset = offset
+        self.expected = expected
+        self.position = 0
+        self.hash = hashlib.blake2b(digest_size=CHECKSUM_DIGEST_BYTES)
+
+    @classmethod
+    def from_fields(cls, fields: list[str]) -> "FileChecksum":
+        """
+        Args:
+            fields (list[str]): "<offset>", "<checksum>" as sent by the node; may be empty
+
+        Returns:
+            FileChecksum: A checksum to verify against, None if the node sent none
+        """
+        if len(fields) < 2 or not fields[1]:
+            return None
+        return cls(int(fields[0]), fields[1])
+
+    def update(self, data):
+        """
+        Args:
+            data (bytes-like): The next bytes of the file
+        """
+        skip = max(0, self.offset - self.position)
+        if skip < len(data):
+            self.hash.update(memoryview(data)[skip:])
+        self.position += len(data)
+
+    def update_from_file(self, path: str, size: int = None):
+        """
+        Feed the first bytes of a local file, e.g. the part of an interrupted transfer.
+
+        Args:
+            path (str): Path of the file
+            size (int, optional): Number of bytes to read (default: all of them)
+        """
+        remaining = os.path.getsize(path) if size is None else size
+        with open(path, "rb") as f:
+            while remaining:
+                block = f.read(min(remaining, CHECKSUM_BLOCK_BYTES))
+                if not block:
+                    raise EOFError(f"{path} ended {remaining} bytes early")
+                self.update(block)
+                remaining -= len(block)
+
+    def hexdigest(self) -> str:
+        return self.hash.hexdigest()
+
+    def matches(self) -> bool:
+        """
+        Returns:
+            bool: True if the bytes passed so far are the file the pi checksummed
+        """
+        return self.hexdigest() == self.expected
@@ -12,10 +12,29 @@ from RPI_pac_tcp_node import RPI_PAC_TCP_Node
 from RPI_pac_scp_node import RPI_PAC_SCP_Node
 from windows_pac_scheduler import WindowsPACScheduler
 from windows_pac_file_handler import WindowsPACFileHandler
+from windows_pac_stream_receiver import WindowsPACStreamReceiver
 from windows_pac_plotter import WindowsPACPlotter
+from windows_pac_run_assembler import WindowsPACRunAssembler, RECORDING_EXTENSIONS
 import windows_pac_logger as logger_
 
 
+class CaptureEnd:
+    """
+    Queued after the files of a capture, so the files fetched up to it are assembled into
+    one run.
+    """
+    def __init__(self, start_time: float, end_time: float, complete: bool = True):
+        """
+        Args:
+            start_time (float): Start of the capture (controller clock)
+            end_time (float): End of the capture (controller clock)
+            complete (bool): False if a node did not finish the capture; its files are fetched, but not assembled
+        """
+        self.start_time = start_time
+        self.end_time = end_time
+        self.complete = complete
+
+
 class WindowsPACController:
     """
     This class is responsible for coordinating the passive audio capture process.
@@ -61,6 +80,36 @@ class WindowsPACController:
             self.file_handler.add_rpi_scp_node(rpi_pac_scp_node)
             
         self.plotter = WindowsPACPlotter()
+        # Combines the files of a run into one time-aligned multi-channel store once fetched
+        self.run_assembler = WindowsPACRunAssembler(config, self.logger) if config.get('assemble_runs', False) else None
+
+        # Queue of the running sequence, so file_ready events can queue files for fetching
+        self.file_path_queue: queue.Queue = None
+        # The nodes push capture_complete and file_ready events, instead of being polled
+        for rpi_pac_node in self.rpi_pac_nodes:
+            rpi_pac_node.start_subscription(self.on_node_event)
+
+    def on_node_event(self, rpi_pac_node: RPI_PAC_TCP_Node, event: dict):
+        """
+        Handles an event pushed by a node: marks its capture complete, or starts fetching a
+        file the moment it is ready. Runs on the subscription thread of the node.
+        """
+        if event["type"] == "capture_complete":
+            self.logger.info(f"~[pac-ctrl] {rpi_pac_node.name} finished its capture")
+            self.scheduler.set_capture_complete(rpi_pac_node.name)
+        elif event["type"] == "file_ready":
+            file_path_queue = self.file_path_queue
+            if file_path_queue is None:
+                return
+            remote_audio_file_paths = self.file_handler.claim_files({rpi_pac_node.name: [event["file"]]})
+            if remote_audio_file_paths:
+                self.logger.info(f"~[pac-ctrl] {rpi_pac_node.name} has {event['file']} ready ({event['size']} bytes)")
+                file_path_queue.put(remote_audio_file_paths)
+
+    def shutdown(self):
+        for rpi_pac_node in self.rpi_pac_nodes:
+            rpi_pac_node.stop_subscription()
+        self.file_handler.close()
 
     def passive_audio_capture(self, runtime=15.0, calibrate=False):
         # print(self.config)
@@ -72,22 +121,22 @@ class WindowsPACController:
 
         # 1. Schedule capture
         self.logger.info(f"~[pac-ctrl] Scheduling capture of {runtime} seconds")
-        self.scheduler.schedule_capture(runtime)
+        active_nodes_names = self.scheduler.schedule_capture(runtime)
 
-        # 3. Poll/Wait for capture to complete
-        while True:
-            time.sleep(5)
-            self.logger.info("~[pac-ctrl] Polling for capture to complete...")
-            if self.scheduler.is_capture_complete():
-                self.logger.info("~[pac-ctrl] Capture complete!")
-                break
+        # 3. Wait for the nodes to report the capture complete
+        if not self.scheduler.wait_for_capture_complete(active_nodes_names):
+            pending = self.scheduler.abort_capture(active_nodes_names)
+            self.logger.error(f"~[pac-ctrl] Capture not complete on {pending}, not fetching it")
+            return
 
         # 4. Find audio files + fetch them over scp & save to folder
         self.logger.info("~[pac-ctrl] Fetching audio files...")
-        self.file_handler.fetch_audio_files()
+        fetch_result = self.file_handler.fetch_audio_files()
 
 
         # 5. process audio files
+        run_files = self.add_run_files({}, fetch_result)
+        self.assemble_run(run_files, CaptureEnd(self.scheduler.start_time, self.scheduler.start_time + runtime))
 
         # 6. plot results in html
 
@@ -99,6 +148,7 @@ class WindowsPACController:
         self.running = True
 
         file_path_queue = queue.Queue()
+        self.file_path_queue = file_path_queue
         process_audio_files_thread = threading.Thread(target=self.process_audio_files_thread, args=(file_path_queue,))
         process_audio_files_thread.start()
 
@@ -110,6 +160,7 @@ class WindowsPACController:
 
         passive_audio_capture_thread.join()
         process_audio_files_thread.join()
+        self.file_path_queue = None
 
     def passive_audio_capture_thread(self, file_path_queue: queue.Queue, runtime=15.0, repetitions=1, calibrate=False):
         try:
@@ -122,24 +173,106 @@ class WindowsPACController:
                     self.logger.info("~[pac-ctrl] No active nodes, skipping capture")
                     continue
 
-                while True:
-                    time.sleep(10)
-                    self.logger.info("~[pac-ctrl] Polling for capture to complete...")
-                    if self.scheduler.is_capture_complete(active_nodes_names):
-                        self.logger.info("~[pac-ctrl] Capture complete!")
-                        break
-                
+                # Files are queued by their file_ready events as the nodes finish them
+                capture_end = CaptureEnd(self.scheduler.start_time, self.scheduler.start_time + runtime)
+                if not self.scheduler.wait_for_capture_complete(active_nodes_names):
+                    # Files the other nodes announced are still fetched
+                    pending = self.scheduler.abort_capture(active_nodes_names)
+                    self.logger.error(f"~[pac-ctrl] Capture {_ + 1} of {repetitions} not complete on {pending}, skipping it")
+                    capture_end.complete = False
+                    file_path_queue.put(capture_end)
+                    continue
+
+                # Anything an event did not announce, e.g. while a subscription was down
                 self.logger.info("~[pac-ctrl] polling for audio files...")
                 remote_audio_file_paths = self.file_handler.get_remote_audio_file_paths()
-                        
-                file_path_queue.put(remote_audio_file_paths)
+                if remote_audio_file_paths:
+                    file_path_queue.put(remote_audio_file_paths)
+                file_path_queue.put(capture_end)
         except Exception as e:
             self.logger.error(f"~[pac-ctrl] Error in passive audio capture thread: {e}")
         finally:
             self.logger.info("~[pac-ctrl] Passive audio capture thread finished, setting running to False")
             self.running = False
+            file_path_queue.put(None)
+
+    def run_continuous(self, segment_time=60, duration=None, triggered=False, stream=False, store_on_node=True):
+        """
+        Runs a gapless continuous capture on all nodes, fetching every finished segment
+        while the nodes keep recording.
+
+        Args:
+            segment_time (int): Length of a segment in seconds (the maximum event length if triggered)
+            duration (float, optional): Total duration in seconds, None to run until interrupted
+            triggered (bool): Only record the audio around events detected on the nodes
+            stream (bool): Also receive the audio live and write it to local storage as it is recorded
+            store_on_node (bool): Let the nodes record to their cards; False only streams
+        """
+        self.running = True
+
+        stream_receiver = None
+        if stream or not store_on_node:
+            # Connect before the capture starts, so the first chunk is not missed
+            stream_receiver = WindowsPACStreamReceiver(self.config, self.logger)
+            for rpi_pac_node in self.rpi_pac_nodes:
+                stream_receiver.add_rpi_pac_node(rpi_pac_node)
+            stream_receiver.start()
+
+        file_path_queue = queue.Queue()
+        self.file_path_queue = file_path_queue
+        process_audio_files_thread = threading.Thread(target=self.process_audio_files_thread, args=(file_path_queue,))
+        process_audio_files_thread.start()
+
+        passive_audio_continuous_thread = threading.Thread(target=self.passive_audio_continuous_thread, args=(file_path_queue, segment_time, duration, triggered, store_on_node))
+        passive_audio_continuous_thread.start()
+
+        try:
+            while self.running:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            self.logger.info("~[pac-ctrl] Interrupted, stopping continuous capture...")
+            self.running = False
+
+        passive_audio_continuous_thread.join()
+        process_audio_files_thread.join()
+        self.file_path_queue = None
+        if stream_receiver is not None:
+            stream_receiver.stop()
+
+    def passive_audio_continuous_thread(self, file_path_queue: queue.Queue, segment_time=60, duration=None, triggered=False, store_on_node=True):
+        active_nodes_names = []
+        try:
+            active_nodes_names = self.scheduler.schedule_continuous(segment_time, triggered, store_on_node)
+            if not active_nodes_names:
+                self.logger.info("~[pac-ctrl] No active nodes, skipping continuous capture")
+                return
+
+            end_time = None if duration is None else self.scheduler.start_time + duration
+            while self.running and (end_time is None or time.time() < end_time):
+                time.sleep(segment_time)
+                self.scheduler.log_capture_status(active_nodes_names)
+                # Segments are queued by their file_ready events; this only catches ones an event missed
+                self.logger.info("~[pac-ctrl] polling for finished segments...")
+                remote_audio_file_paths = self.file_handler.get_remote_audio_file_paths()
+                if remote_audio_file_paths:
+                    file_path_queue.put(remote_audio_file_paths)
+        except Exception as e:
+            self.logger.error(f"~[pac-ctrl] Error in continuous capture thread: {e}")
+        finally:
+            if active_nodes_names:
+                self.scheduler.stop_continuous(active_nodes_names)
+                # Give the nodes time to close (and encode) their last segment
+                time.sleep(5)
+                file_path_queue.put(self.file_handler.get_remote_audio_file_paths())
+                if store_on_node:
+                    file_path_queue.put(CaptureEnd(self.scheduler.start_time, time.time()))
+            self.logger.info("~[pac-ctrl] Continuous capture thread finished, setting running to False")
+            self.running = False
+            file_path_queue.put(None)
 
     def process_audio_files_thread(self, file_path_queue):
+        # Files fetched since the last capture ended, assembled into a run when the next CaptureEnd comes
+        run_files: dict[str, list[str]] = {}
         while self.running or not file_path_queue.empty():
             try:
                 remote_audio_file_paths = file_path_queue.get()
@@ -147,16 +280,93 @@ class WindowsPACController:
                     self.logger.info("~[pac-ctrl] No audio files to process")
                     time.sleep(10)
                     continue
+                elif isinstance(remote_audio_file_paths, CaptureEnd):
+                    run_files, capture_run_files = {}, run_files
+                    self.assemble_run(capture_run_files, remote_audio_file_paths)
+                    continue
                 else:
-                    self.logger.info(f"~[pac-ctrl] Processing audio files: {remote_audio_file_paths}")
-                    self.file_handler.fetch_audio_files(remote_audio_file_paths)
+                    # Take everything queued meanwhile (e.g. a file_ready event per file), so the
+                    # files are fetched in parallel instead of one call per file
+                    remote_audio_file_paths, capture_end = self.merge_queued_file_paths(file_path_queue, remote_audio_file_paths)
+                    try:
+                        if self.config.get("triage_min_band_db") is not None:
+                            # Decide from the spectral summaries what is worth downloading
+                            remote_audio_file_paths = self.file_handler.triage_audio_files(remote_audio_file_paths, self.config["triage_min_band_db"])
+                            if not remote_audio_file_paths:
+                                continue
+                        self.logger.info(f"~[pac-ctrl] Processing audio files: {remote_audio_file_paths}")
+                        run_files = self.add_run_files(run_files, self.file_handler.fetch_audio_files(remote_audio_file_paths))
+                    finally:
+                        if capture_end is not None:
+                            run_files, capture_run_files = {}, run_files
+                            self.assemble_run(capture_run_files, capture_end)
             except Exception as e:
                 self.logger.error(f"~[pac-ctrl] Error processing audio files: {e}")
                 time.sleep(10)
 
+    def add_run_files(self, run_files: dict[str, list[str]], fetch_result: dict) -> dict[str, list[str]]:
+        """
+        Returns:
+            dict: {rpi name: [file names]} of run_files and the recordings fetched in fetch_result,
+                  if runs are assembled
+        """
+        if self.run_assembler is None or not fetch_result:
+            return run_files
+        for rpi_name, node_result in fetch_result["nodes"].items():
+            files = run_files.setdefault(rpi_name, [])
+            files.extend(file for file in node_result["fetched_files"] if file.endswith(RECORDING_EXTENSIONS) and file not in files)
+        return run_files
+
+    def assemble_run(self, run_files: dict[str, list[str]], capture_end: CaptureEnd):
+        """
+        Assemble the recordings fetched for a capture into a run store, if runs are assembled.
+        Recordings without samples in the capture, e.g. those of an earlier capture that were
+        fetched late, are left out.
+        """
+        if self.run_assembler is None:
+            return
+        if not capture_end.complete:
+            self.logger.error(f"~[pac-ctrl] Not assembling the capture at {capture_end.start_time}, not all nodes finished it")
+            return
+        if not any(run_files.values()):
+            self.logger.info(f"~[pac-ctrl] No recordings fetched for the capture at {capture_end.start_time}, nothing to assemble")
+            return
+        try:
+            self.run_assembler.assemble(run_files, start_time=capture_end.start_time, end_time=capture_end.end_time)
+        except Exception as e:
+            self.logger.error(f"~[pac-ctrl] Error assembling run: {e}")
+
+
+    @staticmethod
+    def merge_queued_file_paths(file_path_queue: queue.Queue, remote_audio_file_paths: dict[str, list[str]]) -> tuple[dict[str, list[str]], CaptureEnd]:
+        """
+        Returns:
+            tuple[dict, CaptureEnd]: {rpi name: [file names]} of remote_audio_file_paths and every entry waiting in the
+                                     queue up to the end of a capture, and that CaptureEnd (None if the queue ran empty first)
+        """
+        merged = {rpi_name: list(files) for rpi_name, files in remote_audio_file_paths.items()}
+        while True:
+            try:
+                queued = file_path_queue.get_nowait()
+            except queue.Empty:
+                break
+            if queued is None:
+                # Keep the end-of-run marker for the next round of the loop
+                file_path_queue.put(None)
+                break
+            if isinstance(queued, CaptureEnd):
+                # Files queued after it belong to the next capture
+                return merged, queued
+            for rpi_name, files in queued.items():
+                merged.setdefault(rpi_name, []).extend(file for file in files if file not in merged[rpi_name])
+        return merged, None
+
 
 if __name__ == "__main__":
     config = json.load(open(os.path.join(os.path.dirname(__file__), 'config.json')))
     controller = WindowsPACController(config, demo_mode=True)
-    controller.run_sequence(runtime=10.0, repetitions=2, calibrate=False)
+    try:
+        controller.run_sequence(runtime=10.0, repetitions=2, calibrate=False)
+    finally:
+        controller.shutdown()
 
@@ -1,11 +1,21 @@
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 
 from RPI_pac_tcp_node import RPI_PAC_TCP_Node
 from RPI_pac_scp_node import RPI_PAC_SCP_Node 
+from windows_pac_checksum import FileChecksum
 
 import logging
 
+# Transfers running at the same time over all nodes; beyond a few the disk and network of the controller are the limit
+FETCH_WORKERS = 8
+
+# Transfers running at the same time from a single node; a pi is limited by its card and link well before this
+FETCH_WORKERS_PER_NODE = 2
+
 class WindowsPACFileHandler:
     def __init__(self, config: dict, logger: logging.Logger):
         self.rpi_pac_nodes: list[RPI_PAC_TCP_Node] = []
@@ -17,29 +27,134 @@ class WindowsPACFileHandler:
 
         self.local_storage_path = config['local_storage_path']
         self.remote_storage_path = config['remote_storage_path']
+        # "tcp": fetch over the command port of the node, falling back to SFTP; "sftp": SFTP only
+        self.fetch_protocol = config.get('fetch_protocol', 'tcp')
+
+        # (rpi name, file name) of the files queued or being fetched, so a file announced by an
+        # event and listed by a poll is fetched once
+        self.claimed_files: set[tuple[str, str]] = set()
+        self.claimed_files_lock = threading.Lock()
+
+        # Nodes by name, and the transfer slots shared by every fetch running at the same time:
+        # one pool for all nodes, and one per node
+        self.rpi_pac_nodes_by_name: dict[str, RPI_PAC_TCP_Node] = {}
+        self.rpi_scp_nodes_by_name: dict[str, RPI_PAC_SCP_Node] = {}
+        self.fetch_workers_per_node = config.get('fetch_workers_per_node', FETCH_WORKERS_PER_NODE)
+        self.fetch_slots = threading.BoundedSemaphore(config.get('fetch_workers', FETCH_WORKERS))
+        self.node_fetch_slots: dict[str, threading.BoundedSemaphore] = {}
 
     def add_rpi_pac_node(self, rpi_pac_node):
         self.rpi_pac_nodes.append(rpi_pac_node)
+        self.rpi_pac_nodes_by_name[rpi_pac_node.name] = rpi_pac_node
+        self.node_fetch_slots.setdefault(rpi_pac_node.name, threading.BoundedSemaphore(self.fetch_workers_per_node))
 
     def add_rpi_scp_node(self, rpi_scp_node):
         self.rpi_scp_nodes.append(rpi_scp_node)
+        self.rpi_scp_nodes_by_name[rpi_scp_node.name] = rpi_scp_node
+        self.node_fetch_slots.setdefault(rpi_scp_node.name, threading.BoundedSemaphore(self.fetch_workers_per_node))
         os.makedirs(os.path.join(self.local_storage_path, rpi_scp_node.name), exist_ok=True)
     
-    def fetch_audio_files(self, remote_audio_file_paths: dict[str, list[str]] = None, delete_remote_files: bool = True):
-        
+    def fetch_audio_files(self, remote_audio_file_paths: dict[str, list[str]] = None, delete_remote_files: bool = True) -> dict:
+        """
+        Fetch files from all nodes at the same time, at most fetch_workers_per_node transfers
+        per node and fetch_workers in total (also over fetch calls running at the same time),
+        so the total time is that of the slowest node instead of the sum of all transfers.
+        Every node deletes or marks its fetched files as soon as its own transfers are done.
+
+        Only files verified against the checksum the node computed while writing them are
+        deleted from the node; a file the node has no checksum for is kept there (and marked
+        as fetched), so a transfer that went wrong in a way its size does not show can be
+        fetched again.
+
+        Args:
+            remote_audio_file_paths (dict, optional): {rpi name: [file names]}; default: list and claim the new files
+            delete_remote_files (bool): Delete the verified files from the nodes once fetched
+
+        Returns:
+            dict: Number of files fetched, unverified and failed, MB fetched, elapsed seconds and MB/s, in total and per
+                  node, and per node the names of the files fetched
+        """
         remote_audio_file_paths = remote_audio_file_paths or self.get_remote_audio_file_paths()
-        
-        for rpi_name, remote_audio_file_paths in remote_audio_file_paths.items():
-            for remote_audio_file_path in remote_audio_file_paths:
-                fetch_success = self.fetch_audio_file([rpi_name, remote_audio_file_path])
-                if fetch_success:
-                    if delete_remote_files:
-                        self.logger.info(f"~[fileh] deleting remote file {remote_audio_file_path}")
-                        self.delete_remote_audio_file([rpi_name, remote_audio_file_path])
-                    else:
-                        self.logger.info(f"~[fileh] not deleting remote file")
-                else:
-                    self.logger.info(f"~[fileh] failed to fetch audio file {remote_audio_file_path} from {rpi_name}")
+        if not remote_audio_file_paths:
+            return {}
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=len(remote_audio_file_paths), thread_name_prefix="fetch_node") as executor:
+            node_results = dict(zip(remote_audio_file_paths, executor.map(
+                lambda item: self._fetch_node_audio_files(item[0], item[1], delete_remote_files), remote_audio_file_paths.items())))
+        elapsed = time.perf_counter() - started
+
+        fetched_mb = sum(result["mb"] for result in node_results.values())
+        result = {
+            "files": sum(result["files"] for result in node_results.values()),
+            "unverified": sum(result["unverified"] for result in node_results.values()),
+            "failed": sum(result["failed"] for result in node_results.values()),
+            "mb": round(fetched_mb, 1),
+            "elapsed_s": round(elapsed, 2),
+            "mb_per_s": round(fetched_mb / elapsed, 1) if elapsed else 0.0,
+            "nodes": node_results,
+        }
+        self.logger.info(f"~[fileh] Fetched {result['files']} files ({result['mb']} MB) from {len(node_results)} nodes in "
+                         f"{result['elapsed_s']} s: {result['mb_per_s']} MB/s"
+                         + (f", {result['unverified']} unverified" if result['unverified'] else "")
+                         + (f", {result['failed']} failed" if result['failed'] else "") + " ("
+                         + ", ".join(f"{name}: {node['mb_per_s']} MB/s" for name, node in node_results.items()) + ")")
+        return result
+
+    def _fetch_node_audio_files(self, rpi_name: str, filenames: list[str], delete_remote_files: bool) -> dict:
+        started = time.perf_counter()
+        workers = max(1, min(self.fetch_workers_per_node, len(filenames)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"fetch_{rpi_name}") as executor:
+            results = dict(zip(filenames, executor.map(lambda filename: self._fetch_audio_file_in_slot(rpi_name, filename), filenames)))
+        elapsed = time.perf_counter() - started
+
+        fetched_files = [filename for filename, result in results.items() if result is not None]
+        verified_files = [filename for filename in fetched_files if results[filename][1]]
+        for remote_audio_file_path in filenames:
+            if remote_audio_file_path not in fetched_files:
+                # Released, so the next listing claims it again and the fetch is retried
+                self.logger.info(f"~[fileh] failed to fetch audio file {remote_audio_file_path} from {rpi_name}")
+                self.release_file(rpi_name, remote_audio_file_path)
+        deleted_files = verified_files if delete_remote_files else []
+        if deleted_files:
+            self.logger.info(f"~[fileh] deleting {len(deleted_files)} verified remote files from {rpi_name}")
+            self.delete_remote_audio_files(rpi_name, deleted_files)
+            for remote_audio_file_path in deleted_files:
+                self.release_file(rpi_name, remote_audio_file_path)
+        kept_files = [filename for filename in fetched_files if filename not in deleted_files]
+        if kept_files:
+            # Stay claimed, so they are not fetched again while the node keeps listing them.
+            # Fetched files left on the pi are the first it evicts when its card runs full
+            if delete_remote_files:
+                self.logger.info(f"~[fileh] not deleting {len(kept_files)} remote files from {rpi_name}: no checksum to verify them")
+            else:
+                self.logger.info(f"~[fileh] not deleting remote files")
+            if rpi_name in self.rpi_pac_nodes_by_name:
+                self.rpi_pac_nodes_by_name[rpi_name].mark_fetched(kept_files)
+
+        fetched_mb = sum(result[0] for result in results.values() if result is not None) / 1024 / 1024
+        return {
+            "files": len(fetched_files),
+            "fetched_files": fetched_files,
+            "unverified": len(fetched_files) - len(verified_files),
+            "failed": len(filenames) - len(fetched_files),
+            "mb": round(fetched_mb, 1),
+            "elapsed_s": round(elapsed, 2),
+            "mb_per_s": round(fetched_mb / elapsed, 1) if elapsed else 0.0,
+        }
+
+    def _fetch_audio_file_in_slot(self, rpi_name: str, filename: str) -> tuple[int, bool]:
+        """
+        Returns:
+            tuple[int, bool]: Size of the fetched file in bytes and whether it was verified, None if it was not fetched
+        """
+        # Node slot first, so a transfer waiting for its busy node never holds a global slot
+        node_slots = self.node_fetch_slots.setdefault(rpi_name, threading.BoundedSemaphore(self.fetch_workers_per_node))
+        with node_slots, self.fetch_slots:
+            fetched = self.fetch_node_audio_files(rpi_name, [filename])
+        if filename not in fetched:
+            return None
+        return os.path.getsize(os.path.join(self.local_storage_path, rpi_name, filename)), fetched[filename]
 
     def get_remote_audio_file_paths(self) -> dict[str, list[str]]:
         remote_audio_file_paths = {}
@@ -48,42 +163,154 @@ class WindowsPACFileHandler:
             if files:
                 remote_audio_file_paths[rpi_pac_node.name] = files
         # self.logger.info(f"~[fileh] Remote audio file paths: {remote_audio_file_paths}")
-        return remote_audio_file_paths
+        return self.claim_files(remote_audio_file_paths)
+
+    def claim_files(self, remote_audio_file_paths: dict[str, list[str]]) -> dict[str, list[str]]:
+        """
+        Claim files for fetching. Files that are already queued or being fetched are left out,
+        so the same file announced by a file_ready event and listed by a poll is fetched once.
+        A claim is released when the file was fetched and deleted from the node, or its fetch
+        failed; files kept on the node or skipped by triage stay claimed, so they are not
+        fetched or triaged again on every poll.
+
+        Args:
+            remote_audio_file_paths (dict): {rpi name: [file names]}
+
+        Returns:
+            dict: {rpi name: [file names]} that were not claimed yet
+        """
+        claimed = {}
+        with self.claimed_files_lock:
+            for rpi_name, files in remote_audio_file_paths.items():
+                new_files = [file for file in files if (rpi_name, file) not in self.claimed_files]
+                self.claimed_files.update((rpi_name, file) for file in new_files)
+                if new_files:
+                    claimed[rpi_name] = new_files
+        return claimed
+
+    def release_file(self, rpi_name: str, filename: str):
+        with self.claimed_files_lock:
+            self.claimed_files.discard((rpi_name, filename))
     
+    def get_spectral_summaries(self, remote_audio_file_paths: dict[str, list[str]]) -> dict[str, dict[str, dict]]:
+        """
+        Request the spectral summary of every listed file from its node.
+
+        Returns:
+            dict: {rpi name: {file name: summary or None}}
+        """
+        summaries = {}
+        for rpi_pac_node in self.rpi_pac_nodes:
+            files = remote_audio_file_paths.get(rpi_pac_node.name, [])
+            summaries[rpi_pac_node.name] = {file: rpi_pac_node.spectral_summary(file) for file in files}
+        return summaries
+
+    def triage_audio_files(self, remote_audio_file_paths: dict[str, list[str]], min_band_db: float) -> dict[str, list[str]]:
+        """
+        Keep only the files in which at least one frequency band reached min_band_db.
+        Files without a summary are kept, so nothing is skipped unseen.
+
+        Args:
+            remote_audio_file_paths (dict): {rpi name: [file names]}
+            min_band_db (float): Band energy (dB full scale) a file must reach to be fetched
+
+        Returns:
+            dict: {rpi name: [file names]} worth fetching
+        """
+        selected = {}
+        for rpi_name, files in self.get_spectral_summaries(remote_audio_file_paths).items():
+            keep = []
+            for file, summary in files.items():
+                if summary is None or max(summary.get("band_max_db", [min_band_db]), default=min_band_db) >= min_band_db:
+                    keep.append(file)
+                else:
+                    self.logger.info(f"~[fileh] skipping quiet file {file} from {rpi_name}: band max {summary['band_max_db']} dB")
+            if keep:
+                selected[rpi_name] = keep
+        return selected
+
     def fetch_audio_file(self, remote_audio_file_path: tuple[str, str]) -> bool:
-        self.logger.info(f"~[fileh] Trying to fetch audio file {remote_audio_file_path[1]} from {remote_audio_file_path[0]}")
-        success = False
+        return remote_audio_file_path[1] in self.fetch_node_audio_files(remote_audio_file_path[0], [remote_audio_file_path[1]])
 
-        try:
-            for rpi_scp_node in self.rpi_scp_nodes:
-                if rpi_scp_node.name == remote_audio_file_path[0]:
-                    self.logger.info(f"~[fileh] Fetching audio file {remote_audio_file_path[1]} from {remote_audio_file_path[0]}")
-                    node_specific_local_storage_path = os.path.join(self.local_storage_path, rpi_scp_node.name)
-                    
-                    rpi_scp_node.download_scp_file(node_specific_local_storage_path, self.remote_storage_path, remote_audio_file_path[1])
-                    
-                    if os.path.exists(os.path.join(node_specific_local_storage_path, remote_audio_file_path[1])):
-                        self.logger.info(f"~[fileh] Audio file {remote_audio_file_path[1]} fetched from {remote_audio_file_path[0]}")
-                        success = True
-                        break
-                    else:
-                        self.logger.info(f"~[fileh] Audio file {remote_audio_file_path[1]} not found on {remote_audio_file_path[0]}")
-                        success = False
-                    
+    def fetch_node_audio_files(self, rpi_name: str, filenames: list[str]) -> dict[str, bool]:
+        """
+        Fetch files from one node: over tcp first (if enabled), and whatever that did not
+        fetch in one batch over the pooled SFTP session of the node. Both verify a file against
+        the checksum of the node as it arrives, resume partial files and leave a local copy
+        that already matches alone.
+
+        Args:
+            rpi_name (str): Name of the node
+            filenames (list[str]): Names of the files to fetch
+
+        Returns:
+            dict[str, bool]: {name: verified} of the files fetched; verified is False if only the size was checked
+        """
+        self.logger.info(f"~[fileh] Trying to fetch {len(filenames)} audio files from {rpi_name}")
+        node_specific_local_storage_path = os.path.join(self.local_storage_path, rpi_name)
+        fetched = {}
+
+        if self.fetch_protocol == "tcp" and rpi_name in self.rpi_pac_nodes_by_name:
+            rpi_pac_node = self.rpi_pac_nodes_by_name[rpi_name]
+            for filename in filenames:
+                result = rpi_pac_node.fetch_audio_file(filename, node_specific_local_storage_path)
+                if result is not None:
+                    fetched[filename] = result["verified"]
                 else:
-                    self.logger.info(f"~[fileh] No RPI SCP node found for {remote_audio_file_path[0]}")
-                    success = False
+                    self.logger.info(f"~[fileh] Fetching {filename} over tcp failed, trying sftp")
+
+        remaining = [filename for filename in filenames if filename not in fetched]
+        if not remaining:
+            return fetched
+        if rpi_name not in self.rpi_scp_nodes_by_name:
+            self.logger.info(f"~[fileh] No RPI SCP node found for {rpi_name}")
+            return fetched
+        try:
+            self.logger.info(f"~[fileh] Fetching {len(remaining)} audio files from {rpi_name} over sftp")
+            rpi_scp_node = self.rpi_scp_nodes_by_name[rpi_name]
+            downloaded = rpi_scp_node.download_scp_files(node_specific_local_storage_path, self.remote_storage_path, remaining,
+                                                         self.get_file_checksums(rpi_name, remaining))
+            for filename, verified in downloaded.items():
+                self.logger.info(f"~[fileh] Audio file {filename} fetched from {rpi_name}")
+                fetched[filename] = verified
         except Exception as e:
-            self.logger.error(f"~[fileh] Error fetching audio file {remote_audio_file_path[1]} from {remote_audio_file_path[0]}: {e}")
-            success = False
+            self.logger.error(f"~[fileh] Error fetching audio files {remaining} from {rpi_name}: {e}")
 
-        return success
+        return fetched
+
+    def get_file_checksums(self, rpi_name: str, filenames: list[str]) -> dict[str, FileChecksum]:
+        """
+        Ask the node for the checksums of files to fetch over SFTP, which has no checksums of its own.
+
+        Returns:
+            dict[str, FileChecksum]: Checksum by file name, for the files the node has one for
+        """
+        if rpi_name not in self.rpi_pac_nodes_by_name:
+            return {}
+        checksums = {}
+        for filename in filenames:
+            try:
+                info = self.rpi_pac_nodes_by_name[rpi_name].file_info(filename)
+            except Exception as e:
+                self.logger.error(f"~[fileh] Error requesting the checksum of {filename} from {rpi_name}: {e}")
+                continue
+            if info is not None and info["checksum"] is not None:
+                checksums[filename] = info["checksum"]
+        return checksums
 
     def delete_remote_audio_file(self, remote_audio_file_path: tuple[str, str]):
+        self.delete_remote_audio_files(remote_audio_file_path[0], [remote_audio_file_path[1]])
+
+    def delete_remote_audio_files(self, rpi_name: str, filenames: list[str]):
         try:
-            for rpi_scp_node in self.rpi_scp_nodes:
-                if rpi_scp_node.name == remote_audio_file_path[0]:
-                    # self.logger.info(f"~[fileh] Deleting audio file {remote_audio_file_path[1]} from {remote_audio_file_path[0]}")
-                    rpi_scp_node.delete_scp_file(self.remote_storage_path, remote_audio_file_path[1])
+            if rpi_name in self.rpi_scp_nodes_by_name:
+                self.rpi_scp_nodes_by_name[rpi_name].delete_scp_files(self.remote_storage_path, filenames)
         except Exception as e:
-            self.logger.error(f"~[fileh] Error deleting audio file {remote_audio_file_path[1]} from {remote_audio_file_path[0]}: {e}")
+            self.logger.error(f"~[fileh] Error deleting audio files {filenames} from {rpi_name}: {e}")
+
+    def close(self):
+        """
+        Close the SFTP sessions kept open to the nodes.
+        """
+        for rpi_scp_node in self.rpi_scp_nodes:
+            rpi_scp_node.close()
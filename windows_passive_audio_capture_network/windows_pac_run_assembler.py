@@ -0,0 +1,502 @@
+"""
+Run assembler.
+
+Combines the recordings of all sensors of a run, fetched as one mono file per node and
+device (local_storage_path/<node>/), into a single time-aligned multi-channel store:
+
+    <run_store_path>/<run name>/
+        manifest.json       sample rate, start time, channel labels and the files behind every channel
+        chunk_00000.npy     int16 array of chunk_frames x channels, frame-major
+        chunk_00001.npy
+        ...
+
+Every chunk is a plain .npy file, so a slice of a run is read by memory-mapping only the
+chunks it spans, all channels at once, without opening or decoding any recording:
+
+    store = RunStore(r"C:\\...\\runs\\run_2026_10_18_09_30_35")
+    samples = store.slice(120.0, 125.0)                                         # frames x 6 channels
+    pest = store.slice(120.0, 125.0, store.channels_where(experiment_group="pest"))
+
+Files are aligned on the time of their first sample, in controller time: the pi stores the
+time of the first sample and the offset of its clock to the controller (as estimated when
+the capture was started) in the metadata of every file. Channels are labelled from
+sensor_allocation.json. Periods no file of a channel covers are zero; the segments of a
+channel in the manifest list what is covered. Where recordings of a channel overlap, the
+samples of the earlier one are kept.
+
+From the command line, all files recorded between two times:
+
+    python windows_pac_run_assembler.py --start "2026-10-18 09:30:00" --end "2026-10-18 09:40:00"
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import shutil
+import struct
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+import soundfile as sf
+
+# Seconds of audio per chunk of a run store; a slice reads whole chunks, so this bounds the overhead of a short slice
+RUN_CHUNK_SECONDS = 10
+
+# Name of the manifest of a run store
+RUN_MANIFEST = "manifest.json"
+
+# Version of the layout of a run store, stored in its manifest
+RUN_STORE_FORMAT = 1
+
+# Extensions of the recordings a run is assembled from
+RECORDING_EXTENSIONS = (".wav", ".flac")
+
+# Id of the WAV chunk the pi stores the capture metadata in (pac_stream_writer.py)
+METADATA_CHUNK_ID = b"pacm"
+
+# Bytes of a WAV file searched for the metadata chunk; the pi writes a fixed header of this size
+WAV_HEADER_BYTES = 4096
+
+# Start time and device index in the name of a recording, for files without metadata
+RECORDING_NAME_PATTERN = re.compile(r"_(\d{4}_\d{2}_\d{2}_\d{2}_\d{2}(?:_\d{2})?)_Udev(\d+)")
+
+# Number at the end of a batsound_id, which orders the sensors of a pi ("Batsound_10" after "Batsound_2")
+BATSOUND_NUMBER_PATTERN = re.compile(r"(\d+)$")
+
+# Default location of the sensor allocation, relative to this file
+SENSOR_ALLOCATION_PATH = os.path.join("..", "passive_audio_capture", "sensor_allocation.json")
+
+
+def read_recording_metadata(path: str) -> dict:
+    """
+    Read the capture metadata the pi stored in a recording: in the pacm chunk of a WAV file,
+    or as JSON in the comment of a FLAC file.
+
+    Returns:
+        dict: The metadata, empty if the file has none
+    """
+    if path.endswith(".flac"):
+        with sf.SoundFile(path) as f:
+            comment = f.comment
+        try:
+            return json.loads(comment) if comment else {}
+        except ValueError:
+            return {}
+
+    with open(path, "rb") as f:
+        header = f.read(WAV_HEADER_BYTES)
+    offset = 12
+    while offset + 8 <= len(header):
+        chunk_id, chunk_size = struct.unpack_from("<4sI", header, offset)
+        if chunk_id == METADATA_CHUNK_ID:
+            return json.loads(header[offset + 8:offset + 8 + chunk_size])
+        if chunk_id == b"data":
+            break
+        offset += 8 + chunk_size + chunk_size % 2
+    return {}
+
+
+def read_recording_info(path: str) -> dict:
+    """
+    Returns:
+        dict: path, sample_rate, frames, device_index, start (time of the first sample in
+              controller time), clock_offset, clock_uncertainty and timestamp_source of a recording
+
+    Raises:
+        ValueError: If the recording is not mono or its start time is unknown
+    """
+    info = sf.info(path)
+    if info.channels != 1:
+        raise ValueError(f"{path} has {info.channels} channels, expected a mono recording")
+    metadata = read_recording_metadata(path)
+
+    start = metadata.get("first_sample_time")
+    timestamp_source = metadata.get("timestamp_source")
+    if start is None and metadata.get("scheduled_start_time") is not None:
+        start = metadata["scheduled_start_time"] + metadata.get("first_frame", 0) / info.samplerate
+        timestamp_source = "scheduled"
+    match = RECORDING_NAME_PATTERN.search(os.path.basename(path))
+    if start is None and match:
+        # Whole seconds only; files without metadata, e.g. those of the stream receiver
+        fmt = "%Y_%m_%d_%H_%M_%S" if match.group(1).count("_") == 5 else "%Y_%m_%d_%H_%M"
+        start = datetime.strptime(match.group(1), fmt).timestamp()
+        timestamp_source = "file name"
+    if start is None:
+        raise ValueError(f"{path} has no start time")
+
+    device_index = metadata.get("device_index")
+    if device_index is None and match:
+        device_index = int(match.group(2))
+
+    # The pi stores its own time; its clock is clock_offset ahead of that of the controller
+    clock_offset = metadata.get("clock_offset")
+    return {
+        "path": path,
+        "sample_rate": info.samplerate,
+        "frames": info.frames,
+        "device_index": device_index,
+        "start": start - (clock_offset or 0.0),
+        "clock_offset": clock_offset,
+        "clock_uncertainty": metadata.get("clock_uncertainty"),
+        "timestamp_source": timestamp_source,
+    }
+
+
+def load_sensor_allocation(path: str) -> list[dict]:
+    """
+    Returns:
+        list[dict]: The sensors of sensor_allocation.json, empty if there is no such file
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def batsound_order(sensor: dict) -> tuple:
+    """
+    Returns:
+        tuple: Sort key of a sensor by the number of its batsound_id; ids without a number sort last, by name
+    """
+    batsound_id = str(sensor.get("batsound_id", ""))
+    match = BATSOUND_NUMBER_PATTERN.search(batsound_id)
+    return (0, int(match.group(1)), batsound_id) if match else (1, 0, batsound_id)
+
+
+def sensor_label(sensors: list[dict], node_name: str, device_index: int) -> dict:
+    """
+    Find the sensor recorded by a device of a node. A sensor belongs to the node whose name
+    ends in its pi_id; within a node, devices are matched by an explicit device_index in the
+    allocation or else by the number of the batsound_ids (the lowest, e.g. Batsound_1, is device 0).
+
+    Returns:
+        dict: The allocation entry of the sensor, empty if it is not allocated
+    """
+    node_sensors = sorted((sensor for sensor in sensors if sensor.get("pi_id") and node_name.endswith(sensor["pi_id"])),
+                          key=batsound_order)
+    for sensor in node_sensors:
+        if sensor.get("device_index") == device_index:
+            return sensor
+    unindexed = [sensor for sensor in node_sensors if "device_index" not in sensor]
+    return unindexed[device_index] if device_index is not None and device_index < len(unindexed) else {}
+
+
+class RunStore:
+    """
+    Reads a run store written by WindowsPACRunAssembler.
+
+    Attributes:
+        sample_rate (int): Sample rate in Hz
+        start_time (float): Controller time of frame 0 of the run
+        frames (int): Number of frames per channel
+        channels (list[dict]): Label of every channel: name, node, device_index, the fields of
+                               its sensor allocation and the segments of recordings it holds
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path (str): Directory of the run store
+        """
+        self.path = path
+        with open(os.path.join(path, RUN_MANIFEST)) as f:
+            self.manifest = json.load(f)
+        if self.manifest.get("format") != RUN_STORE_FORMAT:
+            raise ValueError(f"{path} is a run store of format {self.manifest.get('format')}, expected {RUN_STORE_FORMAT}")
+        self.sample_rate = self.manifest["sample_rate"]
+        self.start_time = self.manifest["start_time"]
+        self.frames = self.manifest["frames"]
+        self.chunk_frames = self.manifest["chunk_frames"]
+        self.channels = self.manifest["channels"]
+        self.chunks: dict[int, np.ndarray] = {}
+
+    @property
+    def duration(self) -> float:
+        return self.frames / self.sample_rate
+
+    def channel_index(self, channel) -> int:
+        """
+        Args:
+            channel (Union[int, str]): Index or name of a channel
+
+        Returns:
+            int: Index of the channel
+        """
+        if isinstance(channel, str):
+            for index, label in enumerate(self.channels):
+                if label["name"] == channel:
+                    return index
+            raise KeyError(f"No channel {channel} in {self.path}")
+        return channel
+
+    def channels_where(self, **fields) -> list[int]:
+        """
+        Returns:
+            list[int]: Indices of the channels whose label has all given values, e.g. experiment_group="pest"
+        """
+        return [index for index, label in enumerate(self.channels)
+                if all(label.get(key) == value for key, value in fields.items())]
+
+    def chunk(self, index: int) -> np.ndarray:
+        """
+        Returns:
+            np.ndarray: Memory map of a chunk, chunk_frames (fewer for the last) x channels
+        """
+        if index not in self.chunks:
+            self.chunks[index] = np.load(os.path.join(self.path, self.manifest["chunks"][index]), mmap_mode="r")
+        return self.chunks[index]
+
+    def slice(self, start: float, end: float, channels: list = None) -> np.ndarray:
+        """
+        Read the samples of a period of the run.
+
+        Args:
+            start (float): Start in seconds since the start of the run
+            end (float): End in seconds since the start of the run
+            channels (list, optional): Indices or names of the channels (default: all)
+
+        Returns:
+            np.ndarray: int16 samples, frames x channels
+        """
+        first = min(max(0, round(start * self.sample_rate)), self.frames)
+        last = min(max(first, round(end * self.sample_rate)), self.frames)
+        columns = slice(None) if channels is None else [self.channel_index(channel) for channel in channels]
+        parts = []
+        for index in range(first // self.chunk_frames, (last - 1) // self.chunk_frames + 1 if last > first else 0):
+            chunk_start = index * self.chunk_frames
+            rows = slice(max(first, chunk_start) - chunk_start, min(last, chunk_start + self.chunk_frames) - chunk_start)
+            parts.append(self.chunk(index)[rows][:, columns])
+        if not parts:
+            return np.zeros((0, len(self.channels) if channels is None else len(channels)), dtype=np.int16)
+        return np.concatenate(parts)
+
+    def slice_time(self, start_time: float, end_time: float, channels: list = None) -> np.ndarray:
+        """
+        Like slice, with start and end in controller time (unix time).
+        """
+        return self.slice(start_time - self.start_time, end_time - self.start_time, channels)
+
+
+class WindowsPACRunAssembler:
+    """
+    Builds run stores from fetched recordings, one chunk at a time: memory use is that of
+    a single chunk, however long the run, and every recording is read once, in order.
+    """
+
+    def __init__(self, config: dict, logger: logging.Logger):
+        self.config = config
+        self.logger = logger
+        self.logger.info("~[assem] Building run assembler...")
+
+        self.local_storage_path = config['local_storage_path']
+        self.run_store_path = config.get('run_store_path') or os.path.join(self.local_storage_path, "runs")
+        self.chunk_seconds = config.get('run_chunk_seconds', RUN_CHUNK_SECONDS)
+        sensor_allocation_path = config.get('sensor_allocation_path', SENSOR_ALLOCATION_PATH)
+        # Relative to this file, so the default finds the allocation of the pi code in the same checkout
+        self.sensor_allocation_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), sensor_allocation_path)
+
+    def find_run_files(self, start_time: float, end_time: float) -> dict[str, list[str]]:
+        """
+        Find the fetched recordings with samples between two times, in all node folders.
+
+        Args:
+            start_time (float): Unix time (controller clock)
+            end_time (float): Unix time (controller clock)
+
+        Returns:
+            dict[str, list[str]]: {node name: [file names]}
+        """
+        run_files = {}
+        for node_name in sorted(os.listdir(self.local_storage_path)):
+            node_path = os.path.join(self.local_storage_path, node_name)
+            if not os.path.isdir(node_path) or os.path.abspath(node_path) == os.path.abspath(self.run_store_path):
+                continue
+            for filename in sorted(os.listdir(node_path)):
+                if not filename.endswith(RECORDING_EXTENSIONS):
+                    continue
+                try:
+                    info = read_recording_info(os.path.join(node_path, filename))
+                except (OSError, RuntimeError, ValueError) as e:
+                    self.logger.info(f"~[assem] Skipping {node_name}/{filename}: {e}")
+                    continue
+                if info["start"] < end_time and info["start"] + info["frames"] / info["sample_rate"] > start_time:
+                    run_files.setdefault(node_name, []).append(filename)
+        return run_files
+
+    def assemble(self, run_files: dict[str, list[str]], run_name: str = None, start_time: float = None,
+                 end_time: float = None) -> str:
+        """
+        Assemble recordings into a run store, one channel per node and device.
+
+        Args:
+            run_files (dict[str, list[str]]): {node name: [file names]} of the recordings, in local_storage_path/<node>
+            run_name (str, optional): Name of the store (default: run_<start time of the run>)
+            start_time (float, optional): Leave out recordings that end before this Unix time (controller clock)
+            end_time (float, optional): Leave out recordings that start after this Unix time (controller clock)
+
+        Returns:
+            str: Path of the run store, None if there was nothing to assemble
+
+        Raises:
+            ValueError: If the recordings do not share a sample rate
+        """
+        started = time.perf_counter()
+        sensors = load_sensor_allocation(self.sensor_allocation_path)
+
+        # One channel per node and device, each with its recordings in time order
+        channels: dict[tuple[str, int], list[dict]] = {}
+        for node_name, filenames in sorted(run_files.items()):
+            for filename in filenames:
+                try:
+                    info = read_recording_info(os.path.join(self.local_storage_path, node_name, filename))
+                except (OSError, RuntimeError, ValueError) as e:
+                    self.logger.error(f"~[assem] Leaving {node_name}/{filename} out of the run: {e}")
+                    continue
+                if (start_time is not None and info["start"] + info["frames"] / info["sample_rate"] <= start_time) \
+                        or (end_time is not None and info["start"] >= end_time):
+                    self.logger.info(f"~[assem] Leaving {node_name}/{filename} out of the run: recorded outside of it")
+                    continue
+                channels.setdefault((node_name, info["device_index"]), []).append(info)
+        if not channels:
+            return None
+        sample_rates = {info["sample_rate"] for recordings in channels.values() for info in recordings}
+        if len(sample_rates) != 1:
+            raise ValueError(f"Recordings of a run must share a sample rate, found {sorted(sample_rates)}")
+        sample_rate = sample_rates.pop()
+
+        run_start = min(info["start"] for recordings in channels.values() for info in recordings)
+        labels = []
+        for (node_name, device_index), recordings in sorted(channels.items(), key=lambda item: (item[0][0], item[0][1] or 0)):
+            sensor = sensor_label(sensors, node_name, device_index)
+            segments = []
+            for info in sorted(recordings, key=lambda info: info["start"]):
+                file = os.path.join(node_name, os.path.basename(info["path"]))
+                start_frame = round((info["start"] - run_start) * sample_rate)
+                # Frames at the start of the file that an earlier recording of the channel already covers
+                file_frame = 0
+                previous_end = segments[-1]["start_frame"] + segments[-1]["frames"] if segments else 0
+                if start_frame < previous_end:
+                    overlap = previous_end - start_frame
+                    if overlap >= info["frames"]:
+                        self.logger.error(f"~[assem] Leaving {file} out of the run: {segments[-1]['file']} already covers all of it")
+                        continue
+                    # One frame is the rounding of the start times of consecutive segments
+                    self.logger.log(logging.INFO if overlap <= 1 else logging.WARNING,
+                                    f"~[assem] {file} overlaps {segments[-1]['file']} by {overlap} frames, keeping those of the earlier file")
+                    start_frame, file_frame = previous_end, overlap
+                segments.append({
+                    "file": file,
+                    "start_frame": start_frame,
+                    "file_frame": file_frame,
+                    "frames": info["frames"] - file_frame,
+                    "clock_offset": info["clock_offset"],
+                    "clock_uncertainty": info["clock_uncertainty"],
+                    "timestamp_source": info["timestamp_source"],
+                })
+            labels.append({
+                **sensor,
+                "name": f"sensor{sensor['sensor_id']}" if "sensor_id" in sensor else f"{node_name}_Udev{device_index}",
+                "node": node_name,
+                "device_index": device_index,
+                "segments": segments,
+            })
+        frames = max(segment["start_frame"] + segment["frames"] for label in labels for segment in label["segments"])
+
+        run_name = run_name or "run_" + datetime.fromtimestamp(run_start).strftime("%Y_%m_%d_%H_%M_%S")
+        run_path = os.path.join(self.run_store_path, run_name)
+        # Written next to its final place and moved there when complete, so a store is never half written
+        part_path = run_path + ".part"
+        shutil.rmtree(part_path, ignore_errors=True)
+        os.makedirs(part_path)
+
+        chunk_frames = int(self.chunk_seconds * sample_rate)
+        chunk_names = []
+        readers: dict[str, sf.SoundFile] = {}
+        try:
+            for chunk_start in range(0, frames, chunk_frames):
+                chunk_end = min(chunk_start + chunk_frames, frames)
+                chunk = np.zeros((chunk_end - chunk_start, len(labels)), dtype=np.int16)
+                for column, label in enumerate(labels):
+                    for segment in label["segments"]:
+                        first = max(chunk_start, segment["start_frame"])
+                        last = min(chunk_end, segment["start_frame"] + segment["frames"])
+                        if first >= last:
+                            continue
+                        if segment["file"] not in readers:
+                            readers[segment["file"]] = sf.SoundFile(os.path.join(self.local_storage_path, segment["file"]))
+                        reader = readers[segment["file"]]
+                        reader.seek(first - segment["start_frame"] + segment["file_frame"])
+                        samples = reader.read(last - first, dtype="int16")
+                        chunk[first - chunk_start:first - chunk_start + len(samples), column] = samples
+                        if last == segment["start_frame"] + segment["frames"]:
+                            readers.pop(segment["file"]).close()
+                chunk_names.append(f"chunk_{len(chunk_names):05d}.npy")
+                np.save(os.path.join(part_path, chunk_names[-1]), chunk)
+        finally:
+            for reader in readers.values():
+                reader.close()
+
+        manifest = {
+            "format": RUN_STORE_FORMAT,
+            "sample_rate": sample_rate,
+            "dtype": "int16",
+            "start_time": run_start,
+            "frames": frames,
+            "chunk_frames": chunk_frames,
+            "chunks": chunk_names,
+            "channels": labels,
+            "created": time.time(),
+        }
+        with open(os.path.join(part_path, RUN_MANIFEST), "w") as f:
+            json.dump(manifest, f, indent=2)
+        shutil.rmtree(run_path, ignore_errors=True)
+        os.replace(part_path, run_path)
+
+        self.logger.info(f"~[assem] Assembled {run_name}: {len(labels)} channels, {frames / sample_rate:.1f} s, "
+                         f"{len(chunk_names)} chunks in {time.perf_counter() - started:.1f} s")
+        return run_path
+
+
+def parse_time(value: str) -> float:
+    """
+    Returns:
+        float: Unix time of "YYYY-mm-dd HH:MM:SS" (local time) or of a number of seconds
+    """
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.strptime(value, "%Y-%m-%d %H:%M:%S").timestamp()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Assemble the recordings of a run into a time-aligned multi-channel store")
+    parser.add_argument("--config", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json"),
+                        help="Controller configuration")
+    parser.add_argument("--start", required=True, help="Start of the run, \"YYYY-mm-dd HH:MM:SS\" or unix time")
+    parser.add_argument("--end", required=True, help="End of the run, \"YYYY-mm-dd HH:MM:SS\" or unix time")
+    parser.add_argument("--name", default=None, help="Name of the run store")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    with open(args.config) as f:
+        config = json.load(f)
+    assembler = WindowsPACRunAssembler(config, logging.getLogger(__name__))
+    run_files = assembler.find_run_files(parse_time(args.start), parse_time(args.end))
+    run_path = assembler.assemble(run_files, args.name)
+    if run_path is None:
+        print("No recordings found")
+        return 1
+    store = RunStore(run_path)
+    print(f"{run_path}: {len(store.channels)} channels, {store.duration:.1f} s at {store.sample_rate} Hz")
+    for label in store.channels:
+        print(f"  {label['name']}: {label['node']} Udev{label['device_index']}, {label.get('experiment_group', '-')}, "
+              f"{len(label['segments'])} files")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,8 +1,11 @@
 import paramiko
+import math
 import time
 import os
 import socket
-from datetime import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Callable
 import json
 
 from RPI_pac_tcp_node import RPI_PAC_TCP_Node
@@ -11,6 +14,35 @@ import logging
 
 COMMAND_SEPARATOR = "#"
 
+# Pings per node in a health check, the timeout of a ping (and of the clock offset estimate
+# after it) and the pause after one that failed, in seconds
+HEALTH_CHECK_TRIES = 3
+HEALTH_CHECK_TIMEOUT = 1.0
+HEALTH_CHECK_RETRY_INTERVAL = 0.5
+
+
+def health_check_deadline(tries: int = HEALTH_CHECK_TRIES) -> float:
+    """
+    Returns:
+        float: Seconds a health check of `tries` pings may take: every ping but the last timing
+               out and pausing, then the last ping and the clock offset estimate after it
+    """
+    return (tries - 1) * (HEALTH_CHECK_TIMEOUT + HEALTH_CHECK_RETRY_INTERVAL) + 2 * HEALTH_CHECK_TIMEOUT
+
+# A start command may take this many times the slowest recent ping of its node
+RTT_SAFETY_FACTOR = 3
+
+# Added to the lead time the slowest node needs, and the least lead time of any run, in seconds
+START_MARGIN = 0.5
+MIN_LEAD_TIME = 1.0
+
+# Start times are rounded up to a multiple of this, in seconds
+START_TIME_RESOLUTION = 0.1
+
+# Shortest timeout of a start command, even if the deadline of its node already passed, in seconds
+MIN_COMMAND_TIMEOUT = 0.5
+
+
 class WindowsPACScheduler:
     def __init__(self, config: dict, logger: logging.Logger):
         self.rpi_pac_nodes: list[RPI_PAC_TCP_Node] = []
@@ -20,88 +52,262 @@ class WindowsPACScheduler:
         self.logger = logger
         self.logger.info("~[sched] Building scheduler...")
 
-        self.capture_tries_counter: int = 0
-        self.capture_complete_status: list[bool] = []
+        # Names of the nodes that pushed a capture_complete event for the current run
+        self.completed_nodes: set[str] = set()
+        self.capture_complete_condition = threading.Condition()
 
 
     def add_rpi_pac_node(self, rpi_pac_node: RPI_PAC_TCP_Node):
         self.rpi_pac_nodes.append(rpi_pac_node)
 
-    def update_rpi_pac_nodes(self, tries: int = 3):
+    def update_rpi_pac_nodes(self, tries: int = HEALTH_CHECK_TRIES):
+        """
+        Ping all nodes at the same time, each up to `tries` times, and mark them responsive or
+        not. Nodes that did not answer within health_check_deadline(tries) seconds, long enough
+        for all of their tries, are left out of the next run, so one dead node costs everyone at
+        most that long.
+        """
+        if not self.rpi_pac_nodes:
+            return
+        # Filled as the nodes answer, so a node whose clock estimate overruns the deadline still counts as responsive
+        pings: dict[str, dict] = {}
+        executor = ThreadPoolExecutor(max_workers=len(self.rpi_pac_nodes), thread_name_prefix="health_check")
+        futures = [executor.submit(self._check_node, rpi_pac_node, tries, pings) for rpi_pac_node in self.rpi_pac_nodes]
+        wait(futures, timeout=health_check_deadline(tries))
+        # Do not wait for the checks still running; their result is not used
+        executor.shutdown(wait=False)
         for rpi_pac_node in self.rpi_pac_nodes:
-            for _ in range(tries):
-                rpi_pac_node.test_tcp_connection(output=False)
-                if rpi_pac_node.is_responsive():
-                    break
-                else:
-                    self.logger.info(f"~[sched] tcpnode:{rpi_pac_node.ip_address}:{rpi_pac_node.port} - RPI_PAC_Node not active, trying again...")
-                    time.sleep(1)
-                    continue
+            ping = pings.get(rpi_pac_node.name)
+            rpi_pac_node.set_isresponsive(ping is not None)
+            if ping is None:
+                self.logger.error(f"~[sched] tcpnode:{rpi_pac_node.ip_address}:{rpi_pac_node.port} - RPI_PAC_Node not responding, leaving it out")
+            else:
+                clock = "unknown" if rpi_pac_node.clock_offset is None else \
+                    f"{rpi_pac_node.clock_offset*1000:+.2f} ms +/- {rpi_pac_node.clock_uncertainty*1000:.2f} ms"
+                self.logger.info(f"~[sched] tcpnode:{rpi_pac_node.ip_address}:{rpi_pac_node.port} - rtt {ping['rtt']*1000:.1f} ms, "
+                                 f"arm latency {ping['arm_latency']*1000:.0f} ms, clock offset {clock}")
+
+    def _check_node(self, rpi_pac_node: RPI_PAC_TCP_Node, tries: int, pings: dict[str, dict]) -> dict:
+        for attempt in range(tries):
+            ping = rpi_pac_node.ping(timeout=HEALTH_CHECK_TIMEOUT)
+            if ping is not None:
+                pings[rpi_pac_node.name] = ping
+                # Start times are sent by the clock of the node, so clock drift between the nodes
+                # does not end up as misalignment between their recordings
+                if rpi_pac_node.estimate_clock_offset(timeout=HEALTH_CHECK_TIMEOUT) is None:
+                    self.logger.error(f"~[sched] tcpnode:{rpi_pac_node.ip_address}:{rpi_pac_node.port} - Clock offset unknown, "
+                                      f"{'keeping the previous estimate' if rpi_pac_node.clock_offset is not None else 'not compensated'}")
+                return ping
+            if attempt < tries - 1:
+                self.logger.info(f"~[sched] tcpnode:{rpi_pac_node.ip_address}:{rpi_pac_node.port} - RPI_PAC_Node not active, trying again...")
+                time.sleep(HEALTH_CHECK_RETRY_INTERVAL)
+        return None
+
+    def lead_time(self, rpi_pac_nodes: list[RPI_PAC_TCP_Node]) -> float:
+        """
+        Returns:
+            float: Seconds between sending the start commands and the start time, so every node
+                   gets its command and arms its devices in time: the slowest node's worst recent
+                   round trip (times RTT_SAFETY_FACTOR) plus its arming latency, plus START_MARGIN
+        """
+        needed = [RTT_SAFETY_FACTOR * (rpi_pac_node.rtt() or 0.0) + (rpi_pac_node.arm_latency or 0.0)
+                  for rpi_pac_node in rpi_pac_nodes]
+        return max([MIN_LEAD_TIME] + [lead + START_MARGIN for lead in needed])
+
+    def next_start_time(self) -> float:
+        """
+        Returns:
+            float: The earliest start time all responsive nodes can make, rounded up to START_TIME_RESOLUTION
+        """
+        lead_time = self.lead_time([rpi_pac_node for rpi_pac_node in self.rpi_pac_nodes if rpi_pac_node.is_responsive()])
+        return round(math.ceil((time.time() + lead_time) / START_TIME_RESOLUTION) * START_TIME_RESOLUTION, 3)
+
+    def start_nodes(self, start: Callable[[RPI_PAC_TCP_Node, float], str], description: str) -> list[str]:
+        """
+        Send a start command to every responsive node at the same time. Every node gets until
+        the start time minus its arming latency to answer; a node that answers later could not
+        arm in time and is left out.
+
+        A start that timed out may still have reached its node, which would then record without
+        being listed and refuse every later start. Every node that did not confirm its start is
+        therefore sent a stop.
+
+        Args:
+            start (Callable[[RPI_PAC_TCP_Node, float], str]): Sends the start command to a node with a timeout, returns the response
+            description (str): What is started, for the log
+
+        Returns:
+            list[str]: Names of the nodes that started
+        """
+        rpi_pac_nodes = [rpi_pac_node for rpi_pac_node in self.rpi_pac_nodes if rpi_pac_node.is_responsive()]
+        if not rpi_pac_nodes:
+            self.logger.info(f"~[sched] Active nodes: []")
+            return []
+
+        def send(rpi_pac_node: RPI_PAC_TCP_Node) -> str:
+            deadline = self.start_time - (rpi_pac_node.arm_latency or 0.0)
+            return start(rpi_pac_node, max(MIN_COMMAND_TIMEOUT, deadline - time.time()))
+
+        with ThreadPoolExecutor(max_workers=len(rpi_pac_nodes), thread_name_prefix="start") as executor:
+            responses = list(executor.map(send, rpi_pac_nodes))
+
+        active_nodes_names = []
+        failed_nodes = []
+        for rpi_pac_node, response in zip(rpi_pac_nodes, responses):
+            if not response.startswith("REC_START"):
+                self.logger.error(f"~[sched] tcpnode:{rpi_pac_node.ip_address}:{rpi_pac_node.port} - Error starting {description}; response: {response}")
+                failed_nodes.append(rpi_pac_node)
+                continue
+            _, timestamp, waittime = response.split(COMMAND_SEPARATOR)
+            rpi_pac_node.set_isactive(True)
+            if float(waittime) < (rpi_pac_node.arm_latency or 0.0):
+                self.logger.warning(f"~[sched] tcpnode:{rpi_pac_node.ip_address}:{rpi_pac_node.port} - Start command arrived {waittime} s "
+                                    f"before the start, may start late")
+            self.logger.info(f"~[sched] tcpnode:{rpi_pac_node.ip_address}:{rpi_pac_node.port} - {description.capitalize()} planned at {timestamp} in {waittime} seconds")
+            active_nodes_names.append(rpi_pac_node.name)
+
+        if failed_nodes:
+            with ThreadPoolExecutor(max_workers=len(failed_nodes), thread_name_prefix="stop") as executor:
+                stop_responses = list(executor.map(lambda rpi_pac_node: rpi_pac_node.stop_continuous(), failed_nodes))
+            for rpi_pac_node, response in zip(failed_nodes, stop_responses):
+                self.logger.info(f"~[sched] tcpnode:{rpi_pac_node.ip_address}:{rpi_pac_node.port} - Start not confirmed, stopping it in case it did start; response: {response}")
+                rpi_pac_node.set_isactive(False)
 
+        self.logger.info(f"~[sched] Active nodes: {active_nodes_names}")
+        return active_nodes_names
 
     def schedule_capture(self, record_time_in_seconds: int) -> list[str]:
         self.update_rpi_pac_nodes()
-        self.capture_tries_counter = 0
+        with self.capture_complete_condition:
+            self.completed_nodes.clear()
 
-        current_time = datetime.now()
-        # Find next 10 second interval at least 5s away
-        self.start_time = ((int(current_time.timestamp()) // 10) + 1) * 10
-        if self.start_time - current_time.timestamp() < 5:
-            self.start_time += 10
+        self.start_time = self.next_start_time()
         
         self.runtime = record_time_in_seconds
-        self.logger.info(f"~[sched] Scheduling capture of {self.runtime} seconds at {self.start_time}") # <-------- LOGGER
+        self.logger.info(f"~[sched] Scheduling capture of {self.runtime} seconds at {self.start_time} (in {self.start_time - time.time():.1f} s)") # <-------- LOGGER
 
-        active_nodes_names = []
+        return self.start_nodes(lambda rpi_pac_node, timeout: rpi_pac_node.start_recording(self.runtime, self.start_time, timeout=timeout),
+                                "recording")
+
+    def schedule_continuous(self, segment_time_in_seconds: int, triggered: bool = False, store: bool = True) -> list[str]:
+        """
+        Start gapless continuous recording on all responsive nodes. The nodes rotate their
+        files every segment_time_in_seconds seconds until stop_continuous is called.
+
+        In triggered mode the nodes only write the audio around detected events, one file
+        per event of at most segment_time_in_seconds seconds.
+
+        Without store the nodes write nothing and only stream the audio live.
+        """
+        self.update_rpi_pac_nodes()
+        self.start_time = self.next_start_time()
+        self.runtime = None
+        mode = "streaming" if not store else "triggered" if triggered else "continuous"
+        self.logger.info(f"~[sched] Scheduling {mode} capture in segments of {segment_time_in_seconds} seconds at {self.start_time} (in {self.start_time - time.time():.1f} s)")
+
+        return self.start_nodes(lambda rpi_pac_node, timeout: rpi_pac_node.start_continuous(segment_time_in_seconds, self.start_time, triggered,
+                                                                                              store, timeout=timeout),
+                                f"{mode} recording")
+
+    def log_capture_status(self, active_nodes_names: list[str]):
+        """
+        Log the capture counters of every active node, one line per device, so overruns,
+        a filling queue or slow writes show up while the capture is still running.
+        """
         for rpi_pac_node in self.rpi_pac_nodes:
-            response = rpi_pac_node.start_recording(self.runtime, self.start_time)
-            if not response.startswith("REC_START"):
-                self.logger.error(f"~[sched] tcpnode:{rpi_pac_node.ip_address}:{rpi_pac_node.port} - Error starting recording; response: {response}") # <-------- LOGGER
-            else:
-                _, timestamp, waittime = response.split(COMMAND_SEPARATOR)
-                rpi_pac_node.set_isactive(True)
-                self.logger.info(f"~[sched] tcpnode:{rpi_pac_node.ip_address}:{rpi_pac_node.port} - Recording planned at {timestamp} in {waittime} seconds") # <-------- LOGGER
-                active_nodes_names.append(rpi_pac_node.name)
+            if rpi_pac_node.name not in active_nodes_names:
+                continue
+            status = rpi_pac_node.capture_status()
+            if status is None:
+                continue
+            for device in status["devices"]:
+                if not device["active"]:
+                    continue
+                since_last_period = device["since_last_period"]
+                level = logging.WARNING if device["overruns"] or device["dropped_periods"] or device["bytes_dropped"] or since_last_period is None or since_last_period > 1.0 else logging.INFO
+                self.logger.log(level, f"~[sched] tcpnode:{rpi_pac_node.ip_address}:{rpi_pac_node.port} - {device['device']}: "
+                                       f"{device['bytes_written']/1024/1024:.0f} MB written, {device['bytes_dropped']} bytes not written, {device['overruns']} overruns, "
+                                       f"queue {device['queue']}/{device['queue_slots']}, {device['dropped_periods']} dropped, "
+                                       f"last period {since_last_period} s ago, write p99 {device['write_p99_ms']} ms; "
+                                       f"{status['free_mb']} MB free")
 
-        self.logger.info(f"~[sched] Active nodes: {active_nodes_names}")
-        return active_nodes_names
+    def stop_continuous(self, active_nodes_names: list[str]):
+        for rpi_pac_node in self.rpi_pac_nodes:
+            if rpi_pac_node.name in active_nodes_names:
+                response = rpi_pac_node.stop_continuous()
+                self.logger.info(f"~[sched] tcpnode:{rpi_pac_node.ip_address}:{rpi_pac_node.port} - Stopping continuous recording; response: {response}")
+                rpi_pac_node.set_isactive(False)
 
     def schedule_calibration(self):
         # Same as schedule_capture, but with a different runtime and command.
         pass
 
-    def is_capture_complete(self, active_nodes_names: list[str], tries: int = 10) -> bool:
-        if self.capture_tries_counter == 0:
-            self.capture_complete_status = [False] * len(active_nodes_names)
+    def set_capture_complete(self, rpi_name: str):
+        """
+        Record that a node finished its capture, e.g. from its capture_complete event.
+        """
+        with self.capture_complete_condition:
+            self.completed_nodes.add(rpi_name)
+            self.capture_complete_condition.notify_all()
 
-            if self.start_time is None or datetime.now().timestamp() < self.start_time + self.runtime:
-                self.logger.info(f"~[sched] Capture not complete yet, returning False {datetime.now().timestamp()} < {self.start_time} + {self.runtime}")
-                return False
-
-        if self.capture_tries_counter < tries:
-            active_rpi_pac_nodes = [rpi_pac_node for rpi_pac_node in self.rpi_pac_nodes if rpi_pac_node.name in active_nodes_names]
-            self.logger.info(f"~[sched] polling active nodes: {active_rpi_pac_nodes}, attempt {self.capture_tries_counter} of {tries}")
-            self.capture_tries_counter += 1
+    def wait_for_capture_complete(self, active_nodes_names: list[str], poll_interval: float = 10.0, timeout: float = 60.0) -> bool:
+        """
+        Block until every active node finished its capture. The nodes push a capture_complete
+        event, so this returns within milliseconds of the last node finishing. Nodes that did
+        not report by the scheduled end are polled every poll_interval seconds, in case their
+        subscription dropped.
 
-            for i, rpi_pac_node in enumerate(active_rpi_pac_nodes):
-                if not rpi_pac_node.is_capture_complete():
-                    self.logger.info(f"~[sched] tcpnode:{rpi_pac_node.ip_address}:{rpi_pac_node.port} - Capture not complete yet, RPI_PAC_Node returning False")
-                    self.capture_complete_status[i] = False
-                else:
-                    self.capture_complete_status[i] = True
+        Args:
+            active_nodes_names (list[str]): Names of the nodes that started the capture
+            poll_interval (float): Seconds between polls of nodes that did not report
+            timeout (float): Seconds after the scheduled end of the capture to give up
 
-            if all(self.capture_complete_status):
+        Returns:
+            bool: True if all nodes finished, False on timeout
+        """
+        end_time = self.start_time + self.runtime
+        deadline = end_time + timeout
+        next_poll = end_time + poll_interval
+        while True:
+            with self.capture_complete_condition:
+                self.capture_complete_condition.wait_for(lambda: self.completed_nodes.issuperset(active_nodes_names),
+                                                         timeout=max(0.0, min(next_poll, deadline) - time.time()))
+                pending = [name for name in active_nodes_names if name not in self.completed_nodes]
+            if not pending:
                 self.logger.info("~[sched] Capture complete!")
                 return True
-            else:
-                self.logger.info(f"~[sched] Capture not complete yet, returning False {[f'{self.capture_complete_status[i]}:{rpi_pac_node.name}' for i, rpi_pac_node in enumerate(active_rpi_pac_nodes)]}")
+            if time.time() >= deadline:
+                self.logger.error(f"~[sched] Capture not complete {timeout:.0f} seconds after its end on {pending}, giving up")
                 return False
-        else:
-            self.logger.info("~[sched] capture timeout, returning True")
-            return True
-    
+            if time.time() >= next_poll:
+                for rpi_pac_node in self.rpi_pac_nodes:
+                    if rpi_pac_node.name in pending and rpi_pac_node.is_capture_complete():
+                        self.logger.info(f"~[sched] tcpnode:{rpi_pac_node.ip_address}:{rpi_pac_node.port} - Capture complete, found by polling")
+                        self.set_capture_complete(rpi_pac_node.name)
+                next_poll += poll_interval
+
+    def abort_capture(self, active_nodes_names: list[str]) -> list[str]:
+        """
+        Stop the nodes that did not report a capture complete in time and mark them inactive,
+        so their capture is not taken for complete.
+
+        Args:
+            active_nodes_names (list[str]): Names of the nodes that started the capture
+
+        Returns:
+            list[str]: Names of the nodes stopped
+        """
+        with self.capture_complete_condition:
+            pending = [name for name in active_nodes_names if name not in self.completed_nodes]
+        for rpi_pac_node in self.rpi_pac_nodes:
+            if rpi_pac_node.name in pending:
+                response = rpi_pac_node.stop_continuous()
+                self.logger.error(f"~[sched] tcpnode:{rpi_pac_node.ip_address}:{rpi_pac_node.port} - Capture not complete, stopping it; response: {response}")
+                rpi_pac_node.set_isactive(False)
+        return pending
+
     def is_calibration_complete(self) -> bool:
-        # Same as is_capture_complete, but with a different runtime and command.
+        # Same as wait_for_capture_complete, but with a different runtime and command.
         pass
 
 
@@ -0,0 +1,341 @@
+"""
+SFTP download benchmark.
+
+Downloads a file with RPI_PAC_SCP_Node for every combination of request size, requests in
+flight and parallel ranges, and reports the throughput of each, e.g. to tune the sftp_*
+settings in config.json for a node:
+
+    python windows_pac_sftp_benchmark.py --host 192.168.0.225 --remote-file /home/plense/passive_sensor_data/PZOrec_x.wav
+
+Without a node, --local serves a generated file from a stand-in SFTP server (paramiko, in a
+process of its own) behind a proxy that delays every packet by half of --rtt-ms each way,
+which shows what pipelining buys on a link with latency:
+
+    python windows_pac_sftp_benchmark.py --local --size-mb 64 --rtt-ms 2 --chunk-bytes 32768 131072 --max-requests 1 16 64 --range-workers 1 4
+
+The stand-in runs Python crypto on one core, so its absolute numbers are far below those of
+a node running OpenSSH; compare the settings, not the totals.
+
+With --check, --local instead checks that complete and partial local copies are verified
+against the checksum and resumed rather than downloaded again:
+
+    python windows_pac_sftp_benchmark.py --local --size-mb 64 --rtt-ms 0 --check
+"""
+
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import paramiko
+
+from RPI_pac_scp_node import RPI_PAC_SCP_Node, SFTP_CHUNK_BYTES, SFTP_MAX_REQUESTS, SFTP_RANGE_WORKERS
+from windows_pac_checksum import FileChecksum, CHECKSUM_DIGEST_BYTES
+
+
+class _StandInHandle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+
+class _StandInSFTPServer(paramiko.SFTPServerInterface):
+    """
+    Read-only SFTP server on the local file system.
+    """
+
+    def list_folder(self, path):
+        try:
+            return [paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(path, name)), name) for name in os.listdir(path)]
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        try:
+            f = open(path, "rb")
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        handle = _StandInHandle(flags)
+        handle.readfile = f
+        handle.filename = path
+        return handle
+
+
+class _StandInSSHServer(paramiko.ServerInterface):
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == "session" else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+def _serve_ssh(listener: socket.socket):
+    host_key = paramiko.RSAKey.generate(2048)
+    while True:
+        connection, _ = listener.accept()
+        transport = paramiko.Transport(connection)
+        transport.add_server_key(host_key)
+        transport.set_subsystem_handler("sftp", paramiko.SFTPServer, _StandInSFTPServer)
+        transport.start_server(server=_StandInSSHServer())
+
+
+async def _forward(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, delay: float):
+    # Every packet is held for delay seconds, without holding up the packets behind it
+    queue = asyncio.Queue()
+
+    async def send():
+        while True:
+            due, data = await queue.get()
+            if data is None:
+                break
+            await asyncio.sleep(max(0.0, due - time.monotonic()))
+            writer.write(data)
+            await writer.drain()
+
+    sender = asyncio.create_task(send())
+    try:
+        while data := await reader.read(65536):
+            await queue.put((time.monotonic() + delay, data))
+        await queue.put((0.0, None))
+        await sender
+    except ConnectionError:
+        pass
+    finally:
+        sender.cancel()
+        writer.close()
+
+
+async def _serve_proxy(listener: socket.socket, target_port: int, delay: float):
+    async def handle(client_reader, client_writer):
+        server_reader, server_writer = await asyncio.open_connection("127.0.0.1", target_port)
+        await asyncio.gather(_forward(client_reader, server_writer, delay), _forward(server_reader, client_writer, delay),
+                             return_exceptions=True)
+
+    server = await asyncio.start_server(handle, sock=listener)
+    await server.serve_forever()
+
+
+def _run_stand_in(port_queue, rtt: float):
+    # The connections the benchmark closes would be reported as errors
+    logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+    ssh_listener = socket.create_server(("127.0.0.1", 0))
+    threading.Thread(target=_serve_ssh, args=(ssh_listener,), daemon=True).start()
+    if not rtt:
+        port_queue.put(ssh_listener.getsockname()[1])
+        threading.Event().wait()
+    proxy_listener = socket.create_server(("127.0.0.1", 0))
+    port_queue.put(proxy_listener.getsockname()[1])
+    asyncio.run(_serve_proxy(proxy_listener, ssh_listener.getsockname()[1], rtt / 2))
+
+
+def start_stand_in(rtt: float = 0.0) -> tuple[multiprocessing.Process, int]:
+    """
+    Start a stand-in SFTP server in a process of its own, so it does not share the GIL with the downloads.
+
+    Args:
+        rtt (float): Round trip time added by a proxy in front of the server, in seconds
+
+    Returns:
+        tuple[multiprocessing.Process, int]: The server process, and the port to connect to
+    """
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_stand_in, args=(port_queue, rtt), daemon=True)
+    process.start()
+    return process, port_queue.get(timeout=30)
+
+
+def file_checksum(path: str) -> FileChecksum:
+    checksum = hashlib.blake2b(digest_size=CHECKSUM_DIGEST_BYTES)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            checksum.update(block)
+    return FileChecksum(0, checksum.hexdigest())
+
+
+def run_setting(config: dict, ip_address: str, port: int, remote_file: str, local_directory: str, checksum: FileChecksum,
+                repeat: int) -> dict:
+    """
+    Download the file repeat times with one setting.
+
+    Returns:
+        dict: The setting, size, verified and the best and mean MB/s
+    """
+    node = RPI_PAC_SCP_Node("benchmark", ip_address, config, logging.getLogger(__name__))
+    node.port = port
+    remote_directory, filename = remote_file.rsplit("/", 1)
+    try:
+        # Connect before timing, so only the transfer is measured
+        size = node.list_remote_files(remote_directory)[filename]
+        rates, verified = [], True
+        for _ in range(repeat):
+            for name in (filename, filename + ".part"):
+                if os.path.exists(os.path.join(local_directory, name)):
+                    os.remove(os.path.join(local_directory, name))
+            started = time.perf_counter()
+            downloaded = node.download_scp_files(local_directory, remote_directory, [filename],
+                                                 {filename: checksum} if checksum else None)
+            elapsed = time.perf_counter() - started
+            if filename not in downloaded:
+                raise RuntimeError(f"Download of {remote_file} failed")
+            verified = verified and downloaded[filename]
+            rates.append(size / 1024 / 1024 / elapsed)
+    finally:
+        node.close()
+    return {
+        "chunk_bytes": config["sftp_chunk_bytes"],
+        "max_requests": config["sftp_max_requests"],
+        "range_workers": config["sftp_range_workers"],
+        "mb": round(size / 1024 / 1024, 1),
+        "verified": verified,
+        "best_mb_per_s": round(max(rates), 1),
+        "mean_mb_per_s": round(sum(rates) / len(rates), 1),
+    }
+
+
+def run_checks(config: dict, port: int, remote_file: str, local_directory: str, checksum: FileChecksum) -> list[str]:
+    """
+    Check that downloads over the stand-in pick up what is already on disk: a complete copy
+    is verified and left alone, and a part file is resumed, in one range and in several.
+
+    Returns:
+        list[str]: Descriptions of the checks that failed
+    """
+    remote_directory, filename = remote_file.rsplit("/", 1)
+    local_file = os.path.join(local_directory, filename)
+    with open(remote_file, "rb") as f:
+        content = f.read()
+    failures = []
+
+    def check(description: str, range_workers: int, part: bytes = None, complete: str = None):
+        for name in (filename, filename + ".part"):
+            if os.path.exists(os.path.join(local_directory, name)):
+                os.remove(os.path.join(local_directory, name))
+        if part is not None:
+            with open(local_file + ".part", "wb") as f:
+                f.write(part)
+        if complete is not None:
+            with open(os.path.join(local_directory, complete), "wb") as f:
+                f.write(content)
+            # An old time, which a new download would replace
+            os.utime(os.path.join(local_directory, complete), (1, 1))
+        node = RPI_PAC_SCP_Node("check", "127.0.0.1", dict(config, sftp_range_workers=range_workers), logging.getLogger(__name__))
+        node.port = port
+        try:
+            downloaded = node.download_scp_files(local_directory, remote_directory, [filename], {filename: checksum})
+        finally:
+            node.close()
+        with open(local_file, "rb") as f:
+            correct = f.read() == content
+        if downloaded.get(filename) is not True or not correct:
+            failures.append(f"{description}: downloaded {downloaded}, content {'correct' if correct else 'wrong'}")
+        elif complete is not None and os.path.getmtime(local_file) != 1:
+            failures.append(f"{description}: downloaded again")
+        print(f"{description}: {'failed' if failures and failures[-1].startswith(description) else 'ok'}", flush=True)
+
+    check("complete copy", 1, complete=filename)
+    check("complete part file", 1, complete=filename + ".part")
+    check("resumed part file", 1, part=content[:len(content) // 3])
+    check("resumed part file in ranges", 4, part=content[:len(content) // 3])
+    return failures
+
+
+def print_header():
+    print(f"{'chunk bytes':>12} {'requests':>9} {'ranges':>7} {'best MB/s':>10} {'mean MB/s':>10}")
+
+
+def print_result(result: dict):
+    print(f"{result['chunk_bytes']:>12} {result['max_requests']:>9} {result['range_workers']:>7} "
+          f"{result['best_mb_per_s']:>10.1f} {result['mean_mb_per_s']:>10.1f}"
+          + ("" if result["verified"] else "  (not verified)"), flush=True)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark SFTP downloads for every combination of the download settings")
+    parser.add_argument("--host", default="127.0.0.1", help="Address of the node")
+    parser.add_argument("--port", type=int, default=22, help="SSH port of the node")
+    parser.add_argument("--config", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json"),
+                        help="Controller configuration with the SSH credentials")
+    parser.add_argument("--remote-file", default=None, help="Path of the file to download from the node")
+    parser.add_argument("--local", action="store_true", help="Download a generated file from a stand-in SFTP server")
+    parser.add_argument("--size-mb", type=int, default=64, help="Size of the generated file with --local")
+    parser.add_argument("--rtt-ms", type=float, default=2.0, help="Round trip time the stand-in adds, in ms")
+    parser.add_argument("--chunk-bytes", type=int, nargs="+", default=[SFTP_CHUNK_BYTES], help="Bytes per read request")
+    parser.add_argument("--max-requests", type=int, nargs="+", default=[1, 16, SFTP_MAX_REQUESTS], help="Read requests in flight per range")
+    parser.add_argument("--range-workers", type=int, nargs="+", default=sorted({SFTP_RANGE_WORKERS, 4}),
+                        help="Ranges downloaded at the same time")
+    parser.add_argument("--repeat", type=int, default=3, help="Downloads per setting")
+    parser.add_argument("--json", default=None, help="Also write the results to this JSON file")
+    parser.add_argument("--check", action="store_true",
+                        help="With --local, only check that complete and partial local copies are verified and resumed")
+    args = parser.parse_args(argv)
+
+    work_directory = tempfile.mkdtemp(prefix="sftp_benchmark_")
+    local_directory = os.path.join(work_directory, "local")
+    os.makedirs(local_directory)
+    server = None
+    try:
+        if args.local:
+            config = {"username": "benchmark", "password": "benchmark", "audio_file_prefix": ""}
+            remote_directory = os.path.join(work_directory, "remote")
+            os.makedirs(remote_directory)
+            remote_file = os.path.join(remote_directory, "benchmark.wav").replace(os.sep, "/")
+            with open(remote_file, "wb") as f:
+                for _ in range(args.size_mb):
+                    f.write(os.urandom(1024 * 1024))
+            checksum = file_checksum(remote_file)
+            server, port = start_stand_in(args.rtt_ms / 1000)
+            host = "127.0.0.1"
+        else:
+            if args.remote_file is None:
+                parser.error("--remote-file is required without --local")
+            with open(args.config) as f:
+                config = json.load(f)
+            remote_file, checksum, host, port = args.remote_file, None, args.host, args.port
+
+        if args.check:
+            if not args.local:
+                parser.error("--check requires --local")
+            failures = run_checks(config, port, remote_file, local_directory, checksum)
+            for failure in failures:
+                print(failure)
+            return 1 if failures else 0
+
+        results = []
+        print_header()
+        for chunk_bytes, max_requests, range_workers in itertools.product(args.chunk_bytes, args.max_requests, args.range_workers):
+            setting = dict(config, sftp_chunk_bytes=chunk_bytes, sftp_max_requests=max_requests, sftp_range_workers=range_workers)
+            results.append(run_setting(setting, host, port, remote_file, local_directory, checksum, args.repeat))
+            print_result(results[-1])
+    finally:
+        if server is not None:
+            server.terminate()
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,278 @@
+import logging
+import math
+import os
+import socket
+import struct
+import threading
+import time
+import wave
+from datetime import datetime
+from typing import Callable
+
+from RPI_pac_tcp_node import RPI_PAC_TCP_Node, MESSAGE_HEADER
+
+# Header of a chunk of a live PCM stream, as sent by the pi (pac_pcm_stream.py): magic, device
+# index, channels, sample width, sample rate, sequence number, index of the first frame within
+# the capture, time of the first frame (NaN if unknown) and the number of sample bytes that follow
+PCM_CHUNK_HEADER = struct.Struct("!4sBBBxIQQdI")
+PCM_CHUNK_MAGIC = b"PCM1"
+
+# Start a new file every this many seconds of audio
+STREAM_FILE_SECONDS = 60
+
+# Gaps (chunks the pi dropped because the link could not keep up) up to this long are filled
+# with silence, so a file stays aligned to the sample clock; longer gaps start a new file
+MAX_GAP_FILL_SECONDS = 5.0
+
+# A stream without any message (the pi sends a keepalive every 10 s) for this long is reconnected
+STREAM_TIMEOUT = 30
+
+# Seconds between attempts to (re)connect a stream
+STREAM_RETRY_INTERVAL = 2
+
+# Seconds between the status lines of every stream
+STREAM_STATUS_INTERVAL = 10
+
+
+class DeviceStream:
+    """
+    Reassembles the live chunks of a single device into WAV files.
+
+    Chunks carry the index of their first frame, so a chunk dropped on the way shows up as a
+    gap: short gaps are filled with silence, longer ones start a new file. Files are written
+    as <name>.wav.part and renamed when complete.
+    """
+
+    def __init__(self, directory: str, device_index: int, logger: logging.Logger, file_seconds: int = STREAM_FILE_SECONDS,
+                 max_gap_fill_seconds: float = MAX_GAP_FILL_SECONDS):
+        """
+        Args:
+            directory (str): Directory to write the files to
+            device_index (int): Index of the device on its node
+            logger (logging.Logger): Logger
+            file_seconds (int): Length of a file in seconds
+            max_gap_fill_seconds (float): Longest gap filled with silence, in seconds
+        """
+        self.directory = directory
+        self.device_index = device_index
+        self.logger = logger
+        self.file_seconds = file_seconds
+        self.max_gap_fill_seconds = max_gap_fill_seconds
+
+        self.file: wave.Wave_write = None
+        self.path = None
+        self.file_frames = 0
+        self.format = None
+        self.next_frame = None
+        self.next_sequence = None
+
+        self.chunks = 0
+        self.gaps = 0
+        self.missing_frames = 0
+        self.latency = None
+        self.files_written = []
+
+    def add(self, header: dict, samples: memoryview):
+        """
+        Args:
+            header (dict): Fields of the chunk header
+            samples (memoryview): Sample data of the chunk
+        """
+        sample_format = (header["sample_rate"], header["channels"], header["sample_width"])
+        frame_bytes = header["channels"] * header["sample_width"]
+        frames = len(samples) // frame_bytes
+        if header["first_frame"] + frames <= (self.next_frame or 0):
+            # Older than what was written, e.g. a new capture started; start over
+            self.close()
+        if self.file is not None and sample_format != self.format:
+            self.close()
+
+        if self.file is not None and header["first_frame"] > self.next_frame:
+            gap = header["first_frame"] - self.next_frame
+            self.gaps += 1
+            self.missing_frames += gap
+            self.logger.info(f"~[stream] {self.path}: {gap} frames missing (sequence {self.next_sequence} - {header['sequence']})")
+            if gap <= self.max_gap_fill_seconds * header["sample_rate"]:
+                self._write(bytes(gap * frame_bytes), header)
+            else:
+                self.close()
+
+        if self.file is None:
+            self.format = sample_format
+            self._open(header)
+        self._write(samples, header)
+
+        self.chunks += 1
+        self.next_sequence = header["sequence"] + 1
+        if header["first_sample_time"] is not None:
+            self.latency = time.time() - (header["first_sample_time"] + frames / header["sample_rate"])
+
+    def _open(self, header: dict):
+        start = header["first_sample_time"] if header["first_sample_time"] is not None else time.time()
+        timestamp = datetime.fromtimestamp(start).strftime("%Y_%m_%d_%H_%M_%S")
+        self.path = os.path.join(self.directory, f"PZOstream_{timestamp}_Udev{self.device_index}.wav")
+        self.file = wave.open(self.path + ".part", "wb")
+        self.file.setnchannels(header["channels"])
+        self.file.setsampwidth(header["sample_width"])
+        self.file.setframerate(header["sample_rate"])
+        self.file_frames = 0
+        self.next_frame = header["first_frame"]
+
+    def _write(self, samples, header: dict):
+        # Split on file boundaries, so every file holds file_seconds of audio
+        frame_bytes = header["channels"] * header["sample_width"]
+        samples = memoryview(samples)
+        while len(samples):
+            room = self.file_seconds * header["sample_rate"] - self.file_frames
+            head, samples = samples[:room * frame_bytes], samples[room * frame_bytes:]
+            self.file.writeframesraw(head)
+            frames = len(head) // frame_bytes
+            self.file_frames += frames
+            self.next_frame += frames
+            if self.file_frames >= self.file_seconds * header["sample_rate"]:
+                next_frame = self.next_frame
+                self.close()
+                first_sample_time = header["first_sample_time"]
+                if first_sample_time is not None:
+                    first_sample_time += (next_frame - header["first_frame"]) / header["sample_rate"]
+                self._open(dict(header, first_frame=next_frame, first_sample_time=first_sample_time))
+
+    def close(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        if self.file_frames:
+            os.replace(self.path + ".part", self.path)
+            self.files_written.append(self.path)
+        else:
+            os.remove(self.path + ".part")
+
+    def status(self) -> str:
+        latency = "-" if self.latency is None else f"{self.latency*1000:.0f} ms"
+        return f"Udev{self.device_index}: {self.chunks} chunks, latency {latency}, {self.gaps} gaps ({self.missing_frames} frames)"
+
+
+class WindowsPACStreamReceiver:
+    """
+    Receives the live audio of every node and writes it straight to local storage, one set
+    of files per node and device, without the store-then-fetch round trip.
+
+    Every node gets a connection of its own (SUBSCRIBE#pcm on its command port), served by a
+    thread that reconnects whenever the node goes away. Optionally every chunk is also handed
+    to a callback, e.g. to plot or play the signals while they are being recorded.
+    """
+
+    def __init__(self, config: dict, logger: logging.Logger, on_chunk: Callable[[str, dict, memoryview], None] = None):
+        """
+        Args:
+            config (dict): Controller configuration
+            logger (logging.Logger): Logger
+            on_chunk (Callable, optional): Called with the node name, chunk header and samples of every chunk
+        """
+        self.config = config
+        self.logger = logger
+        self.on_chunk = on_chunk
+        self.local_storage_path = config['local_storage_path']
+
+        self.rpi_pac_nodes: list[RPI_PAC_TCP_Node] = []
+        self.streams: dict[tuple[str, int], DeviceStream] = {}
+        self.threads: list[threading.Thread] = []
+        self.sockets: dict[str, socket.socket] = {}
+        self.stop_event = threading.Event()
+        self.logger.info("~[stream] Building stream receiver...")
+
+    def add_rpi_pac_node(self, rpi_pac_node: RPI_PAC_TCP_Node):
+        self.rpi_pac_nodes.append(rpi_pac_node)
+
+    def start(self):
+        self.stop_event.clear()
+        for rpi_pac_node in self.rpi_pac_nodes:
+            thread = threading.Thread(target=self._receive_loop, args=(rpi_pac_node,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """
+        Disconnect from all nodes and finish the files.
+        """
+        self.stop_event.set()
+        for s in list(self.sockets.values()):
+            try:
+                # Wakes up the blocking receive
+                s.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        for thread in self.threads:
+            thread.join(timeout=5)
+        self.threads = []
+        for stream in self.streams.values():
+            stream.close()
+        self.logger.info(f"~[stream] Stream receiver stopped, {sum(len(stream.files_written) for stream in self.streams.values())} files written")
+
+    def _receive_loop(self, rpi_pac_node: RPI_PAC_TCP_Node):
+        failing = False
+        while not self.stop_event.is_set():
+            try:
+                with socket.create_connection((rpi_pac_node.ip_address, rpi_pac_node.port), timeout=5) as s:
+                    self.sockets[rpi_pac_node.name] = s
+                    s.settimeout(STREAM_TIMEOUT)
+                    payload = "SUBSCRIBE#pcm".encode()
+                    s.sendall(MESSAGE_HEADER.pack(len(payload)) + payload)
+                    response = RPI_PAC_TCP_Node.receive_message(s)
+                    if response != "SUBSCRIBED":
+                        raise ConnectionError(f"Stream refused: {response}")
+                    self.logger.info(f"~[stream] tcpnode:{rpi_pac_node.ip_address}:{rpi_pac_node.port} - Receiving live audio")
+                    failing = False
+                    self._receive_chunks(rpi_pac_node, s)
+            except Exception as e:
+                # Only log the first failure, not every retry while the node is down
+                if not failing and not self.stop_event.is_set():
+                    self.logger.error(f"~[stream] tcpnode:{rpi_pac_node.ip_address}:{rpi_pac_node.port} - Stream lost: {e}")
+                failing = True
+            finally:
+                self.sockets.pop(rpi_pac_node.name, None)
+            self.stop_event.wait(STREAM_RETRY_INTERVAL)
+
+    def _receive_chunks(self, rpi_pac_node: RPI_PAC_TCP_Node, s: socket.socket):
+        directory = os.path.join(self.local_storage_path, rpi_pac_node.name)
+        os.makedirs(directory, exist_ok=True)
+        next_status = time.monotonic() + STREAM_STATUS_INTERVAL
+        while not self.stop_event.is_set():
+            message = RPI_PAC_TCP_Node.receive_message(s, decode=False)
+            if message[:4] == PCM_CHUNK_MAGIC:
+                header, samples = self.unpack_chunk(message)
+                key = (rpi_pac_node.name, header["device_index"])
+                if key not in self.streams:
+                    self.streams[key] = DeviceStream(directory, header["device_index"], self.logger)
+                self.streams[key].add(header, samples)
+                if self.on_chunk is not None:
+                    try:
+                        self.on_chunk(rpi_pac_node.name, header, samples)
+                    except Exception as e:
+                        self.logger.error(f"~[stream] Error handling chunk of {rpi_pac_node.name}: {e}")
+
+            if time.monotonic() >= next_status:
+                next_status += STREAM_STATUS_INTERVAL
+                for (name, _), stream in self.streams.items():
+                    if name == rpi_pac_node.name:
+                        self.logger.info(f"~[stream] {name} {stream.status()}")
+
+    @staticmethod
+    def unpack_chunk(chunk: bytes) -> tuple[dict, memoryview]:
+        """
+        Returns:
+            tuple[dict, memoryview]: The header fields of a chunk, and a view of its samples
+        """
+        _, device_index, channels, sample_width, sample_rate, sequence, first_frame, first_sample_time, length = \
+            PCM_CHUNK_HEADER.unpack_from(chunk)
+        header = {
+            "device_index": device_index,
+            "channels": channels,
+            "sample_width": sample_width,
+            "sample_rate": sample_rate,
+            "sequence": sequence,
+            "first_frame": first_frame,
+            "first_sample_time": None if math.isnan(first_sample_time) else first_sample_time,
+        }
+        return header, memoryview(chunk)[PCM_CHUNK_HEADER.size:PCM_CHUNK_HEADER.size + length]